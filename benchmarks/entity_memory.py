@@ -0,0 +1,87 @@
+# Bytes per entity and attribute access speed: the slotted entity classes versus
+# the classes as they were before __slots__, with a per-instance __dict__ and the
+# fields the change dropped.
+#
+#     python benchmarks/entity_memory.py [--count N]
+import argparse
+import sys
+import timeit
+import tracemalloc
+
+from games import load_dsmario, load_smb
+
+# Fields the __slots__ change removed, with the values the classes used to set them to
+REMOVED_FIELDS = {
+    ("smb", "Platform"): {"bounce_timer": 0},
+    ("smb", "Player"): {"run_speed": 3.5, "carrying_item": None},
+    ("dsmario", "Boss"): {"world": 1},
+}
+
+def before_slots(cls, removed):
+    # The class without __slots__, setting the removed fields after its own __init__
+    namespace = {name: value for name, value in vars(cls).items()
+                 if name not in cls.__slots__ and name not in ("__slots__", "__dict__", "__weakref__")}
+    init = cls.__init__
+
+    def __init__(self, *args):
+        init(self, *args)
+        for name, value in removed.items():
+            setattr(self, name, value)
+
+    namespace["__init__"] = __init__
+    return type(cls.__name__, (), namespace)
+
+def bytes_per_object(make, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [make() for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # Don't charge the list holding them
+    return (after - before - sys.getsizeof(objects)) / count
+
+def access_ns(obj, number=200000):
+    # One read-modify-write of x per iteration
+    seconds = timeit.timeit("o.x = o.x + o.y", globals={"o": obj}, number=number)
+    return seconds / number * 1e9
+
+def measure(title, game, cases, count):
+    print(title)
+    print("%-10s %12s %12s %12s %12s" % ("entity", "before bytes", "slot bytes",
+                                          "before ns", "slot ns"))
+    for name, cls, args in cases:
+        before = before_slots(cls, REMOVED_FIELDS.get((game, name), {}))
+        before_bytes = bytes_per_object(lambda: before(*args), count)
+        slot_bytes = bytes_per_object(lambda: cls(*args), count)
+        print("%-10s %12.0f %12.0f %12.1f %12.1f" % (
+            name, before_bytes, slot_bytes, access_ns(before(*args)), access_ns(cls(*args))))
+    print()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Entity memory and attribute access")
+    parser.add_argument("--count", type=int, default=20000, help="objects allocated per class")
+    args = parser.parse_args(argv)
+
+    smb = load_smb()
+    measure("supermario2ddeeepseeek1.09.23.25.py", "smb", [
+        ("Platform", smb.Platform, (10, 20, 30, 15)),
+        ("Enemy", smb.Enemy, (10, 20, "goomba")),
+        ("Coin", smb.Coin, (10, 20)),
+        ("PowerUp", smb.PowerUp, (10, 20, "mushroom")),
+        ("Fireball", smb.Fireball, (10, 20, 1)),
+        ("FlagPole", smb.FlagPole, (10, 20)),
+        ("Player", smb.Player, (10, 20)),
+    ], args.count)
+
+    ds = load_dsmario()
+    measure("dsmario1.0.py", "dsmario", [
+        ("Platform", ds.Platform, (10, 20, 30, 15)),
+        ("Enemy", ds.Enemy, (10, 20, "goomba")),
+        ("Coin", ds.Coin, (10, 20)),
+        ("Flagpole", ds.Flagpole, (10, 20)),
+        ("Player", ds.Player, ()),
+        ("Boss", ds.Boss, ("kamek",)),
+    ], args.count)
+
+if __name__ == "__main__":
+    main()
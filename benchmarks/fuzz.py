@@ -0,0 +1,469 @@
+# Soak-test both games headlessly with random and mutated input on every core. Each
+# case plays one input stream and watches for crashes, hangs, softlocks, NaN positions
+# and entities far outside the level. Failing inputs are shrunk and saved as replay
+# scripts that the games' --script option plays back.
+#
+#     python benchmarks/fuzz.py --cases 200                     # quick run on every core
+#     python benchmarks/fuzz.py --hours 8 --frames 50000        # overnight soak
+#     python benchmarks/fuzz.py --target dsmario --jobs 4 --out failures
+import argparse
+import collections
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import signal
+import sys
+import time
+import traceback
+
+from games import load_dsmario, load_smb
+
+STALL_FRAMES = 1800  # Frames of input with no visible change before calling it a softlock
+CHECK_EVERY = 10  # Frames between position checks
+SHRINK_RUNS = 100  # Replays allowed when shrinking one failing input
+CORPUS_SIZE = 64  # Inputs kept per worker and target for mutation
+
+class Failure(Exception):
+    # A detected problem; failures of the same kind are the same bug
+    def __init__(self, kind, frame, detail=""):
+        super().__init__("%s at frame %d" % (kind, frame))
+        self.kind = kind
+        self.frame = frame
+        self.detail = detail
+
+class Hang(Exception):
+    pass
+
+def on_alarm(signum, frame):
+    raise Hang()
+
+# Targets
+
+class SmbTarget:
+    held_names = ("left", "right", "down")
+    press_rates = {"space": 0.05, "z": 0.03, "lshift": 0.02, "r": 0.0005}
+
+    def __init__(self, array_store=False, draw_every=10):
+        self.smb = load_smb()
+        self.keys = self.smb.KEY_NAMES
+        self.key_state = self.smb.KeyState
+        self.array_store = array_store
+        self.draw_every = draw_every
+        self.game = None
+
+    def random_start(self, rng):
+        return {"level": rng.randint(1, self.smb.BUILTIN_LEVELS)}
+
+    def header(self, start, seed):
+        # smb has no random source, so the seed is not needed to replay
+        header = dict(start)
+        if self.array_store:
+            header["array_store"] = True
+        return header
+
+    def start(self, start, seed):
+        # Same set-up as a headless --script run
+        smb = self.smb
+        self.game = smb.Game(headless=True, array_store=self.array_store)
+        if start["level"] != 1:
+            self.game.current_level = start["level"]
+            self.game.reset_level()
+        self.frame = 0
+
+    def step(self, held, pressed):
+        game = self.game
+        game.keys = held
+        for key in pressed:
+            game.handle_key(key)
+        game.save_positions()
+        game.update()
+        self.frame += 1
+        if self.frame % self.draw_every == 0:
+            game.draw()
+
+    def fingerprint(self):
+        player = self.game.player
+        return (self.game.current_level, round(player.x), round(player.y), player.lives,
+                player.score, player.power_level)
+
+    def cell(self):
+        # Coarse position, used to tell which inputs reach somewhere new
+        return (self.game.current_level, int(self.game.player.x) // 100)
+
+    def positions(self):
+        game = self.game
+        player = game.player
+        yield "player", player.x, player.y
+        for enemy in game.level.enemies:
+            yield "enemy", enemy.x, enemy.y
+        for fireball in player.fireballs:
+            yield "fireball", fireball.x, fireball.y
+        store = game.level.store
+        if store:
+            for x, y in zip(store.enemy_x[store.enemy_present].tolist(),
+                            store.enemy_y[store.enemy_present].tolist()):
+                yield "enemy", x, y
+
+    def bounds(self):
+        smb = self.smb
+        return (-smb.SCREEN_WIDTH, self.game.level.width + smb.SCREEN_WIDTH,
+                -4 * smb.SCREEN_HEIGHT, 4 * smb.SCREEN_HEIGHT)
+
+class DsTarget:
+    held_names = ("left", "right")
+    press_rates = {"space": 0.06, "r": 0.002}
+
+    def __init__(self):
+        self.ds = load_dsmario()
+        self.keys = self.ds.KEY_NAMES
+        self.key_state = self.ds.KeyState
+
+    def random_start(self, rng):
+        # Mostly straight into a level or boss fight, sometimes from the intro
+        if rng.random() < 0.2:
+            return {}
+        return {"world": rng.randint(1, len(self.ds.boss_types)), "level": rng.randint(1, 4)}
+
+    def header(self, start, seed):
+        return dict(start, seed=seed)
+
+    def start(self, start, seed):
+        # Same set-up as a --script run of a replay with this header
+        ds = self.ds
+        ds.random.seed(seed)
+        if start:
+            level = start["level"]
+            ds.new_game(start["world"], level, ds.BOSS if level >= 4 else ds.GAME)
+        else:
+            ds.new_game()
+
+    def step(self, held, pressed):
+        ds = self.ds
+        for key in pressed:
+            ds.handle_key(key)
+        ds.present(*ds.step(held))
+
+    def fingerprint(self):
+        ds = self.ds
+        player = ds.player
+        return (ds.game_state, ds.current_world, ds.current_level, round(player.x),
+                round(player.y), player.lives, player.score)
+
+    def cell(self):
+        ds = self.ds
+        return (ds.game_state, ds.current_world, ds.current_level, int(ds.player.x) // 100)
+
+    def positions(self):
+        ds = self.ds
+        yield "player", ds.player.x, ds.player.y
+        for enemy in ds.enemies:
+            yield "enemy", enemy.x, enemy.y
+        if ds.boss and ds.game_state == ds.BOSS:
+            yield "boss", ds.boss.x, ds.boss.y
+            for projectile in ds.boss.projectiles:
+                yield "projectile", projectile[0], projectile[1]
+
+    def bounds(self):
+        ds = self.ds
+        return (-ds.SCREEN_WIDTH, 2 * ds.SCREEN_WIDTH, -4 * ds.SCREEN_HEIGHT, 4 * ds.SCREEN_HEIGHT)
+
+TARGETS = {
+    "smb": SmbTarget,
+    "smb-store": lambda: SmbTarget(array_store=True),
+    "dsmario": DsTarget,
+}
+
+# Inputs: run-length segments in the games' replay format
+
+def random_segment(rng, target):
+    segment = {"frames": rng.choice((1, 2, 5, 10, 20, 40, 80))}
+    hold = [name for name in target.held_names
+            if rng.random() < (0.6 if name == "right" else 0.3)]
+    press = [name for name, rate in target.press_rates.items()
+             if rng.random() < min(1.0, rate * segment["frames"])]
+    if hold:
+        segment["hold"] = hold
+    if press:
+        segment["press"] = press
+    return segment
+
+def random_input(rng, target, frames):
+    segments = []
+    total = 0
+    while total < frames:
+        segment = random_segment(rng, target)
+        segments.append(segment)
+        total += segment["frames"]
+    return truncate(segments, frames)
+
+def mutate_input(rng, target, segments, frames, corpus):
+    # A few edits to a corpus input: replace, insert, delete, retime or splice segments
+    segments = [dict(segment) for segment in segments]
+    for _ in range(rng.randint(1, 8)):
+        i = rng.randrange(len(segments))
+        edit = rng.randrange(5)
+        if edit == 0:
+            segments[i] = random_segment(rng, target)
+        elif edit == 1:
+            segments.insert(i, random_segment(rng, target))
+        elif edit == 2 and len(segments) > 1:
+            del segments[i]
+        elif edit == 3:
+            segments[i]["frames"] = max(1, int(segments[i]["frames"] * rng.choice((0.5, 2, 4))))
+        else:
+            other = rng.choice(corpus)
+            j = rng.randrange(len(other))
+            segments[i:] = [dict(segment) for segment in other[j:]]
+    while sum(segment["frames"] for segment in segments) < frames:
+        segments.append(random_segment(rng, target))
+    return truncate(segments, frames)
+
+def truncate(segments, frames):
+    # The first frames frames of an input
+    kept = []
+    total = 0
+    for segment in segments:
+        if total >= frames:
+            break
+        segment = dict(segment)
+        segment["frames"] = min(segment["frames"], frames - total)
+        kept.append(segment)
+        total += segment["frames"]
+    return kept
+
+def expand(target, segments):
+    # Per-frame (held, pressed, active) as the games' load_input_script builds them
+    key_state = target.key_state
+    keys = target.keys
+    frames = []
+    for segment in segments:
+        held = key_state(keys[name] for name in segment.get("hold", []))
+        pressed = [keys[name] for name in segment.get("press", [])]
+        active = bool(segment.get("hold"))
+        for i in range(segment["frames"]):
+            frames.append((held, pressed if i == 0 else [], active or bool(pressed and i == 0)))
+    return frames
+
+# Playing and shrinking
+
+def crash_kind(error):
+    # Exception type and the innermost line in a game script that raised it
+    where = "?"
+    for frame in traceback.extract_tb(error.__traceback__):
+        if not frame.filename.endswith("fuzz.py"):
+            where = "%s:%d" % (os.path.basename(frame.filename), frame.lineno)
+    return "crash %s at %s" % (type(error).__name__, where)
+
+def check_positions(target, frame):
+    left, right, top, bottom = target.bounds()
+    for what, x, y in target.positions():
+        if not (math.isfinite(x) and math.isfinite(y)):
+            raise Failure("nan %s position" % what, frame, "(%r, %r)" % (x, y))
+        if not (left <= x <= right and top <= y <= bottom):
+            raise Failure("%s out of bounds" % what, frame, "(%.1f, %.1f)" % (x, y))
+
+def play(target, start, seed, segments, timeout):
+    # Runs one input; returns the cells it visited or raises Failure
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.alarm(timeout)
+    frame = 0
+    try:
+        target.start(start, seed)
+        cells = {target.cell()}
+        fingerprint = target.fingerprint()
+        stalled = 0
+        for frame, (held, pressed, active) in enumerate(expand(target, segments)):
+            target.step(held, pressed)
+            now = target.fingerprint()
+            if now != fingerprint:
+                fingerprint = now
+                stalled = 0
+            elif active:
+                stalled += 1
+                if stalled >= STALL_FRAMES:
+                    raise Failure("softlock", frame, repr(now))
+            if frame % CHECK_EVERY == 0:
+                check_positions(target, frame)
+                cells.add(target.cell())
+        check_positions(target, frame)
+        return cells
+    except Failure:
+        raise
+    except Hang:
+        raise Failure("hang", frame, "no frame finished within %d s" % timeout)
+    except Exception as error:
+        raise Failure(crash_kind(error), frame, traceback.format_exc())
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+
+def shrink(target, start, seed, segments, failure, timeout):
+    # Greedy delta debugging: keep any smaller input that still fails the same way
+    budget = [SHRINK_RUNS]
+    found = [failure]
+
+    def fails(candidate):
+        if budget[0] <= 0 or not candidate:
+            return False
+        budget[0] -= 1
+        try:
+            play(target, start, seed, candidate, timeout)
+        except Failure as again:
+            if again.kind == failure.kind:
+                found[0] = again
+                return True
+        return False
+
+    segments = truncate(segments, failure.frame + 1)
+    chunk = len(segments) // 2
+    while chunk >= 1:
+        i = 0
+        while i < len(segments):
+            candidate = segments[:i] + segments[i + chunk:]
+            if fails(candidate):
+                segments = candidate
+            else:
+                i += chunk
+        chunk //= 2
+    # Then drop presses and held keys the failure does not need
+    for i in range(len(segments)):
+        for field in ("press", "hold"):
+            if field in segments[i]:
+                candidate = [dict(segment) for segment in segments]
+                del candidate[i][field]
+                if fails(candidate):
+                    segments = candidate
+    return truncate(segments, found[0].frame + 1), found[0]
+
+# Workers
+
+_targets = {}
+_corpus = collections.defaultdict(collections.deque)
+_seen = collections.defaultdict(set)
+
+def worker_init():
+    # The parent handles Ctrl-C and closes the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_case(task):
+    name, case, base_seed, frames, mutate, timeout = task
+    target = _targets.get(name)
+    if target is None:
+        target = _targets[name] = TARGETS[name]()
+    rng = random.Random(base_seed * 1000003 + case)
+    start = target.random_start(rng)
+    seed = rng.randrange(2**32)
+    corpus = _corpus[name]
+    if corpus and rng.random() < mutate:
+        segments = mutate_input(rng, target, rng.choice(corpus), frames, corpus)
+    else:
+        segments = random_input(rng, target, frames)
+
+    try:
+        cells = play(target, start, seed, segments, timeout)
+    except Failure as failure:
+        small, failure = shrink(target, start, seed, segments, failure, timeout)
+        script = dict(target.header(start, seed), failure="%s: %s" % (failure, failure.detail),
+                      segments=small)
+        return {"target": name, "case": case, "frames": failure.frame + 1,
+                "kind": failure.kind, "script": script}
+
+    if not cells <= _seen[name]:
+        _seen[name] |= cells
+        corpus.append(segments)
+        if len(corpus) > CORPUS_SIZE:
+            corpus.popleft()
+    return {"target": name, "case": case, "frames": frames, "kind": None}
+
+# Driver
+
+REPLAY_COMMANDS = {
+    "smb": "python supermario2ddeeepseeek1.09.23.25.py --headless --script %s",
+    "smb-store": "python supermario2ddeeepseeek1.09.23.25.py --headless --array-store --script %s",
+    "dsmario": "python dsmario1.0.py --headless --script %s",
+}
+
+def save_failure(out, result):
+    os.makedirs(out, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9]+", "-", result["kind"]).strip("-").lower()
+    path = os.path.join(out, "%s-%s-case%d.json" % (result["target"], slug, result["case"]))
+    with open(path, "w") as f:
+        json.dump(result["script"], f, separators=(",", ":"))
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fuzz both games with random input")
+    parser.add_argument("--target", default="smb,dsmario",
+                        help="comma-separated targets: %s" % ", ".join(sorted(TARGETS)))
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--cases", type=int, help="inputs to play (default: 100, or no limit "
+                        "with --hours)")
+    parser.add_argument("--hours", type=float, help="stop starting new cases after this long")
+    parser.add_argument("--frames", type=int, default=10000, help="frames per case")
+    parser.add_argument("--mutate", type=float, default=0.5,
+                        help="fraction of cases that mutate an earlier interesting input")
+    parser.add_argument("--seed", type=int, default=1, help="base seed; cases derive theirs")
+    parser.add_argument("--timeout", type=int, default=300,
+                        help="seconds one case may run before it counts as a hang")
+    parser.add_argument("--out", default="fuzz-failures", help="directory for failing inputs")
+    args = parser.parse_args(argv)
+    targets = [name for name in args.target.split(",") if name]
+    for name in targets:
+        if name not in TARGETS:
+            parser.error("unknown target %r" % name)
+    cases = args.cases
+    if cases is None and args.hours is None:
+        cases = 100
+    deadline = time.time() + args.hours * 3600 if args.hours else math.inf
+
+    started = time.perf_counter()
+    frames = 0
+    done = 0
+    kinds = collections.Counter()
+    saved = {}
+    pending = collections.deque()
+    case = 0
+    pool = multiprocessing.Pool(args.jobs, initializer=worker_init)
+    try:
+        while True:
+            # Keep two cases queued per worker so none sits idle
+            while (len(pending) < args.jobs * 2 and (cases is None or case < cases)
+                   and time.time() < deadline):
+                name = targets[case % len(targets)]
+                pending.append(pool.apply_async(run_case, ((name, case, args.seed, args.frames,
+                                                            args.mutate, args.timeout),)))
+                case += 1
+            if not pending:
+                break
+            result = pending.popleft().get()
+            done += 1
+            frames += result["frames"]
+            if result["kind"]:
+                key = (result["target"], result["kind"])
+                kinds[key] += 1
+                if key not in saved:
+                    saved[key] = save_failure(args.out, result)
+                    print("%s: %s" % (result["target"], result["kind"]), flush=True)
+                    print("    replay: " + REPLAY_COMMANDS[result["target"]] % saved[key], flush=True)
+            if done % 100 == 0:
+                elapsed = time.perf_counter() - started
+                print("%d cases, %d frames, %.0f frames/s" % (done, frames, frames / elapsed),
+                      flush=True)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        print("interrupted")
+    pool.join()
+
+    elapsed = time.perf_counter() - started
+    print("%d cases, %d frames in %.1f s: %.0f frames/s on %d workers"
+          % (done, frames, elapsed, frames / elapsed if elapsed else 0, args.jobs))
+    for (name, kind), count in kinds.most_common():
+        print("  %5d  %-10s %s" % (count, name, kind))
+    return 1 if kinds else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+# Load both game scripts as modules for the benchmarks. Their file names are not
+# importable names, and both open a display at import, so the SDL dummy drivers
+# are selected first unless the caller chose others. SDL's own SIGINT/SIGTERM
+# handlers are turned off so worker processes can still be interrupted and killed.
+# The repository root goes on sys.path for mario_common, which both scripts import.
+import importlib.util
+import os
+import sys
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("SDL_NO_SIGNAL_HANDLERS", "1")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SMB_PATH = os.path.join(ROOT, "supermario2ddeeepseeek1.09.23.25.py")
+DSMARIO_PATH = os.path.join(ROOT, "dsmario1.0.py")
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+_modules = {}
+
+def _load(name, path):
+    module = _modules.get(name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        # The scripts read their options from sys.argv; keep the caller's from them
+        argv = sys.argv
+        sys.argv = [path]
+        try:
+            spec.loader.exec_module(module)
+        finally:
+            sys.argv = argv
+        _modules[name] = module
+    return module
+
+def load_smb():
+    return _load("smb", SMB_PATH)
+
+def load_dsmario():
+    # Importing builds world 1-1 but does not start the game loop
+    return _load("dsmario", DSMARIO_PATH)
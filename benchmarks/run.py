@@ -0,0 +1,362 @@
+# Headless benchmark suite for both games: ms/frame for simulation and drawing
+# over scenarios that scale entity counts, plus level build/reset times.
+#
+#     python benchmarks/run.py                                # every scenario
+#     python benchmarks/run.py --only smb-enemies --sizes 10,100,1000
+#     python benchmarks/run.py --output before.json
+#     python benchmarks/run.py --baseline before.json         # compare, exit 1 on regressions
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from games import load_dsmario, load_smb
+
+import pygame
+
+class Held:
+    # Indexable like pygame.key.get_pressed() for a fixed set of keys
+    def __init__(self, keys=()):
+        self.keys = frozenset(keys)
+
+    def __getitem__(self, key):
+        return key in self.keys
+
+RIGHT = [pygame.K_RIGHT]
+LEFT = [pygame.K_LEFT]
+
+def walk_keys(frame):
+    # Pace back and forth so the player keeps meeting things
+    return RIGHT if (frame // 120) % 2 == 0 else LEFT
+
+def result(name, ops, seconds, **parts):
+    ms = seconds / ops * 1000
+    record = {"name": name, "ops": ops, "ms": ms,
+              "per_second": 1000 / ms if ms else float("inf")}
+    if parts:
+        record["parts"] = {part: value / ops * 1000 for part, value in parts.items()}
+    return record
+
+# smb scenarios
+
+def populate(smb, level, platforms=0, enemies=0, coins=0, seed=1):
+    # Scatter extra entities over the first screen of a level
+    rng = random.Random(seed)
+    width, height = smb.SCREEN_WIDTH, smb.SCREEN_HEIGHT
+    for _ in range(platforms):
+        platform = smb.Platform(rng.randrange(0, width - 60), rng.randrange(60, height - 80), 60, 15)
+        level.platforms.append(platform)
+        level.grid.insert(platform)
+    for _ in range(enemies):
+        level.enemies.append(smb.Enemy(rng.randrange(0, width - 16), rng.randrange(40, height - 80),
+                                       "goomba"))
+    for _ in range(coins):
+        level.coins.append(smb.Coin(rng.randrange(10, width - 10), rng.randrange(40, height - 60)))
+    level.paint_static(level.static_layer, 0, level.platforms)
+
+def smb_game(smb, length, array_store=False, **counts):
+    # Jump every 40 frames while walking
+    frames = [(walk_keys(f), [pygame.K_SPACE] if f % 40 == 0 else []) for f in range(length)]
+    game = smb.Game(headless=True, input_source=smb.ScriptedInput(frames))
+    populate(smb, game.level, **counts)
+    if array_store:
+        level = game.level
+        level.store = smb.EntityStore(level.coins, level.powerups, level.enemies)
+        level.coins, level.powerups, level.enemies = [], [], []
+    return game
+
+def level_4_game(smb, length, array_store=False):
+    # The long scrolling level, played for length frames
+    frames = [(walk_keys(f), [pygame.K_SPACE] if f % 40 == 0 else []) for f in range(length)]
+    game = smb.Game(headless=True, input_source=smb.ScriptedInput(frames),
+                    array_store=array_store)
+    game.current_level = 4
+    game.reset_level()
+    game.simulate(length)
+    return game
+
+def run_smb_frames(name, game, frames, warmup, every_frame=None):
+    update = draw = 0.0
+    clock = time.perf_counter
+    for frame in range(warmup + frames):
+        if every_frame:
+            every_frame(game)
+        start = clock()
+        game.handle_events()
+        game.save_positions()
+        game.update()
+        middle = clock()
+        game.draw()
+        end = clock()
+        if frame >= warmup:
+            update += middle - start
+            draw += end - middle
+    return result(name, frames, update + draw, update=update, draw=draw)
+
+def smb_scenarios(smb, sizes, frames, warmup):
+    # Yields (name, run) pairs; run(name) returns the result
+    families = [("platforms", {}), ("enemies", {}), ("coins", {})]
+    if smb.np is not None:
+        families.append(("enemies-store", {"array_store": True}))
+    for family, options in families:
+        kind = family.split("-")[0]
+        for n in sizes:
+            counts = dict(options, **{kind: n})
+            def scale(name, counts=counts):
+                game = smb_game(smb, warmup + frames, **counts)
+                return run_smb_frames(name, game, frames, warmup)
+            yield "smb-%s-%d" % (family, n), scale
+
+    def storm(game):
+        # Fire on every frame; the pool caps how many are in flight
+        game.player.power_level = 2
+        game.player.fireball_cooldown = 0
+        game.player.shoot_fireball()
+
+    def fireballs(name):
+        game = smb_game(smb, warmup + frames, enemies=100)
+        return run_smb_frames(name, game, frames, warmup, storm)
+    yield "smb-fireball-storm", fireballs
+
+    repeats = 20
+    for level_num in (1, 2, 3, 4):
+        def build(name, level_num=level_num):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                smb.Level(level_num, 1)
+            return result(name, repeats, time.perf_counter() - start)
+        yield "smb-build-level-%d" % level_num, build
+
+    def reset(name):
+        game = smb.Game(headless=True)
+        game.current_level = 4
+        game.reset_level()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            game.reset_level()
+        return result(name, repeats, time.perf_counter() - start)
+    yield "smb-reset-level-4", reset
+
+    def enter_preloaded(name):
+        # Main thread time to enter a level a worker thread has finished building
+        game = smb.Game(headless=True)
+        game.current_level = 4
+        total = 0.0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as loader:
+            for _ in range(repeats):
+                game.levels[4] = loader.submit(game.build_level, 4).result()
+                start = time.perf_counter()
+                game.reset_level()
+                total += time.perf_counter() - start
+        game.close()
+        return result(name, repeats, total)
+    yield "smb-enter-preloaded-level-4", enter_preloaded
+
+    if smb.np is not None:
+        def env_steps(name):
+            env = smb.GameEnv()
+            env.reset()
+            rng = random.Random(1)
+            start = time.perf_counter()
+            for _ in range(frames):
+                env.step(rng.randrange(env.action_count))
+            return result(name, frames, time.perf_counter() - start)
+        yield "smb-env-step", env_steps
+
+        def vector_steps(name):
+            envs = smb.VectorEnv(8)
+            envs.reset()
+            rng = random.Random(1)
+            start = time.perf_counter()
+            for _ in range(frames):
+                envs.step([rng.randrange(envs.action_count) for _ in range(8)])
+            seconds = time.perf_counter() - start
+            envs.close()
+            return result(name, frames * 8, seconds)
+        yield "smb-vector-env-8", vector_steps
+
+        def copy_frames(name):
+            # What capturing cost before FrameCapture: a new full array per frame
+            game = smb.Game(headless=True)
+            game.draw()
+            start = time.perf_counter()
+            for _ in range(frames):
+                pygame.surfarray.array3d(game.screen)
+            return result(name, frames, time.perf_counter() - start)
+        yield "smb-capture-array3d", copy_frames
+
+        for label, scale, grayscale in (("rgb", 1, False), ("gray-2", 2, True),
+                                        ("gray-4", 4, True)):
+            def capture(name, scale=scale, grayscale=grayscale):
+                game = smb.Game(headless=True)
+                game.draw()
+                frame_capture = smb.FrameCapture(game.screen, scale, grayscale)
+                start = time.perf_counter()
+                for _ in range(frames):
+                    frame_capture.grab()
+                return result(name, frames, time.perf_counter() - start)
+            yield "smb-capture-%s" % label, capture
+
+    for array_store in (False, True) if smb.np is not None else (False,):
+        def snapshots(name, array_store=array_store):
+            game = level_4_game(smb, warmup, array_store)
+            start = time.perf_counter()
+            for _ in range(frames):
+                game.snapshot()
+            return result(name, frames, time.perf_counter() - start)
+        yield "smb-snapshot-level-4%s" % ("-store" if array_store else ""), snapshots
+
+        def restores(name, array_store=array_store):
+            game = level_4_game(smb, warmup, array_store)
+            state = game.snapshot()
+            start = time.perf_counter()
+            for _ in range(frames):
+                game.restore(state)
+            return result(name, frames, time.perf_counter() - start)
+        yield "smb-restore-level-4%s" % ("-store" if array_store else ""), restores
+
+    def rollback(name):
+        # Netplay's worst case: restore and re-simulate NET_MAX_ROLLBACK frames of the
+        # long level with two players, snapshotting each frame again
+        game = level_4_game(smb, warmup)
+        game.add_partner()
+        game.reset_level()
+        game.simulate(warmup)
+        state = game.snapshot()
+        start = time.perf_counter()
+        for _ in range(frames):
+            game.restore(state)
+            for _ in range(smb.NET_MAX_ROLLBACK):
+                game.snapshot()
+                game.update()
+        return result(name, frames, time.perf_counter() - start)
+    yield "smb-rollback-%d" % smb.NET_MAX_ROLLBACK, rollback
+
+    def open_file(name):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, smb.LEVEL_FILE_NAME % 4)
+            smb.write_level_file(smb.Level(4, 1), path)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                smb.Level(4, 1, source=smb.LevelFile(path))
+            return result(name, repeats, time.perf_counter() - start)
+    yield "smb-open-level-file-4", open_file
+
+# dsmario scenarios
+
+def run_ds_frames(ds, name, frames, warmup, every_frame):
+    space = pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE)
+    clock = time.perf_counter
+    total = 0.0
+    for frame in range(warmup + frames):
+        every_frame()
+        start = clock()
+        for event in pygame.event.get():
+            ds.handle_event(event)
+        if frame % 40 == 0:
+            ds.handle_event(space)
+        ds.present(*ds.step(Held(walk_keys(frame))))
+        if frame >= warmup:
+            total += clock() - start
+    return result(name, frames, total)
+
+def ds_scenarios(ds, frames, warmup):
+    def level(name):
+        ds.random.seed(1)  # Same enemy types every run
+        ds.player = ds.Player()
+        ds.current_world, ds.current_level = 1, 1
+        ds.game_state = ds.GAME
+        ds.create_level(1, 1)
+
+        def keep_playing():
+            # Stay on this level: no deaths, no flagpole transition
+            ds.player.lives = 3
+            ds.level_complete = False
+        return run_ds_frames(ds, name, frames, warmup, keep_playing)
+    yield "ds-level", level
+
+    for world, boss_type in enumerate(ds.boss_types, 1):
+        def boss(name, world=world):
+            ds.player = ds.Player()
+            ds.current_world, ds.current_level = world, 4
+            ds.game_state = ds.BOSS
+            ds.create_level(world, 4)
+
+            def keep_fighting():
+                ds.player.lives = 3
+                ds.boss.health = 5
+            return run_ds_frames(ds, name, frames, warmup, keep_fighting)
+        yield "ds-boss-%s" % boss_type, boss
+
+# Reporting
+
+def print_table(results, baseline=None):
+    print("%-28s %8s %10s %10s %10s %10s" % ("scenario", "ops", "ms/op", "per sec",
+                                             "update ms", "draw ms"))
+    for record in results:
+        parts = record.get("parts", {})
+        line = "%-28s %8d %10.3f %10.0f %10s %10s" % (
+            record["name"], record["ops"], record["ms"], record["per_second"],
+            "%.3f" % parts["update"] if "update" in parts else "",
+            "%.3f" % parts["draw"] if "draw" in parts else "")
+        if baseline and record["name"] in baseline:
+            before = baseline[record["name"]]["ms"]
+            line += "  %+6.1f%%" % ((record["ms"] - before) / before * 100)
+        print(line)
+
+def regressions(results, baseline, tolerance):
+    slower = []
+    for record in results:
+        before = baseline.get(record["name"])
+        if before and record["ms"] > before["ms"] * (1 + tolerance):
+            slower.append(record["name"])
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark both games headlessly")
+    parser.add_argument("--sizes", default="10,100,1000",
+                        help="comma-separated entity counts for the scaling scenarios")
+    parser.add_argument("--frames", type=int, default=300, help="timed frames per scenario")
+    parser.add_argument("--warmup", type=int, default=30, help="untimed frames first")
+    parser.add_argument("--only", help="run scenarios whose name starts with this")
+    parser.add_argument("--output", help="save results as JSON")
+    parser.add_argument("--baseline", help="JSON from an earlier --output to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="fractional slowdown against the baseline counted as a regression")
+    args = parser.parse_args(argv)
+    sizes = [int(n) for n in args.sizes.split(",") if n]
+
+    smb = load_smb()
+    ds = load_dsmario()
+    scenarios = list(smb_scenarios(smb, sizes, args.frames, args.warmup))
+    scenarios += ds_scenarios(ds, args.frames, args.warmup)
+
+    results = [run(name) for name, run in scenarios
+               if not args.only or name.startswith(args.only)]
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {record["name"]: record for record in json.load(f)["results"]}
+    print_table(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "pygame": pygame.version.ver,
+                       "machine": platform.machine(), "results": results}, f, indent=2)
+
+    if baseline:
+        slower = regressions(results, baseline, args.tolerance)
+        if slower:
+            print("slower than baseline by more than %d%%: %s"
+                  % (args.tolerance * 100, ", ".join(slower)))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,19 @@ import pygame
 import sys
 import random
 import math
+import os
+import itertools
+import json
+import concurrent.futures
+
+from mario_common import (SpriteCache, DigitAtlas, HudLabel, FrameProfiler, LevelFile,
+                          write_level_records, LEVEL_CHUNK_WIDTH)
+
+# --headless runs without a visible window or frame-rate cap, e.g. to replay a recording
+HEADLESS = "--headless" in sys.argv
+if HEADLESS:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
 
 # Initialize pygame
 pygame.init()
@@ -13,6 +26,31 @@ SCREEN_HEIGHT = 600
 screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
 pygame.display.set_caption("Super Mario 2D World")
 
+# Push only changed screen regions with display.update instead of flipping every frame
+DIRTY_RECTS = "--dirty-rects" in sys.argv
+
+def option_value(name):
+    # The argument following name on the command line, if given
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+    return None
+
+# Regular levels found in LEVEL_DIR as level files replace the built-in layouts;
+# --export-levels writes the built-in ones there instead of starting the game
+LEVEL_DIR = option_value("--levels")
+EXPORT_DIR = option_value("--export-levels")
+
+# --profile times each frame phase and prints a summary on exit (F3 toggles the overlay);
+# --trace FILE also writes the phases as Chrome trace-event JSON
+TRACE_PATH = option_value("--trace")
+PROFILE = "--profile" in sys.argv or TRACE_PATH is not None
+
+# --record FILE saves every frame's input and the random seed as a replay on exit;
+# --script FILE plays one back frame for frame; --seed N fixes the random seed
+RECORD_PATH = option_value("--record")
+SCRIPT_PATH = option_value("--script")
+SEED_OPTION = option_value("--seed")
+
 # Colors
 WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
@@ -35,8 +73,27 @@ title_font = pygame.font.SysFont('Arial', 48, bold=True)
 subtitle_font = pygame.font.SysFont('Arial', 36)
 normal_font = pygame.font.SysFont('Arial', 24)
 
+# HUD text cache
+hud_atlas = DigitAtlas(normal_font, WHITE)
+hud_lives = HudLabel(normal_font, hud_atlas, (20, 20))
+hud_score = HudLabel(normal_font, hud_atlas, (20, 50))
+hud_world = HudLabel(normal_font, hud_atlas, (SCREEN_WIDTH - 20, 20), anchor="right")
+hud_boss = HudLabel(normal_font, hud_atlas, (SCREEN_WIDTH//2, 20), anchor="center")
+
+# Frame profiling
+profiler = None
+if PROFILE:
+    profiler = FrameProfiler(TRACE_PATH)
+    profiler.overlay = True
+
+# Sprite cache
+sprite_cache = SpriteCache()
+
 # Player class
 class Player:
+    __slots__ = ("width", "height", "x", "y", "vel_y", "jump_power", "gravity", "is_jumping",
+                 "speed", "direction", "lives", "score", "invincible", "color")
+
     def __init__(self):
         self.width = 40
         self.height = 60
@@ -89,25 +146,34 @@ class Player:
         if self.invincible > 0:
             self.invincible -= 1
     
+    @staticmethod
+    def paint(surface, x, y, key):
+        _, color, direction, width, height = key
+        # Body
+        pygame.draw.rect(surface, color, (x, y, width, height))
+        # Hat
+        pygame.draw.rect(surface, RED, (x-5, y, width+10, 15))
+        # Face
+        pygame.draw.circle(surface, (255, 200, 150), (x+width//2, y+25), 12)
+        # Eyes
+        pygame.draw.circle(surface, BLACK, (x+width//2+5*direction, y+22), 4)
+        # Mustache
+        pygame.draw.rect(surface, BLACK, (x+width//2-15, y+30, 30, 5))
+
     def draw(self, screen):
         # Draw Mario
         if self.invincible > 0 and self.invincible % 10 < 5:
             # Flash when invincible
             return
             
-        # Body
-        pygame.draw.rect(screen, self.color, (self.x, self.y, self.width, self.height))
-        # Hat
-        pygame.draw.rect(screen, RED, (self.x-5, self.y, self.width+10, 15))
-        # Face
-        pygame.draw.circle(screen, (255, 200, 150), (self.x+self.width//2, self.y+25), 12)
-        # Eyes
-        pygame.draw.circle(screen, BLACK, (self.x+self.width//2+5*self.direction, self.y+22), 4)
-        # Mustache
-        pygame.draw.rect(screen, BLACK, (self.x+self.width//2-15, self.y+30, 30, 5))
+        key = ("player", self.color, self.direction, self.width, self.height)
+        return sprite_cache.blit(screen, key, (self.width + 10, self.height), (5, 0),
+                                 self.paint, self.x, self.y)
 
 # Platform class
 class Platform:
+    __slots__ = ("x", "y", "width", "height", "color")
+
     def __init__(self, x, y, width, height, color=BROWN):
         self.x = x
         self.y = y
@@ -120,6 +186,8 @@ class Platform:
 
 # Enemy class
 class Enemy:
+    __slots__ = ("x", "y", "width", "height", "speed", "direction", "type", "is_alive")
+
     def __init__(self, x, y, enemy_type="goomba"):
         self.x = x
         self.y = y
@@ -153,29 +221,63 @@ class Enemy:
         if not on_platform:
             self.direction *= -1
     
-    def draw(self, screen):
-        if not self.is_alive:
-            return
-            
-        if self.type == "goomba":
+    @staticmethod
+    def paint(surface, x, y, key):
+        _, enemy_type, width, height = key
+        if enemy_type == "goomba":
             # Draw Goomba
-            pygame.draw.ellipse(screen, (139, 69, 19), (self.x, self.y, self.width, self.height))
-            pygame.draw.ellipse(screen, (100, 40, 0), (self.x, self.y, self.width, self.height//2))
+            pygame.draw.ellipse(surface, (139, 69, 19), (x, y, width, height))
+            pygame.draw.ellipse(surface, (100, 40, 0), (x, y, width, height//2))
             # Eyes
-            pygame.draw.circle(screen, BLACK, (self.x+10, self.y+15), 5)
-            pygame.draw.circle(screen, BLACK, (self.x+30, self.y+15), 5)
-        elif self.type == "koopa":
+            pygame.draw.circle(surface, BLACK, (x+10, y+15), 5)
+            pygame.draw.circle(surface, BLACK, (x+30, y+15), 5)
+        elif enemy_type == "koopa":
             # Draw Koopa Troopa
-            pygame.draw.ellipse(screen, GREEN, (self.x, self.y, self.width, self.height))
-            pygame.draw.ellipse(screen, (0, 100, 0), (self.x, self.y, self.width, self.height//2))
+            pygame.draw.ellipse(surface, GREEN, (x, y, width, height))
+            pygame.draw.ellipse(surface, (0, 100, 0), (x, y, width, height//2))
             # Shell pattern
-            pygame.draw.ellipse(screen, (0, 80, 0), (self.x+5, self.y+5, self.width-10, self.height-10))
+            pygame.draw.ellipse(surface, (0, 80, 0), (x+5, y+5, width-10, height-10))
+
+    def draw(self, screen):
+        if not self.is_alive:
+            return
+            
+        key = ("enemy", self.type, self.width, self.height)
+        return sprite_cache.blit(screen, key, (self.width, self.height), (0, 0),
+                                 self.paint, self.x, self.y)
+
+# Boss projectiles in flight at once; dry_bowser's spreads keep about fifteen alive
+PROJECTILE_CAPACITY = 32
+
+class ProjectilePool:
+    # Fixed set of [x, y, dx, dy] slots; the first count are in flight, in firing order
+    def __init__(self, capacity=PROJECTILE_CAPACITY):
+        self.slots = [[0, 0, 0, 0] for _ in range(capacity)]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return itertools.islice(self.slots, self.count)
+
+    def spawn(self, x, y, dx, dy=0):
+        # Dropped when every slot is in flight
+        if self.count < len(self.slots):
+            proj = self.slots[self.count]
+            proj[0] = x
+            proj[1] = y
+            proj[2] = dx
+            proj[3] = dy
+            self.count += 1
 
 # Boss class
 class Boss:
-    def __init__(self, boss_type, world):
+    __slots__ = ("type", "width", "height", "x", "y", "health", "speed", "direction",
+                 "attack_timer", "projectiles")
+
+    def __init__(self, boss_type):
         self.type = boss_type
-        self.world = world
         self.width = 80
         self.height = 80
         self.x = SCREEN_WIDTH - 150
@@ -184,7 +286,7 @@ class Boss:
         self.speed = 3
         self.direction = -1
         self.attack_timer = 0
-        self.projectiles = []
+        self.projectiles = ProjectilePool()
         
     def update(self, player):
         # Move side to side
@@ -200,11 +302,13 @@ class Boss:
             self.attack()
             self.attack_timer = 0
             
-        # Update projectiles
-        for proj in self.projectiles[:]:
+        # Update projectiles, packing survivors to the front of the pool in order
+        slots = self.projectiles.slots
+        kept = 0
+        for i in range(self.projectiles.count):
+            proj = slots[i]
             proj[0] += proj[2] * 5  # Move projectile
-            if proj[0] < 0 or proj[0] > SCREEN_WIDTH:
-                self.projectiles.remove(proj)
+            live = 0 <= proj[0] <= SCREEN_WIDTH
                 
             # Check collision with player
             if (player.x < proj[0] < player.x + player.width and
@@ -212,68 +316,98 @@ class Boss:
                 player.invincible == 0):
                 player.lives -= 1
                 player.invincible = 60
-                if proj in self.projectiles:
-                    self.projectiles.remove(proj)
+                live = False
+
+            if live:
+                slots[i] = slots[kept]
+                slots[kept] = proj
+                kept += 1
+        self.projectiles.count = kept
     
     def attack(self):
         # Create projectiles based on boss type
         if self.type == "kamek":
             # Kamek shoots magic projectiles
-            self.projectiles.append([self.x, self.y + self.height//2, -1])
+            self.projectiles.spawn(self.x, self.y + self.height//2, -1)
         elif self.type == "king_boo":
             # King Boo shoots ghostly projectiles
             angle = math.atan2(player.y - self.y, player.x - self.x)
-            self.projectiles.append([self.x, self.y + self.height//2, math.cos(angle), math.sin(angle)])
+            self.projectiles.spawn(self.x, self.y + self.height//2, math.cos(angle), math.sin(angle))
         elif self.type == "wiggler":
             # Wiggler charges
             self.speed = 8
             pygame.time.set_timer(pygame.USEREVENT, 1000)  # Reset speed after 1 second
         elif self.type == "bowser_jr":
             # Bowser Jr. shoots fireballs
-            self.projectiles.append([self.x, self.y + self.height//2, -1])
-            self.projectiles.append([self.x, self.y + self.height//2, -0.7])
-            self.projectiles.append([self.x, self.y + self.height//2, -1.3])
+            self.projectiles.spawn(self.x, self.y + self.height//2, -1)
+            self.projectiles.spawn(self.x, self.y + self.height//2, -0.7)
+            self.projectiles.spawn(self.x, self.y + self.height//2, -1.3)
         elif self.type == "dry_bowser":
             # Dry Bowser shoots bone projectiles
             for i in range(5):
                 angle = (i - 2) * 0.3
-                self.projectiles.append([self.x, self.y + self.height//2, math.cos(angle), math.sin(angle)])
+                self.projectiles.spawn(self.x, self.y + self.height//2, math.cos(angle), math.sin(angle))
     
-    def draw(self, screen):
-        if self.type == "kamek":
+    @staticmethod
+    def paint(surface, x, y, key):
+        _, boss_type, width, height = key
+        if boss_type == "kamek":
             # Draw Kamek
-            pygame.draw.rect(screen, (200, 0, 200), (self.x, self.y, self.width, self.height))
-            pygame.draw.circle(screen, (150, 0, 150), (self.x+self.width//2, self.y-10), 20)
+            pygame.draw.rect(surface, (200, 0, 200), (x, y, width, height))
+            pygame.draw.circle(surface, (150, 0, 150), (x+width//2, y-10), 20)
             # Eyes
-            pygame.draw.circle(screen, YELLOW, (self.x+20, self.y+20), 10)
-            pygame.draw.circle(screen, YELLOW, (self.x+60, self.y+20), 10)
-            pygame.draw.circle(screen, BLACK, (self.x+20, self.y+20), 5)
-            pygame.draw.circle(screen, BLACK, (self.x+60, self.y+20), 5)
+            pygame.draw.circle(surface, YELLOW, (x+20, y+20), 10)
+            pygame.draw.circle(surface, YELLOW, (x+60, y+20), 10)
+            pygame.draw.circle(surface, BLACK, (x+20, y+20), 5)
+            pygame.draw.circle(surface, BLACK, (x+60, y+20), 5)
             # Nose
-            pygame.draw.polygon(screen, (255, 150, 150), [(self.x+40, self.y+30), (self.x+30, self.y+50), (self.x+50, self.y+50)])
-        elif self.type == "king_boo":
+            pygame.draw.polygon(surface, (255, 150, 150), [(x+40, y+30), (x+30, y+50), (x+50, y+50)])
+        elif boss_type == "king_boo":
             # Draw King Boo
-            pygame.draw.circle(screen, WHITE, (self.x+self.width//2, self.y+self.height//2), self.width//2)
-            pygame.draw.circle(screen, (200, 200, 200), (self.x+self.width//2, self.y+self.height//2), self.width//2-5)
+            pygame.draw.circle(surface, WHITE, (x+width//2, y+height//2), width//2)
+            pygame.draw.circle(surface, (200, 200, 200), (x+width//2, y+height//2), width//2-5)
             # Crown
-            pygame.draw.polygon(screen, YELLOW, [(self.x+20, self.y+10), (self.x+40, self.y-20), (self.x+60, self.y+10)])
+            pygame.draw.polygon(surface, YELLOW, [(x+20, y+10), (x+40, y-20), (x+60, y+10)])
             # Eyes
-            pygame.draw.ellipse(screen, BLACK, (self.x+20, self.y+20, 20, 30))
-            pygame.draw.ellipse(screen, BLACK, (self.x+40, self.y+20, 20, 30))
+            pygame.draw.ellipse(surface, BLACK, (x+20, y+20, 20, 30))
+            pygame.draw.ellipse(surface, BLACK, (x+40, y+20, 20, 30))
             # Mouth
-            pygame.draw.arc(screen, BLACK, (self.x+20, self.y+40, 40, 20), 0, math.pi, 3)
+            pygame.draw.arc(surface, BLACK, (x+20, y+40, 40, 20), 0, math.pi, 3)
+
+    @staticmethod
+    def paint_projectile(surface, x, y, key):
+        boss_type = key[1]
+        if boss_type == "kamek" or boss_type == "bowser_jr":
+            pygame.draw.circle(surface, RED, (x, y), 8)
+        elif boss_type == "king_boo":
+            pygame.draw.circle(surface, (200, 200, 255), (x, y), 8)
+        elif boss_type == "dry_bowser":
+            pygame.draw.ellipse(surface, WHITE, (x, y, 15, 8))
+
+    def draw(self, screen):
+        # Returns the screen areas touched
+        areas = []
+        if self.type == "kamek" or self.type == "king_boo":
+            # Head and crown reach 30 pixels above the body
+            key = ("boss", self.type, self.width, self.height)
+            areas.append(sprite_cache.blit(screen, key, (self.width + 1, self.height + 31), (0, 30),
+                                           self.paint, self.x, self.y))
         
         # Draw projectiles
+        if self.type == "dry_bowser":
+            size, origin = (15, 8), (0, 0)
+        else:
+            size, origin = (17, 17), (8, 8)
+        key = ("boss_projectile", self.type)
         for proj in self.projectiles:
-            if self.type == "kamek" or self.type == "bowser_jr":
-                pygame.draw.circle(screen, RED, (int(proj[0]), int(proj[1])), 8)
-            elif self.type == "king_boo":
-                pygame.draw.circle(screen, (200, 200, 255), (int(proj[0]), int(proj[1])), 8)
-            elif self.type == "dry_bowser":
-                pygame.draw.ellipse(screen, WHITE, (int(proj[0]), int(proj[1]), 15, 8))
+            areas.append(sprite_cache.blit(screen, key, size, origin, self.paint_projectile,
+                                           proj[0], proj[1]))
+        return areas
 
 # Coin class
 class Coin:
+    __slots__ = ("x", "y", "width", "height", "collected", "animation")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -285,15 +419,24 @@ class Coin:
     def update(self):
         self.animation = (self.animation + 0.1) % (2 * math.pi)
         
+    @staticmethod
+    def paint(surface, x, y, key):
+        radius = key[1]
+        pygame.draw.circle(surface, YELLOW, (x, y), radius)
+        pygame.draw.circle(surface, (255, 200, 0), (x, y), radius - 3)
+
     def draw(self, screen):
         if not self.collected:
             # Animated coin
             offset = math.sin(self.animation) * 3
-            pygame.draw.circle(screen, YELLOW, (int(self.x + self.width//2), int(self.y + self.height//2 + offset)), self.width//2)
-            pygame.draw.circle(screen, (255, 200, 0), (int(self.x + self.width//2), int(self.y + self.height//2 + offset)), self.width//2 - 3)
+            r = self.width//2
+            return sprite_cache.blit(screen, ("coin", r), (r*2 + 1, r*2 + 1), (r, r), self.paint,
+                                     self.x + r, self.y + self.height//2 + offset)
 
 # Flagpole class (end of level)
 class Flagpole:
+    __slots__ = ("x", "y", "width", "height", "flag_raised")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -301,15 +444,22 @@ class Flagpole:
         self.height = 200
         self.flag_raised = False
         
-    def draw(self, screen):
+    @staticmethod
+    def paint(surface, x, y, key):
+        _, flag_raised, width, height = key
         # Pole
-        pygame.draw.rect(screen, (200, 200, 200), (self.x, self.y, self.width, self.height))
+        pygame.draw.rect(surface, (200, 200, 200), (x, y, width, height))
         # Flag
-        if not self.flag_raised:
-            pygame.draw.polygon(screen, RED, [(self.x+self.width, self.y+30), 
-                                            (self.x+self.width+40, self.y+30), 
-                                            (self.x+self.width+40, self.y+60), 
-                                            (self.x+self.width, self.y+60)])
+        if not flag_raised:
+            pygame.draw.polygon(surface, RED, [(x+width, y+30), 
+                                             (x+width+40, y+30), 
+                                             (x+width+40, y+60), 
+                                             (x+width, y+60)])
+
+    def draw(self, screen):
+        key = ("flagpole", self.flag_raised, self.width, self.height)
+        return sprite_cache.blit(screen, key, (self.width + 41, self.height), (0, 0),
+                                 self.paint, self.x, self.y)
 
 # Create game objects
 player = Player()
@@ -318,12 +468,15 @@ enemies = []
 coins = []
 boss = None
 flagpole = None
+background = None
 
 # Game state
 game_state = INTRO
 current_world = 1
 current_level = 1
-intro_timer = 0
+intro_frames = 0      # Frames the intro has been up
+intro_started = None  # Clock time of a live intro's first frame
+intro_length = None   # Frames the intro lasted, saved with recordings
 boss_defeated = False
 level_complete = False
 level_timer = 0
@@ -332,310 +485,743 @@ level_timer = 0
 boss_types = ["kamek", "king_boo", "wiggler", "bowser_jr", "dry_bowser"]
 boss_names = ["Kamek", "King Boo", "Wiggler", "Bowser Jr.", "Dry Bowser"]
 
-# Create levels
+def world_color(world):
+    if world == 1:
+        return (135, 206, 235)  # Sky blue for world 1
+    elif world == 2:
+        return (100, 100, 200)  # Evening sky for world 2
+    elif world == 3:
+        return (150, 75, 0)     # Autumn for world 3
+    elif world == 4:
+        return (70, 70, 120)    # Night for world 4
+    else:
+        return (30, 30, 60)     # Space for world 5
+
+# Level files, in the format shared with the other game; dsmario levels have no power-ups
+ENEMY_TYPES = ("goomba", "koopa")
+
+def level_path(world, level):
+    return os.path.join(LEVEL_DIR or EXPORT_DIR, "world%d-%d.lvl" % (world, level))
+
+def read_level_file(path):
+    # Decode every chunk of a mapped level file into platforms, enemies, coins and flagpole
+    level_file = LevelFile(path)
+    records = ({}, {}, {})
+    try:
+        for i in range(len(level_file.index)):
+            for found, group in zip(records, level_file.read_chunk(i)):
+                for fields in group:
+                    found[fields[0]] = fields[1:]
+    finally:
+        level_file.close()
+    platform_records, enemy_records, coin_records = records
+    level_platforms = [Platform(x, y, w, h) for _, (x, y, w, h, _) in sorted(platform_records.items())]
+    level_enemies = [Enemy(x, y, ENEMY_TYPES[kind]) for _, (x, y, kind) in
+                     sorted(enemy_records.items())]
+    level_coins = [Coin(x, y) for _, (x, y) in sorted(coin_records.items())]
+    level_flagpole = Flagpole(*level_file.flag_pos) if level_file.flag_pos else None
+    return level_platforms, level_enemies, level_coins, level_flagpole
+
+def write_level_file(path, width=SCREEN_WIDTH, chunk_width=LEVEL_CHUNK_WIDTH):
+    # Save the current level's platforms, enemies, coins and flagpole
+    write_level_records(path, width, flagpole and (flagpole.x, flagpole.y),
+                        [(p.x, p.y, p.width, p.height, False) for p in platforms],
+                        [(e.x, e.y, ENEMY_TYPES.index(e.type)) for e in enemies],
+                        [(c.x, c.y) for c in coins], chunk_width=chunk_width)
+
+def slot_values(obj):
+    # Attribute values of a slotted entity, in __slots__ order
+    return [getattr(obj, name) for name in obj.__slots__]
+
+def set_slot_values(obj, values):
+    for name, value in zip(obj.__slots__, values):
+        setattr(obj, name, value)
+
+# Levels built so far by (world, level): platforms, baked background and flagpole,
+# plus every entity's starting attributes, copied back when the level is re-entered
+level_templates = {}
+
+# Levels being built on a worker thread by (world, level) while the flag sequence
+# plays. Building touches no globals and rolls no enemy types, so the swap in
+# create_level makes the same random calls as building there would.
+preloads = {}
+loader = None  # Their worker, started by the first preload_level
+
+def next_level(world, level):
+    # The level played after world-level
+    if level < 4:
+        return world, level + 1
+    return world + 1, 1
+
+def preload_level(world, level):
+    global loader
+    if (world, level) not in level_templates and (world, level) not in preloads:
+        if loader is None:
+            loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        preloads[(world, level)] = loader.submit(build_level, world, level)
+
 def create_level(world, level):
-    global platforms, enemies, coins, flagpole, boss
-    
-    platforms = []
-    enemies = []
-    coins = []
-    boss = None
-    flagpole = None
-    
+    global platforms, enemies, coins, flagpole, boss, background
+    template = level_templates.get((world, level))
+    if template is None:
+        # A preloaded level is swapped in, waiting only if its build is still running
+        future = preloads.pop((world, level), None)
+        built = future.result() if future else build_level(world, level)
+        level_platforms, level_enemies, level_coins, level_flagpole, level_background, rolled = built
+        entities = level_enemies + level_coins + ([level_flagpole] if level_flagpole else [])
+        template = level_templates[(world, level)] = (
+            level_platforms, level_enemies, level_coins, level_flagpole, level_background,
+            [(obj, slot_values(obj)) for obj in entities], rolled)
+
+    platforms, enemies, coins, flagpole, background, states, rolled = template
+    for obj, values in states:
+        set_slot_values(obj, values)
+    if rolled:
+        # Built-in levels pick enemy types afresh on every visit
+        for enemy in enemies:
+            enemy.type = random.choice(["goomba", "koopa"])
+    boss = Boss(boss_types[world-1]) if level >= 4 else None
+
+def build_level(world, level):
+    # Platforms, enemies, coins, flagpole and baked background for world-level, and
+    # whether its enemy types are left to roll (built-in layouts rather than level files)
+    if LEVEL_DIR and level < 4 and os.path.exists(level_path(world, level)):
+        level_platforms, level_enemies, level_coins, level_flagpole = \
+            read_level_file(level_path(world, level))
+        return (level_platforms, level_enemies, level_coins, level_flagpole,
+                bake_background(world, level_platforms), False)
+
+    level_enemies = []
+    level_coins = []
+    level_flagpole = None
+
     # Ground platform
-    platforms.append(Platform(0, SCREEN_HEIGHT - 50, SCREEN_WIDTH, 50))
+    level_platforms = [Platform(0, SCREEN_HEIGHT - 50, SCREEN_WIDTH, 50)]
     
     # Level design based on world and level
     if level < 4:  # Regular levels
         # Add platforms
         for i in range(5):
-            platforms.append(Platform(150 + i*120, SCREEN_HEIGHT - 150, 80, 20))
+            level_platforms.append(Platform(150 + i*120, SCREEN_HEIGHT - 150, 80, 20))
             
         # Add enemies
         for i in range(3):
-            enemies.append(Enemy(200 + i*200, SCREEN_HEIGHT - 190, random.choice(["goomba", "koopa"])))
+            level_enemies.append(Enemy(200 + i*200, SCREEN_HEIGHT - 190))
             
         # Add coins
         for i in range(10):
-            coins.append(Coin(100 + i*70, SCREEN_HEIGHT - 200))
+            level_coins.append(Coin(100 + i*70, SCREEN_HEIGHT - 200))
             
         # Add flagpole at the end
-        flagpole = Flagpole(SCREEN_WIDTH - 100, SCREEN_HEIGHT - 250)
+        level_flagpole = Flagpole(SCREEN_WIDTH - 100, SCREEN_HEIGHT - 250)
         
     else:  # Boss level
-        # Create boss
-        boss = Boss(boss_types[world-1], world)
-        
         # Add platforms for boss battle
-        platforms.append(Platform(0, SCREEN_HEIGHT - 150, 200, 20))
-        platforms.append(Platform(SCREEN_WIDTH - 200, SCREEN_HEIGHT - 150, 200, 20))
-        platforms.append(Platform(SCREEN_WIDTH//2 - 100, SCREEN_HEIGHT - 250, 200, 20))
+        level_platforms.append(Platform(0, SCREEN_HEIGHT - 150, 200, 20))
+        level_platforms.append(Platform(SCREEN_WIDTH - 200, SCREEN_HEIGHT - 150, 200, 20))
+        level_platforms.append(Platform(SCREEN_WIDTH//2 - 100, SCREEN_HEIGHT - 250, 200, 20))
 
-# Initial level creation
-create_level(current_world, current_level)
+    return (level_platforms, level_enemies, level_coins, level_flagpole,
+            bake_background(world, level_platforms), True)
+
+def bake_background(world, level_platforms):
+    # Platforms never move, so bake them into the level background once
+    surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+    surface.fill(world_color(world))
+    for platform in level_platforms:
+        platform.draw(surface)
+    return surface
+
+def export_levels():
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    for world in range(1, len(boss_types) + 1):
+        for level in range(1, 4):
+            create_level(world, level)
+            write_level_file(level_path(world, level))
+            print(level_path(world, level))
+
+# Input
+KEY_NAMES = {
+    "left": pygame.K_LEFT,
+    "right": pygame.K_RIGHT,
+    "space": pygame.K_SPACE,
+    "r": pygame.K_r,
+}
+HELD_KEY_NAMES = ("left", "right")  # Keys the game reads as held rather than pressed
+
+class KeyState:
+    # Stands in for pygame.key.get_pressed() with a fixed set of held keys
+    def __init__(self, held=()):
+        self.held = frozenset(held)
 
-# Main game loop
-clock = pygame.time.Clock()
+    def __getitem__(self, key):
+        return key in self.held
+
+NO_KEYS = KeyState()
+
+class KeyboardInput:
+    # Live input from the pygame event queue
+    def __init__(self):
+        self.focused = True  # Cleared while the window is in the background
+
+    def poll(self):
+        pressed = []
+        quit_requested = False
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                quit_requested = True
+            elif event.type == pygame.KEYDOWN:
+                pressed.append(event.key)
+            elif event.type == pygame.WINDOWFOCUSLOST:
+                self.focused = False
+            elif event.type == pygame.WINDOWFOCUSGAINED:
+                self.focused = True
+        return pygame.key.get_pressed(), pressed, quit_requested
+
+class ScriptedInput:
+    # Plays back (held_keys, pressed_keys) per frame, asking to quit with the last one.
+    # The event queue is still read so the window can be closed during a replay.
+    def __init__(self, frames=(), seed=None, start=None, intro_frames=None):
+        self.frames = frames
+        self.index = 0
+        self.seed = seed  # Random seed of a recorded replay, if known
+        self.start = start  # new_game() arguments when it starts somewhere other than 1-1
+        self.intro_frames = intro_frames  # Frames a recorded intro lasted, if known
+
+    def __len__(self):
+        return len(self.frames)
+
+    def poll(self):
+        quit_requested = any(event.type == pygame.QUIT for event in pygame.event.get())
+        if self.index >= len(self.frames):
+            return NO_KEYS, [], True
+        held, pressed = self.frames[self.index]
+        self.index += 1
+        return held, pressed, quit_requested or self.index == len(self.frames)
+
+class InputRecorder:
+    # Passes another input source through, keeping what it returned as script segments
+    def __init__(self, source):
+        self.source = source
+        self.segments = []
+        self.names = {key: name for name, key in KEY_NAMES.items()}
+
+    def poll(self):
+        keys, pressed, quit_requested = self.source.poll()
+        hold = [name for name in HELD_KEY_NAMES if keys[KEY_NAMES[name]]]
+        press = [self.names[key] for key in pressed if key in self.names]
+        last = self.segments[-1] if self.segments else None
+        if last is not None and not press and last.get("hold", []) == hold:
+            last["frames"] += 1
+        else:
+            segment = {"frames": 1}
+            if hold:
+                segment["hold"] = hold
+            if press:
+                segment["press"] = press
+            self.segments.append(segment)
+        return keys, pressed, quit_requested
+
+    def save(self, path, **header):
+        # A script load_input_script reads back, with header fields beside the segments
+        with open(path, "w") as f:
+            json.dump(dict(header, segments=self.segments), f, separators=(",", ":"))
+
+def load_input_script(path):
+    # {"seed": 1234, "segments": [{"frames": 30, "hold": ["right"], "press": ["space"]}]}
+    # Keys in "press" go down on the first frame of their segment only. With "world"
+    # (and optionally "level") the replay starts in that level instead of the intro;
+    # otherwise "intro_frames" says how many frames the recorded intro lasted.
+    with open(path) as f:
+        script = json.load(f)
+    start = None
+    if "world" in script:
+        level = script.get("level", 1)
+        start = (script["world"], level, BOSS if level >= 4 else GAME)
+    frames = []
+    for segment in script["segments"]:
+        held = KeyState(KEY_NAMES[name] for name in segment.get("hold", []))
+        pressed = [KEY_NAMES[name] for name in segment.get("press", [])]
+        for i in range(segment.get("frames", 1)):
+            frames.append((held, pressed if i == 0 else []))
+    return ScriptedInput(frames, script.get("seed"), start, script.get("intro_frames"))
+
+# Main game loop state
 running = True
+dirty = []        # Areas drawn last frame, erased from the background next frame
+presented = None  # (game_state, background) shown last frame when it can be patched
 
-while running:
-    # Handle events
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-        elif event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_SPACE:
-                if game_state == INTRO:
-                    game_state = GAME
-                elif game_state == GAME and not level_complete:
-                    player.jump()
-                elif game_state == BOSS and not boss_defeated:
-                    player.jump()
-                elif game_state == GAME_OVER or game_state == VICTORY:
-                    # Reset game
-                    player = Player()
-                    current_world = 1
-                    current_level = 1
-                    create_level(current_world, current_level)
-                    game_state = GAME
-            elif event.key == pygame.K_r and (game_state == GAME_OVER or game_state == VICTORY):
-                # Reset game
-                player = Player()
-                current_world = 1
-                current_level = 1
-                create_level(current_world, current_level)
-                game_state = GAME
-    
-    # Fill background
-    if current_world == 1:
-        screen.fill((135, 206, 235))  # Sky blue for world 1
-    elif current_world == 2:
-        screen.fill((100, 100, 200))  # Evening sky for world 2
-    elif current_world == 3:
-        screen.fill((150, 75, 0))     # Autumn for world 3
-    elif current_world == 4:
-        screen.fill((70, 70, 120))    # Night for world 4
-    else:
-        screen.fill((30, 30, 60))     # Space for world 5
-    
-    # Game state handling
-    if game_state == INTRO:
-        # Draw intro screens
-        intro_timer += 1
-        
-        if intro_timer < 180:  # SamSoft presents (3 seconds)
-            # SamSoft logo (similar to HAL Labs style)
-            pygame.draw.rect(screen, BLUE, (SCREEN_WIDTH//2 - 150, SCREEN_HEIGHT//2 - 100, 300, 200))
-            pygame.draw.rect(screen, WHITE, (SCREEN_WIDTH//2 - 140, SCREEN_HEIGHT//2 - 90, 280, 180))
-            
-            text = title_font.render("SamSoft", True, BLUE)
-            screen.blit(text, (SCREEN_WIDTH//2 - text.get_width()//2, SCREEN_HEIGHT//2 - 70))
-            
-            text = subtitle_font.render("presents", True, BLUE)
-            screen.blit(text, (SCREEN_WIDTH//2 - text.get_width()//2, SCREEN_HEIGHT//2))
-            
-        elif intro_timer < 360:  # Nintendo co-presents (3 seconds)
-            # Nintendo logo
-            pygame.draw.rect(screen, RED, (SCREEN_WIDTH//2 - 150, SCREEN_HEIGHT//2 - 100, 300, 200))
-            
-            text = title_font.render("Nintendo", True, WHITE)
-            screen.blit(text, (SCREEN_WIDTH//2 - text.get_width()//2, SCREEN_HEIGHT//2 - 70))
-            
-            text = subtitle_font.render("co-presents", True, WHITE)
-            screen.blit(text, (SCREEN_WIDTH//2 - text.get_width()//2, SCREEN_HEIGHT//2))
-            
-        else:  # Fade to game
+def new_game(world=1, level=1, state=INTRO):
+    # Reset every per-run global for a fresh player on world-level
+    global player, game_state, current_world, current_level, intro_frames, intro_started
+    global intro_length, boss_defeated, level_complete, level_timer, dirty, presented
+    player = Player()
+    game_state = state
+    current_world = world
+    current_level = level
+    intro_frames = 0
+    intro_started = None
+    intro_length = None
+    boss_defeated = False
+    level_complete = False
+    level_timer = 0
+    dirty = []
+    presented = None
+    create_level(world, level)
+
+# Every run is seeded so a recording can replay the same enemy types
+script = load_input_script(SCRIPT_PATH) if SCRIPT_PATH else None
+if SEED_OPTION is not None:
+    seed = int(SEED_OPTION)
+elif script and script.seed is not None:
+    seed = script.seed
+else:
+    seed = random.randrange(2**32)
+random.seed(seed)
+
+# Initial level creation
+if script and script.start:
+    new_game(*script.start)
+else:
+    new_game()
+
+def restore_background(state):
+    # Repaint the baked level background; in dirty-rect mode only under last frame's sprites
+    if DIRTY_RECTS and presented == (state, background):
+        for rect in dirty:
+            screen.blit(background, rect, rect)
+        return dirty
+    screen.blit(background, (0, 0))
+    return None
+
+def handle_event(event):
+    global running
+    if event.type == pygame.QUIT:
+        running = False
+    elif event.type == pygame.KEYDOWN:
+        handle_key(event.key)
+
+def handle_key(key):
+    global player, game_state, current_world, current_level, intro_length
+    if key == pygame.K_SPACE:
+        if game_state == INTRO:
             game_state = GAME
-            
-    elif game_state == GAME:
-        # Handle player input
-        keys = pygame.key.get_pressed()
-        if keys[pygame.K_LEFT]:
-            player.x -= player.speed
-            player.direction = -1
-        if keys[pygame.K_RIGHT]:
-            player.x += player.speed
-            player.direction = 1
-            
-        # Update game objects
-        player.update(platforms)
-        
-        for enemy in enemies:
-            enemy.update(platforms)
-            
-        for coin in coins:
-            coin.update()
-            
-        # Check coin collection
-        for coin in coins:
-            if (not coin.collected and 
-                player.x < coin.x + coin.width and 
-                player.x + player.width > coin.x and
-                player.y < coin.y + coin.height and 
-                player.y + player.height > coin.y):
-                coin.collected = True
-                player.score += 100
-                
-        # Check enemy collisions
-        for enemy in enemies[:]:
-            if (enemy.is_alive and
-                player.x < enemy.x + enemy.width and 
-                player.x + player.width > enemy.x and
-                player.y < enemy.y + enemy.height and 
-                player.y + player.height > enemy.y):
-                
-                # Player jumps on enemy
-                if player.vel_y > 0 and player.y + player.height < enemy.y + enemy.height/2:
-                    enemy.is_alive = False
-                    player.vel_y = -10  # Bounce
-                    player.score += 200
-                # Player gets hit
-                elif player.invincible == 0:
-                    player.lives -= 1
-                    player.invincible = 60
-                    
-        # Check if player reached flagpole
-        if flagpole and not level_complete:
-            if (player.x + player.width > flagpole.x and 
-                player.x < flagpole.x + flagpole.width):
-                level_complete = True
-                level_timer = 0
-                flagpole.flag_raised = True
-                
-        # Handle level completion
-        if level_complete:
-            level_timer += 1
-            if level_timer > 120:  # 2 seconds delay
-                level_complete = False
-                if current_level < 4:
-                    current_level += 1
-                else:
-                    current_level = 1
-                    current_world += 1
-                    if current_world > 5:
-                        game_state = VICTORY
-                    else:
-                        game_state = BOSS
-                create_level(current_world, current_level)
-                
-        # Check for game over
-        if player.lives <= 0:
-            game_state = GAME_OVER
-            
-        # Draw game objects
-        for platform in platforms:
-            platform.draw(screen)
-            
-        for coin in coins:
-            coin.draw(screen)
-            
-        for enemy in enemies:
-            enemy.draw(screen)
-            
-        if flagpole:
-            flagpole.draw(screen)
-            
-        player.draw(screen)
-        
-        # Draw UI
-        lives_text = normal_font.render(f"Lives: {player.lives}", True, WHITE)
-        screen.blit(lives_text, (20, 20))
-        
-        score_text = normal_font.render(f"Score: {player.score}", True, WHITE)
-        screen.blit(score_text, (20, 50))
-        
-        world_text = normal_font.render(f"World {current_world}-{current_level}", True, WHITE)
-        screen.blit(world_text, (SCREEN_WIDTH - world_text.get_width() - 20, 20))
-        
-    elif game_state == BOSS:
-        # Handle player input
-        keys = pygame.key.get_pressed()
-        if keys[pygame.K_LEFT]:
-            player.x -= player.speed
-            player.direction = -1
-        if keys[pygame.K_RIGHT]:
-            player.x += player.speed
-            player.direction = 1
-            
-        # Update game objects
-        player.update(platforms)
-        boss.update(player)
-        
-        # Check if player hits boss
-        if (boss and 
-            player.x < boss.x + boss.width and 
-            player.x + player.width > boss.x and
-            player.y < boss.y + boss.height and 
-            player.y + player.height > boss.y and
-            player.invincible == 0):
-            
-            # Player jumps on boss
-            if player.vel_y > 0 and player.y + player.height < boss.y + boss.height/2:
-                boss.health -= 1
+            # A replay's intro must not time out before this frame's key ends it
+            intro_length = intro_frames + 1
+        elif game_state == GAME and not level_complete:
+            player.jump()
+        elif game_state == BOSS and not boss_defeated:
+            player.jump()
+        elif game_state == GAME_OVER or game_state == VICTORY:
+            # Reset game
+            player = Player()
+            current_world = 1
+            current_level = 1
+            create_level(current_world, current_level)
+            game_state = GAME
+    elif key == pygame.K_F3 and profiler:
+        profiler.overlay = not profiler.overlay
+    elif key == pygame.K_r and (game_state == GAME_OVER or game_state == VICTORY):
+        # Reset game
+        player = Player()
+        current_world = 1
+        current_level = 1
+        create_level(current_world, current_level)
+        game_state = GAME
+
+# Screens that only change with the state they show, rendered once per variant
+static_screens = {}
+
+def show_static(key, paint):
+    # Blit the cached screen for key, painting it on first use with paint(surface).
+    # A screen already on the display is left alone rather than drawn and presented again.
+    global dirty
+    dirty = []
+    overlay = profiler and profiler.overlay
+    if presented == key and not overlay:
+        return [], key
+    surface = static_screens.get(key)
+    if surface is None:
+        surface = static_screens[key] = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+        surface.fill(world_color(key[1]))
+        paint(surface)
+    screen.blit(surface, (0, 0))
+    return None, None if overlay else key
+
+def blit_centered(surface, text, y):
+    surface.blit(text, (SCREEN_WIDTH//2 - text.get_width()//2, y))
+
+def paint_samsoft(surface):
+    # SamSoft logo (similar to HAL Labs style)
+    pygame.draw.rect(surface, BLUE, (SCREEN_WIDTH//2 - 150, SCREEN_HEIGHT//2 - 100, 300, 200))
+    pygame.draw.rect(surface, WHITE, (SCREEN_WIDTH//2 - 140, SCREEN_HEIGHT//2 - 90, 280, 180))
+    blit_centered(surface, title_font.render("SamSoft", True, BLUE), SCREEN_HEIGHT//2 - 70)
+    blit_centered(surface, subtitle_font.render("presents", True, BLUE), SCREEN_HEIGHT//2)
+
+def paint_nintendo(surface):
+    # Nintendo logo
+    pygame.draw.rect(surface, RED, (SCREEN_WIDTH//2 - 150, SCREEN_HEIGHT//2 - 100, 300, 200))
+    blit_centered(surface, title_font.render("Nintendo", True, WHITE), SCREEN_HEIGHT//2 - 70)
+    blit_centered(surface, subtitle_font.render("co-presents", True, WHITE), SCREEN_HEIGHT//2)
+
+def paint_game_over(surface):
+    blit_centered(surface, title_font.render("GAME OVER", True, RED), SCREEN_HEIGHT//2 - 50)
+    blit_centered(surface, normal_font.render("Press SPACE to play again or R to restart", True, WHITE),
+                  SCREEN_HEIGHT//2 + 50)
+
+def paint_victory(surface):
+    blit_centered(surface, title_font.render("VICTORY!", True, YELLOW), SCREEN_HEIGHT//2 - 50)
+    blit_centered(surface, normal_font.render(f"Final Score: {player.score}", True, WHITE),
+                  SCREEN_HEIGHT//2 + 20)
+    blit_centered(surface, normal_font.render("Press SPACE to play again or R to restart", True, WHITE),
+                  SCREEN_HEIGHT//2 + 70)
+
+# Each state's handler updates and draws one frame, returning what present() needs
+
+def intro_elapsed():
+    # Milliseconds the intro has been up: by the clock in a live window, otherwise 60
+    # frames a second so scripts, benchmarks and the fuzzer see the same frames every run
+    if not live_clock:
+        return intro_frames * 1000 / 60
+    return pygame.time.get_ticks() - intro_started
+
+def intro_over():
+    # A replay ends the intro on the frame its recording did
+    if script and script.intro_frames is not None:
+        return intro_frames >= script.intro_frames
+    return intro_elapsed() >= 2 * INTRO_SCREEN_MS
+
+def intro_wait():
+    # Milliseconds until the intro next changes screen
+    elapsed = intro_elapsed()
+    return max(1, int((INTRO_SCREEN_MS if elapsed < INTRO_SCREEN_MS else 2 * INTRO_SCREEN_MS)
+                      - elapsed))
+
+def step_intro(keys):
+    global game_state, intro_frames, intro_started, intro_length
+    # Draw intro screens: SamSoft presents, then Nintendo co-presents
+    intro_frames += 1
+    if intro_started is None:
+        intro_started = pygame.time.get_ticks()
+    if not intro_over():
+        if intro_elapsed() < INTRO_SCREEN_MS:
+            return show_static(("samsoft", current_world), paint_samsoft)
+        return show_static(("nintendo", current_world), paint_nintendo)
+    # Fade to game
+    game_state = GAME
+    intro_length = intro_frames
+    return show_static(("fade", current_world), lambda surface: None)
+
+def step_level(keys):
+    global game_state, current_world, current_level, level_complete, level_timer, dirty
+    # Handle player input
+    if keys[pygame.K_LEFT]:
+        player.x -= player.speed
+        player.direction = -1
+    if keys[pygame.K_RIGHT]:
+        player.x += player.speed
+        player.direction = 1
+
+    # Update game objects
+    player.update(platforms)
+    if profiler:
+        profiler.lap("player")
+
+    for enemy in enemies:
+        enemy.update(platforms)
+
+    for coin in coins:
+        coin.update()
+
+    if profiler:
+        profiler.lap("entities")
+        # The player checks every platform and each enemy at most all of them
+        live = sum(1 for enemy in enemies if enemy.is_alive)
+        profiler.count("platform tests", len(platforms) * (1 + live))
+        profiler.count("pickup tests", len(coins))
+        profiler.count("enemy tests", len(enemies))
+
+    # Check coin collection
+    for coin in coins:
+        if (not coin.collected and 
+            player.x < coin.x + coin.width and 
+            player.x + player.width > coin.x and
+            player.y < coin.y + coin.height and 
+            player.y + player.height > coin.y):
+            coin.collected = True
+            player.score += 100
+
+    # Check enemy collisions
+    for enemy in enemies[:]:
+        if (enemy.is_alive and
+            player.x < enemy.x + enemy.width and 
+            player.x + player.width > enemy.x and
+            player.y < enemy.y + enemy.height and 
+            player.y + player.height > enemy.y):
+
+            # Player jumps on enemy
+            if player.vel_y > 0 and player.y + player.height < enemy.y + enemy.height/2:
+                enemy.is_alive = False
                 player.vel_y = -10  # Bounce
-                if boss.health <= 0:
-                    boss_defeated = True
-                    player.score += 1000
+                player.score += 200
             # Player gets hit
-            else:
+            elif player.invincible == 0:
                 player.lives -= 1
                 player.invincible = 60
-                
-        # Handle boss defeat
-        if boss_defeated:
-            level_timer += 1
-            if level_timer > 120:  # 2 seconds delay
-                boss_defeated = False
-                game_state = GAME
-                
-        # Check for game over
-        if player.lives <= 0:
-            game_state = GAME_OVER
-            
-        # Draw game objects
-        for platform in platforms:
-            platform.draw(screen)
-            
-        boss.draw(screen)
-        player.draw(screen)
-        
-        # Draw UI
-        lives_text = normal_font.render(f"Lives: {player.lives}", True, WHITE)
-        screen.blit(lives_text, (20, 20))
-        
-        score_text = normal_font.render(f"Score: {player.score}", True, WHITE)
-        screen.blit(score_text, (20, 50))
-        
-        boss_text = normal_font.render(f"Boss: {boss_names[current_world-1]} - HP: {boss.health}", True, WHITE)
-        screen.blit(boss_text, (SCREEN_WIDTH//2 - boss_text.get_width()//2, 20))
-        
-        world_text = normal_font.render(f"World {current_world} Boss", True, WHITE)
-        screen.blit(world_text, (SCREEN_WIDTH - world_text.get_width() - 20, 20))
-        
-    elif game_state == GAME_OVER:
-        # Draw game over screen
-        text = title_font.render("GAME OVER", True, RED)
-        screen.blit(text, (SCREEN_WIDTH//2 - text.get_width()//2, SCREEN_HEIGHT//2 - 50))
-        
-        text = normal_font.render("Press SPACE to play again or R to restart", True, WHITE)
-        screen.blit(text, (SCREEN_WIDTH//2 - text.get_width()//2, SCREEN_HEIGHT//2 + 50))
-        
-    elif game_state == VICTORY:
-        # Draw victory screen
-        text = title_font.render("VICTORY!", True, YELLOW)
-        screen.blit(text, (SCREEN_WIDTH//2 - text.get_width()//2, SCREEN_HEIGHT//2 - 50))
-        
-        text = normal_font.render(f"Final Score: {player.score}", True, WHITE)
-        screen.blit(text, (SCREEN_WIDTH//2 - text.get_width()//2, SCREEN_HEIGHT//2 + 20))
+
+    # Check if player reached flagpole
+    if flagpole and not level_complete:
+        if (player.x + player.width > flagpole.x and 
+            player.x < flagpole.x + flagpole.width):
+            level_complete = True
+            level_timer = 0
+            flagpole.flag_raised = True
+            # Build the next level while the flag sequence plays
+            preload_level(*next_level(current_world, current_level))
+
+    # Handle level completion
+    if level_complete:
+        level_timer += 1
+        if level_timer > 120:  # 2 seconds delay
+            level_complete = False
+            current_world, current_level = next_level(current_world, current_level)
+            if current_level == 1:
+                if current_world > 5:
+                    game_state = VICTORY
+                else:
+                    game_state = BOSS
+            create_level(current_world, current_level)
+
+    # Check for game over
+    if player.lives <= 0:
+        game_state = GAME_OVER
+
+    if profiler:
+        profiler.lap("collisions")
+
+    # Draw game objects
+    erased = restore_background(GAME)
+    drawn_key = (GAME, background)
+    dirty = []
+    for coin in coins:
+        area = coin.draw(screen)
+        if area:
+            dirty.append(area)
+
+    for enemy in enemies:
+        area = enemy.draw(screen)
+        if area:
+            dirty.append(area)
+
+    if flagpole:
+        dirty.append(flagpole.draw(screen))
+
+    area = player.draw(screen)
+    if area:
+        dirty.append(area)
+
+    # Draw UI
+    dirty.append(hud_lives.draw(screen, "Lives: ", player.lives))
+    dirty.append(hud_score.draw(screen, "Score: ", player.score))
+    dirty.append(hud_world.draw(screen, "World ", f"{current_world}-{current_level}"))
+
+    return erased, drawn_key
+
+def step_boss(keys):
+    global game_state, boss_defeated, level_timer, dirty
+    # Handle player input
+    if keys[pygame.K_LEFT]:
+        player.x -= player.speed
+        player.direction = -1
+    if keys[pygame.K_RIGHT]:
+        player.x += player.speed
+        player.direction = 1
+
+    # Update game objects
+    player.update(platforms)
+    if profiler:
+        profiler.lap("player")
+    boss.update(player)
+    if profiler:
+        profiler.lap("boss")
+        profiler.count("platform tests", len(platforms))
+
+    # Check if player hits boss
+    if (boss and 
+        player.x < boss.x + boss.width and 
+        player.x + player.width > boss.x and
+        player.y < boss.y + boss.height and 
+        player.y + player.height > boss.y and
+        player.invincible == 0):
+
+        # Player jumps on boss
+        if player.vel_y > 0 and player.y + player.height < boss.y + boss.height/2:
+            boss.health -= 1
+            player.vel_y = -10  # Bounce
+            if boss.health <= 0:
+                boss_defeated = True
+                player.score += 1000
+        # Player gets hit
+        else:
+            player.lives -= 1
+            player.invincible = 60
+
+    # Handle boss defeat
+    if boss_defeated:
+        level_timer += 1
+        if level_timer > 120:  # 2 seconds delay
+            boss_defeated = False
+            game_state = GAME
+
+    # Check for game over
+    if player.lives <= 0:
+        game_state = GAME_OVER
+
+    if profiler:
+        profiler.lap("collisions")
+
+    # Draw game objects
+    erased = restore_background(BOSS)
+    drawn_key = (BOSS, background)
+    dirty = []
+    dirty.extend(boss.draw(screen))
+    area = player.draw(screen)
+    if area:
+        dirty.append(area)
+
+    # Draw UI
+    dirty.append(hud_lives.draw(screen, "Lives: ", player.lives))
+    dirty.append(hud_score.draw(screen, "Score: ", player.score))
+    dirty.append(hud_boss.draw(screen, f"Boss: {boss_names[current_world-1]} - HP: ", boss.health))
+    dirty.append(hud_world.draw(screen, "World ", current_world, " Boss"))
+
+    return erased, drawn_key
+
+def step_game_over(keys):
+    return show_static(("game over", current_world), paint_game_over)
+
+def step_victory(keys):
+    return show_static(("victory", current_world, player.score), paint_victory)
+
+STATE_HANDLERS = {
+    INTRO: step_intro,
+    GAME: step_level,
+    BOSS: step_boss,
+    GAME_OVER: step_game_over,
+    VICTORY: step_victory,
+}
+IDLE_STATES = (INTRO, GAME_OVER, VICTORY)  # Nothing moves until a key or the intro clock
+INTRO_SCREEN_MS = 3000  # How long each intro screen stays up
+WAKE_EVENTS = (pygame.QUIT, pygame.KEYDOWN, pygame.WINDOWFOCUSLOST, pygame.WINDOWFOCUSGAINED)
+live_clock = False  # Set by main() when a player at the keyboard drives a window
+
+def step(keys):
+    # Update and draw one frame for the held keys; returns what present() needs
+    erased, drawn_key = STATE_HANDLERS[game_state](keys)
+    if profiler:
+        if profiler.overlay:
+            area = profiler.draw_overlay(screen, (20, 80))
+            if drawn_key:
+                dirty.append(area)
+        profiler.lap("draw")
+
+    return erased, drawn_key
+
+def present(erased, drawn_key):
+    # Show the frame: only the changed areas when the last frame could be patched
+    global presented
+    if erased is not None:
+        # Nothing at all to send while a static screen stays up
+        if erased or dirty:
+            pygame.display.update(erased + dirty)
+    else:
+        pygame.display.flip()
+    presented = drawn_key
+    if profiler:
+        profiler.lap("flip")
+
+def wait_for_focus(keyboard):
+    # Pause while the window is in the background, asleep on the event queue until
+    # it is focused again or closed. Nothing is polled, so recordings skip the pause.
+    global running
+    while running and not keyboard.focused:
+        event = pygame.event.wait()
+        if event.type == pygame.QUIT:
+            running = False
+        elif event.type == pygame.WINDOWFOCUSGAINED:
+            keyboard.focused = True
+
+def wait_for_input(timeout=None):
+    # Sleep on the event queue while a static screen is up, until an event poll() acts
+    # on arrives or timeout milliseconds pass. The event goes back for poll() to read.
+    deadline = None if timeout is None else pygame.time.get_ticks() + timeout
+    while True:
+        if deadline is None:
+            event = pygame.event.wait()
+        else:
+            left = deadline - pygame.time.get_ticks()
+            if left <= 0:
+                return
+            event = pygame.event.wait(left)
+        if event.type in WAKE_EVENTS:
+            pygame.event.post(event)
+            return
+
+def main():
+    if EXPORT_DIR:
+        export_levels()
+        pygame.quit()
+        return
+
+    global running, live_clock
+    keyboard = KeyboardInput()
+    input_source = script if script is not None else keyboard
+    live_clock = not HEADLESS and script is None
+    if RECORD_PATH:
+        input_source = InputRecorder(input_source)
+    clock = pygame.time.Clock()
+    frames = 0
+    while running:
+        if profiler:
+            profiler.begin_frame()
+        keys, pressed, quit_requested = input_source.poll()
+        if quit_requested:
+            running = False
+        for key in pressed:
+            handle_key(key)
+        if profiler:
+            profiler.lap("events")
+        present(*step(keys))
+        if profiler:
+            profiler.end_frame()
+        frames += 1
         
-        text = normal_font.render("Press SPACE to play again or R to restart", True, WHITE)
-        screen.blit(text, (SCREEN_WIDTH//2 - text.get_width()//2, SCREEN_HEIGHT//2 + 70))
-    
-    # Update display
-    pygame.display.flip()
-    
-    # Cap the frame rate
-    clock.tick(60)
+        # Cap the frame rate; a player's static screens sleep until there is input
+        # or the intro moves on
+        if live_clock and game_state in IDLE_STATES:
+            wait_for_input(intro_wait() if game_state == INTRO else None)
+            clock.tick()
+        elif not HEADLESS:
+            clock.tick(60)
+        if not HEADLESS:
+            wait_for_focus(keyboard)
+
+    if RECORD_PATH:
+        header = {"seed": seed}
+        if script and script.start:
+            header["world"], header["level"] = script.start[:2]
+        elif intro_length is not None:
+            header["intro_frames"] = intro_length
+        input_source.save(RECORD_PATH, **header)
+    if script:
+        print(f"frames={frames} world={current_world}-{current_level} score={player.score} "
+              f"lives={player.lives}")
+    if profiler:
+        profiler.report()
+    if loader is not None:
+        loader.shutdown(cancel_futures=True)
+    pygame.quit()
+    sys.exit()
 
-pygame.quit()
-sys.exit()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+# Pieces both games use: the sprite cache, HUD number labels, the frame profiler
+# and the level file format. Each script imports what it needs from here, so this
+# file has to sit next to them.
+import collections
+import json
+import mmap
+import struct
+import time
+
+import pygame
+
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+
+class SpriteCache:
+    # Procedural looks rasterized once per variant, then drawn as single blits
+    def __init__(self):
+        self.sprites = {}
+
+    def get(self, key, size, origin, paint):
+        # paint(surface, x, y, key) draws the variant with its anchor at (x, y)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            surface = pygame.Surface(size, pygame.SRCALPHA)
+            paint(surface, origin[0], origin[1], key)
+            if pygame.display.get_surface():
+                surface = surface.convert_alpha()
+            sprite = self.sprites[key] = (surface, origin)
+        return sprite
+
+    def blit(self, screen, key, size, origin, paint, x, y):
+        surface, (ox, oy) = self.get(key, size, origin, paint)
+        return screen.blit(surface, (int(x) - ox, int(y) - oy))
+
+# HUD text cache
+class DigitAtlas:
+    # Number glyphs rendered once; numbers are drawn as a row of glyph blits
+    def __init__(self, font, color, chars="0123456789-"):
+        self.glyphs = {ch: font.render(ch, True, color) for ch in chars}
+
+class HudLabel:
+    # A caption plus a number, re-laid out only when either changes
+    def __init__(self, font, atlas, pos, anchor="left", color=WHITE):
+        self.font = font
+        self.atlas = atlas
+        self.pos = pos
+        self.anchor = anchor  # "left", "right" or "center" relative to pos
+        self.color = color
+        self.texts = {}
+        self.key = None
+        self.parts = []
+        self.rect = pygame.Rect(pos, (0, 0))
+
+    def text(self, text):
+        surface = self.texts.get(text)
+        if surface is None:
+            surface = self.texts[text] = self.font.render(text, True, self.color)
+        return surface
+
+    def layout(self, caption, value, suffix):
+        parts = []
+        x = 0
+        height = 0
+        pieces = [self.text(caption)] if caption else []
+        glyphs = self.atlas.glyphs
+        for ch in str(value):
+            pieces.append(glyphs.get(ch) or self.text(ch))
+        if suffix:
+            pieces.append(self.text(suffix))
+        for surface in pieces:
+            parts.append((surface, x))
+            x += surface.get_width()
+            height = max(height, surface.get_height())
+        left, top = self.pos
+        if self.anchor == "right":
+            left -= x
+        elif self.anchor == "center":
+            left -= x // 2
+        self.parts = parts
+        self.rect = pygame.Rect(left, top, x, height)
+
+    def draw(self, screen, caption, value, suffix=""):
+        key = (caption, value, suffix)
+        if key != self.key:
+            self.key = key
+            self.layout(caption, value, suffix)
+        left, top = self.rect.topleft
+        for surface, offset in self.parts:
+            screen.blit(surface, (left + offset, top))
+        return self.rect
+
+# Frame profiling
+PROFILE_WINDOW = 600  # Frames kept for the rolling frame-time percentiles
+TRACE_EVENT_LIMIT = 200000  # Newest trace events kept for --trace
+OVERLAY_REFRESH = 30  # Frames between redraws of the profile overlay text
+
+def percentile(ordered, p):
+    # Nearest-rank percentile of an already sorted sequence
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+class FrameProfiler:
+    # Splits each frame into named phases by lap times and counts collision tests.
+    # Games run without one unless profiling was asked for, so the hooks cost one check.
+    def __init__(self, trace_path=None, window=PROFILE_WINDOW):
+        self.clock = time.perf_counter
+        self.history = collections.deque(maxlen=window)  # (seconds, phases, counts) per frame
+        self.trace_path = trace_path
+        self.events = collections.deque(maxlen=TRACE_EVENT_LIMIT) if trace_path else None
+        self.origin = self.clock()
+        self.frame_start = self.last = self.origin
+        self.phases = {}
+        self.counts = {}
+        self.overlay = False
+        self.overlay_font = None
+        self.overlay_surface = None
+        self.overlay_age = OVERLAY_REFRESH
+
+    def begin_frame(self):
+        self.frame_start = self.last = self.clock()
+        self.phases = {}
+        self.counts = {}
+
+    def lap(self, phase):
+        # Charge the time since the previous lap, or the frame start, to phase
+        now = self.clock()
+        spent = now - self.last
+        self.phases[phase] = self.phases.get(phase, 0.0) + spent
+        if self.events is not None:
+            self.events.append((phase, self.last, spent))
+        self.last = now
+
+    def count(self, counter, n):
+        self.counts[counter] = self.counts.get(counter, 0) + n
+
+    def end_frame(self):
+        now = self.clock()
+        self.history.append((now - self.frame_start, self.phases, self.counts))
+        if self.events is not None:
+            self.events.append(("frame", self.frame_start, now - self.frame_start))
+            if self.counts:
+                self.events.append((None, now, self.counts))
+
+    def watch_grid(self, grid):
+        # Count the platforms a level's spatial grid hands out as collision candidates
+        if "query" in vars(grid):
+            return
+        query = grid.query
+
+        def counted(x, y, width, height):
+            found = query(x, y, width, height)
+            self.count("platform tests", len(found))
+            return found
+        grid.query = counted
+
+    def stats(self):
+        # Frame-time percentiles in ms, then mean ms per phase and mean count per counter
+        frames = sorted(seconds for seconds, _, _ in self.history)
+        n = len(frames) or 1
+        phases = {}
+        counts = {}
+        for _, spent, counted in self.history:
+            for phase, seconds in spent.items():
+                phases[phase] = phases.get(phase, 0.0) + seconds
+            for counter, value in counted.items():
+                counts[counter] = counts.get(counter, 0) + value
+        return {"frames": len(frames),
+                "p50": percentile(frames, 50) * 1000,
+                "p95": percentile(frames, 95) * 1000,
+                "p99": percentile(frames, 99) * 1000,
+                "phases": {phase: seconds / n * 1000 for phase, seconds in phases.items()},
+                "counters": {counter: value / n for counter, value in counts.items()}}
+
+    def summary(self):
+        stats = self.stats()
+        lines = ["frame ms  p50 %.2f  p95 %.2f  p99 %.2f  (%d frames)"
+                 % (stats["p50"], stats["p95"], stats["p99"], stats["frames"])]
+        for phase, ms in stats["phases"].items():
+            lines.append("  %-16s %7.3f ms" % (phase, ms))
+        for counter, value in stats["counters"].items():
+            lines.append("  %-16s %7.0f /frame" % (counter, value))
+        return lines
+
+    def draw_overlay(self, screen, pos):
+        # Summary text over the game, re-rendered every OVERLAY_REFRESH frames
+        self.overlay_age += 1
+        if self.overlay_surface is None or self.overlay_age >= OVERLAY_REFRESH:
+            if self.overlay_font is None:
+                self.overlay_font = pygame.font.SysFont(None, 18)
+            lines = [self.overlay_font.render(line, True, WHITE) for line in self.summary()]
+            width = max(line.get_width() for line in lines) + 8
+            height = sum(line.get_height() for line in lines) + 8
+            surface = pygame.Surface((width, height))
+            surface.fill(BLACK)
+            y = 4
+            for line in lines:
+                surface.blit(line, (4, y))
+                y += line.get_height()
+            surface.set_alpha(200)
+            self.overlay_surface = surface
+            self.overlay_age = 0
+        return screen.blit(self.overlay_surface, pos)
+
+    def report(self):
+        # Print the summary and write the trace, if one was asked for
+        print("\n".join(self.summary()))
+        if self.trace_path:
+            self.write_trace(self.trace_path)
+            print("trace written to %s" % self.trace_path)
+
+    def write_trace(self, path):
+        # Chrome trace-event JSON: phases as complete events, counters as counter events
+        events = []
+        for name, start, value in self.events:
+            ts = (start - self.origin) * 1e6
+            if name is None:
+                events.append({"name": "collision tests", "ph": "C", "ts": ts,
+                               "pid": 1, "tid": 1, "args": value})
+            else:
+                events.append({"name": name, "ph": "X", "ts": ts, "dur": value * 1e6,
+                               "pid": 1, "tid": 1})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+# Level files: a header, a chunk index, then fixed-size records grouped by chunk.
+# Chunks are LEVEL_CHUNK_WIDTH pixels wide; a platform spanning several chunks is
+# stored in each of them. Every record starts with its position in the level's
+# list so chunks built in any order still resolve collisions in level order.
+# Enemy and power-up types are indexes into each game's own type tuple.
+LEVEL_MAGIC = b"SMBL"
+LEVEL_VERSION = 1
+LEVEL_CHUNK_WIDTH = 256
+LEVEL_HEADER = struct.Struct("<4sHHIiiI")  # magic, version, chunk width, level width, flag x, y, chunks
+CHUNK_ENTRY = struct.Struct("<IHHHH")  # offset, platforms, enemies, coins, power-ups
+PLATFORM_RECORD = struct.Struct("<IiiHHB")  # id, x, y, width, height, breakable
+PLATFORM_SIZE_LIMIT = 0xFFFF  # Widest or tallest platform a record can hold
+ENEMY_RECORD = struct.Struct("<IiiB")  # id, x, y, type
+COIN_RECORD = struct.Struct("<Iii")  # id, x, y
+POWERUP_RECORD = struct.Struct("<IiiB")  # id, x, y, type
+RECORDS = (PLATFORM_RECORD, ENEMY_RECORD, COIN_RECORD, POWERUP_RECORD)
+
+class LevelFile:
+    # Memory-mapped level file; chunks are decoded only when asked for
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.chunk_width, self.width, flag_x, flag_y, count = \
+            LEVEL_HEADER.unpack_from(self.data)
+        if magic != LEVEL_MAGIC:
+            raise ValueError("%s is not a level file" % path)
+        if version != LEVEL_VERSION:
+            raise ValueError("%s has unsupported level format version %d" % (path, version))
+        self.flag_pos = (flag_x, flag_y) if flag_x >= 0 else None
+        self.index = [CHUNK_ENTRY.unpack_from(self.data, LEVEL_HEADER.size + i * CHUNK_ENTRY.size)
+                      for i in range(count)]
+
+    def chunks_between(self, left, right):
+        first = max(0, int(left) // self.chunk_width)
+        last = min(len(self.index) - 1, int(right) // self.chunk_width)
+        return range(first, last + 1)
+
+    def read_chunk(self, i):
+        # Lists of platform, enemy, coin and power-up record tuples
+        offset, *counts = self.index[i]
+        groups = []
+        for record, count in zip(RECORDS, counts):
+            groups.append([record.unpack_from(self.data, offset + k * record.size)
+                           for k in range(count)])
+            offset += count * record.size
+        return groups
+
+    def close(self):
+        self.data.close()
+
+def write_level_records(path, width, flag_pos, platforms, enemies, coins, powerups=(),
+                        chunk_width=LEVEL_CHUNK_WIDTH):
+    # Each list holds record fields after the id, in level order: platforms as
+    # (x, y, width, height, breakable), enemies and power-ups as (x, y, type), coins as (x, y)
+    for x, y, w, h, _ in platforms:
+        if w > PLATFORM_SIZE_LIMIT or h > PLATFORM_SIZE_LIMIT:
+            raise ValueError("%s would hold a %dx%d platform; level files hold platforms up to "
+                             "%d pixels across" % (path, w, h, PLATFORM_SIZE_LIMIT))
+    count = max(1, -(-width // chunk_width))
+    chunks = [([], [], [], []) for _ in range(count)]
+
+    def chunk_of(x):
+        return min(count - 1, max(0, int(x) // chunk_width))
+
+    for i, fields in enumerate(platforms):
+        x, w = fields[0], fields[2]
+        for c in range(chunk_of(x), chunk_of(x + w - 1) + 1):
+            chunks[c][0].append(PLATFORM_RECORD.pack(i, *fields))
+    for group, record, rows in ((1, ENEMY_RECORD, enemies), (2, COIN_RECORD, coins),
+                                (3, POWERUP_RECORD, powerups)):
+        for i, fields in enumerate(rows):
+            chunks[chunk_of(fields[0])][group].append(record.pack(i, *fields))
+
+    flag_x, flag_y = flag_pos or (-1, -1)
+    header = LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, chunk_width, width, flag_x, flag_y, count)
+    offset = len(header) + count * CHUNK_ENTRY.size
+    index = []
+    body = []
+    for groups in chunks:
+        index.append(CHUNK_ENTRY.pack(offset, *(len(g) for g in groups)))
+        for group in groups:
+            body.extend(group)
+            offset += sum(len(r) for r in group)
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(b"".join(index))
+        f.write(b"".join(body))
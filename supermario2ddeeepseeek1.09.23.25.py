@@ -2,6 +2,28 @@ import pygame
 import sys
 import math
 import random
+import json
+import time
+import argparse
+import os
+import struct
+import itertools
+import array
+import collections
+import multiprocessing
+import operator
+import select
+import signal
+import socket
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for the array-backed entity store
+    np = None
+
+from mario_common import (SpriteCache, DigitAtlas, HudLabel, FrameProfiler, LevelFile,
+                          write_level_records, LEVEL_CHUNK_WIDTH)
 
 # Initialize Pygame
 pygame.init()
@@ -9,7 +31,12 @@ pygame.init()
 # === UPDATED CONSTANTS ===
 SCREEN_WIDTH = 600
 SCREEN_HEIGHT = 400
-FPS = 60
+FPS = 60  # Simulation steps per second; physics constants are tuned per step
+MAX_FRAME_TIME = 0.25  # Longest real-time gap the fixed-step loop will catch up on
+LONG_LEVEL_SCREENS = 6  # Width in screens of the scrolling levels after level 3
+UPDATE_MARGIN = SCREEN_WIDTH  # Entities further than this outside the view are not simulated
+DRAW_MARGIN = 32  # Slack around the view for sprites drawn left of or above their anchor
+LOAD_MARGIN = UPDATE_MARGIN + 64  # File-backed levels build chunks this far outside the view
 
 # Colors
 SKY_BLUE = (107, 140, 255)
@@ -24,53 +51,165 @@ ORANGE = (255, 165, 0)
 BLUE = (0, 0, 255)
 PURPLE = (128, 0, 128)
 
+def slot_values(obj):
+    # Attribute values of a slotted entity, in __slots__ order
+    return [getattr(obj, name) for name in obj.__slots__]
+
+def set_slot_values(obj, values):
+    for name, value in zip(obj.__slots__, values):
+        setattr(obj, name, value)
+
+def lerp(a, b, t):
+    # Exact at t == 1 so uninterpolated draws land on the simulated position
+    return b if t >= 1 else a + (b - a) * t
+
+STAR_FRAMES = 32  # Spin-jump star positions cached per revolution
+FIREBALL_CAPACITY = 8  # Shots in flight at once; the fire cooldown keeps it to about five
+
+class Camera:
+    # Horizontal scroll over the level; x is the world-space left edge of the view
+    def __init__(self, level_width):
+        self.level_width = level_width
+        self.x = 0
+        self.prev_x = 0
+
+    def follow(self, target_x):
+        x = max(0, min(target_x - SCREEN_WIDTH // 2, self.level_width - SCREEN_WIDTH))
+        if abs(x - self.x) > SCREEN_WIDTH // 2:
+            # Respawns teleport the player; cut instead of panning across the level
+            self.prev_x = x
+        self.x = x
+
+    def snap(self, target_x):
+        self.follow(target_x)
+        self.prev_x = self.x
+
+    def offset(self, alpha=1.0):
+        # Whole-pixel scroll for a render between the last two steps
+        return int(lerp(self.prev_x, self.x, alpha))
+
+    def active_range(self):
+        # World-space x span of entities that are still simulated
+        return self.x - UPDATE_MARGIN, self.x + SCREEN_WIDTH + UPDATE_MARGIN
+
+sprite_cache = SpriteCache()
+
 class Fireball:
+    __slots__ = ("radius", "speed", "max_bounces", "rect", "x", "y", "direction",
+                 "bounce_count", "prev_x", "prev_y")
+
     def __init__(self, x, y, direction):
+        self.radius = 5
+        self.speed = 7
+        self.max_bounces = 3
+        self.rect = pygame.Rect(0, 0, self.radius * 2, self.radius * 2)
+        self.reset(x, y, direction)
+
+    def reset(self, x, y, direction):
+        # Relaunch this fireball; pooled fireballs are reused rather than reallocated
         self.x = x
         self.y = y
-        self.radius = 5
         self.direction = direction
-        self.speed = 7
         self.bounce_count = 0
-        self.max_bounces = 3
+        self.prev_x = x
+        self.prev_y = y
+        self.sync_rect()
 
-    def update(self, platforms):
+    def sync_rect(self):
+        self.rect.update(self.x - self.radius, self.y - self.radius,
+                         self.radius * 2, self.radius * 2)
+
+    def update(self, grid, view_x=0):
+        old_x, old_y = self.x, self.y
         self.x += self.speed * self.direction
         
         # Apply gravity
         self.y += 3
         
         # Check for platform collisions
-        fireball_rect = pygame.Rect(self.x - self.radius, self.y - self.radius, 
-                                   self.radius * 2, self.radius * 2)
-        for platform in platforms:
-            if platform.broken:
-                continue
-            plat_rect = pygame.Rect(platform.x, platform.y, platform.width, platform.height)
-            if fireball_rect.colliderect(plat_rect):
+        self.sync_rect()
+        left = min(old_x, self.x) - self.radius
+        top = min(old_y, self.y) - self.radius
+        for platform in grid.query(left, top, abs(self.x - old_x) + self.radius * 2,
+                                   abs(self.y - old_y) + self.radius * 2):
+            if self.rect.colliderect(platform.rect):
                 # Bounce off platform
                 self.y = platform.y - self.radius
                 self.bounce_count += 1
                 if self.bounce_count >= self.max_bounces:
                     return False
+        self.sync_rect()
         
-        # Check if out of bounds
-        if self.x < -20 or self.x > SCREEN_WIDTH + 20 or self.y > SCREEN_HEIGHT + 20:
+        # Check if out of view
+        if (self.x < view_x - 20 or self.x > view_x + SCREEN_WIDTH + 20
+                or self.y > SCREEN_HEIGHT + 20):
             return False
             
         return True
 
     def check_collision(self, enemy):
-        fireball_rect = pygame.Rect(self.x - self.radius, self.y - self.radius, 
-                                   self.radius * 2, self.radius * 2)
-        enemy_rect = pygame.Rect(enemy.x, enemy.y, enemy.width, enemy.height)
-        return fireball_rect.colliderect(enemy_rect)
+        return self.rect.colliderect(enemy.rect)
+
+    @staticmethod
+    def paint(surface, x, y, key):
+        radius = key[1]
+        pygame.draw.circle(surface, ORANGE, (x, y), radius)
+        pygame.draw.circle(surface, YELLOW, (x, y), radius - 2)
+
+    def draw(self, screen, alpha=1.0, camera_x=0):
+        x = lerp(self.prev_x, self.x, alpha)
+        y = lerp(self.prev_y, self.y, alpha)
+        r = self.radius
+        return sprite_cache.blit(screen, ("fireball", r), (r * 2 + 1, r * 2 + 1), (r, r),
+                                 self.paint, x - camera_x, y)
+
+class FireballPool:
+    # Fixed set of fireballs; the first count slots are in flight
+    def __init__(self, capacity=FIREBALL_CAPACITY):
+        self.slots = [Fireball(0, 0, 1) for _ in range(capacity)]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return itertools.islice(self.slots, self.count)
+
+    def spawn(self, x, y, direction):
+        # Returns None when every slot is in flight
+        if self.count == len(self.slots):
+            return None
+        fireball = self.slots[self.count]
+        fireball.reset(x, y, direction)
+        self.count += 1
+        return fireball
+
+    def update(self, grid, view_x):
+        # Step every fireball, packing survivors to the front without reordering them
+        slots = self.slots
+        kept = 0
+        for i in range(self.count):
+            fireball = slots[i]
+            if fireball.update(grid, view_x):
+                slots[i] = slots[kept]
+                slots[kept] = fireball
+                kept += 1
+        self.count = kept
 
-    def draw(self, screen):
-        pygame.draw.circle(screen, ORANGE, (int(self.x), int(self.y)), self.radius)
-        pygame.draw.circle(screen, YELLOW, (int(self.x), int(self.y)), self.radius - 2)
+    def release(self, fireball):
+        # Retire one fireball by swapping it with the last in flight. That one takes
+        # its slot out of firing order; only which of two fireballs touching the same
+        # enemy scores could tell.
+        slots = self.slots
+        i = slots.index(fireball, 0, self.count)
+        last = self.count - 1
+        slots[i] = slots[last]
+        slots[last] = fireball
+        self.count = last
 
 class Platform:
+    __slots__ = ("x", "y", "width", "height", "breakable", "broken", "rect")
+
     def __init__(self, x, y, width, height, breakable=False):
         self.x = x
         self.y = y
@@ -78,9 +217,9 @@ class Platform:
         self.height = height
         self.breakable = breakable
         self.broken = False
-        self.bounce_timer = 0
+        self.rect = pygame.Rect(x, y, width, height)
 
-    def draw(self, screen):
+    def draw(self, screen, camera_x=0):
         if self.broken:
             return
             
@@ -89,30 +228,42 @@ class Platform:
         else:
             color = GREEN
             
-        pygame.draw.rect(screen, color, (self.x, self.y, self.width, self.height))
-        pygame.draw.rect(screen, (100, 100, 100), (self.x, self.y, self.width, self.height), 1)
+        x = self.x - camera_x
+        right = x + self.width - 1
+        bottom = self.y + self.height - 1
+        pygame.draw.rect(screen, color, (x, self.y, self.width, self.height))
+        # Outline as lines: a rect outline hanging off the left of a chunk layer is
+        # drawn with an extra edge at x 0
+        pygame.draw.lines(screen, (100, 100, 100), True,
+                          [(x, self.y), (right, self.y), (right, bottom), (x, bottom)])
 
 class FlagPole:
+    __slots__ = ("x", "y", "height", "flag_raised")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
         self.height = 150
         self.flag_raised = False
 
-    def draw(self, screen):
+    def draw(self, screen, camera_x=0):
         # Draw pole
-        pygame.draw.rect(screen, GRAY, (self.x, self.y, 5, self.height))
+        x = self.x - camera_x
+        pygame.draw.rect(screen, GRAY, (x, self.y, 5, self.height))
         
         # Draw flag
         if not self.flag_raised:
             flag_color = RED
             pygame.draw.polygon(screen, flag_color, [
-                (self.x + 5, self.y + 10),
-                (self.x + 30, self.y + 20),
-                (self.x + 5, self.y + 30)
+                (x + 5, self.y + 10),
+                (x + 30, self.y + 20),
+                (x + 5, self.y + 30)
             ])
 
 class Enemy:
+    __slots__ = ("x", "y", "width", "height", "vel_x", "vel_y", "enemy_type", "alive",
+                 "bounce_timer", "direction", "prev_x", "prev_y", "rect")
+
     def __init__(self, x, y, enemy_type):
         self.x = x
         self.y = y
@@ -124,16 +275,25 @@ class Enemy:
         self.alive = True
         self.bounce_timer = 0
         self.direction = -1  # Start moving left
+        self.prev_x = x
+        self.prev_y = y
+        self.rect = pygame.Rect(x, y, self.width, self.height)
+
+    def sync_rect(self):
+        self.rect.update(self.x, self.y, self.width, self.height)
 
-    def update(self, platforms):
+    def update(self, grid, level_width=SCREEN_WIDTH):
         if not self.alive and self.bounce_timer > 0:
             self.bounce_timer -= 1
             self.y -= 2  # Bounce up when defeated
+            self.sync_rect()
             return True
             
         if not self.alive:
             return False
             
+        old_x, old_y = self.x, self.y
+
         # Move horizontally
         self.x += self.vel_x * self.direction
         
@@ -142,12 +302,11 @@ class Enemy:
         self.y += self.vel_y
         
         # Check platform collisions
-        enemy_rect = pygame.Rect(self.x, self.y, self.width, self.height)
-        for platform in platforms:
-            if platform.broken:
-                continue
-            plat_rect = pygame.Rect(platform.x, platform.y, platform.width, platform.height)
-            if enemy_rect.colliderect(plat_rect):
+        self.sync_rect()
+        for platform in grid.query(min(old_x, self.x), min(old_y, self.y),
+                                   abs(self.x - old_x) + self.width,
+                                   abs(self.y - old_y) + self.height):
+            if self.rect.colliderect(platform.rect):
                 if self.vel_y > 0:  # Falling
                     self.y = platform.y - self.height
                     self.vel_y = 0
@@ -159,36 +318,50 @@ class Enemy:
                 if self.x + self.width > platform.x + platform.width or self.x < platform.x:
                     self.direction *= -1
         
-        # Change direction at screen edges
-        if self.x <= 0 or self.x + self.width >= SCREEN_WIDTH:
+        # Change direction at level edges
+        if self.x <= 0 or self.x + self.width >= level_width:
             self.direction *= -1
-            
+
+        self.sync_rect()
         return True
 
-    def draw(self, screen):
-        if not self.alive and self.bounce_timer <= 0:
-            return
-            
-        if self.enemy_type == "goomba":
+    @staticmethod
+    def paint(surface, x, y, key):
+        _, enemy_type, alive, width, height = key
+        if enemy_type == "goomba":
             # Draw goomba body
             body_color = (150, 75, 0)  # Brown
-            pygame.draw.rect(screen, body_color, (self.x, self.y, self.width, self.height))
+            pygame.draw.rect(surface, body_color, (x, y, width, height))
             
             # Draw face
             eye_color = WHITE
-            pygame.draw.circle(screen, eye_color, (self.x + 4, self.y + 6), 2)
-            pygame.draw.circle(screen, eye_color, (self.x + 12, self.y + 6), 2)
+            pygame.draw.circle(surface, eye_color, (x + 4, y + 6), 2)
+            pygame.draw.circle(surface, eye_color, (x + 12, y + 6), 2)
             
-            if not self.alive:
+            if not alive:
                 # Squished goomba
-                pygame.draw.rect(screen, body_color, (self.x, self.y + 10, self.width, 4))
+                pygame.draw.rect(surface, body_color, (x, y + 10, width, 4))
+
+    def draw(self, screen, alpha=1.0, camera_x=0):
+        if not self.alive and self.bounce_timer <= 0:
+            return
+            
+        x = lerp(self.prev_x, self.x, alpha)
+        y = lerp(self.prev_y, self.y, alpha)
+        key = ("enemy", self.enemy_type, self.alive, self.width, self.height)
+        return sprite_cache.blit(screen, key, (self.width, self.height), (0, 0),
+                                 self.paint, x - camera_x, y)
 
 class Coin:
+    __slots__ = ("x", "y", "radius", "collected", "rect", "bounce_offset", "bounce_direction")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
         self.radius = 6
         self.collected = False
+        self.rect = pygame.Rect(x - self.radius, y - self.radius,
+                                self.radius * 2, self.radius * 2)
         self.bounce_offset = 0
         self.bounce_direction = 1
 
@@ -199,16 +372,22 @@ class Coin:
             if abs(self.bounce_offset) > 3:
                 self.bounce_direction *= -1
 
-    def draw(self, screen):
+    @staticmethod
+    def paint(surface, x, y, key):
+        radius = key[1]
+        pygame.draw.circle(surface, YELLOW, (x, y), radius)
+        pygame.draw.circle(surface, (200, 200, 0), (x, y), radius - 2)
+
+    def draw(self, screen, camera_x=0):
         if not self.collected:
-            pygame.draw.circle(screen, YELLOW, 
-                              (int(self.x), int(self.y + self.bounce_offset)), 
-                              self.radius)
-            pygame.draw.circle(screen, (200, 200, 0), 
-                              (int(self.x), int(self.y + self.bounce_offset)), 
-                              self.radius - 2)
+            r = self.radius
+            return sprite_cache.blit(screen, ("coin", r), (r * 2 + 1, r * 2 + 1), (r, r),
+                                     self.paint, self.x - camera_x, self.y + self.bounce_offset)
 
 class PowerUp:
+    __slots__ = ("x", "y", "width", "height", "power_type", "collected", "rect",
+                 "bounce_offset", "bounce_direction")
+
     def __init__(self, x, y, power_type):
         self.x = x
         self.y = y
@@ -216,6 +395,7 @@ class PowerUp:
         self.height = 16
         self.power_type = power_type
         self.collected = False
+        self.rect = pygame.Rect(x, y, self.width, self.height)
         self.bounce_offset = 0
         self.bounce_direction = 1
 
@@ -226,24 +406,35 @@ class PowerUp:
             if abs(self.bounce_offset) > 2:
                 self.bounce_direction *= -1
 
-    def draw(self, screen):
+    @staticmethod
+    def paint(surface, x, y, key):
+        _, power_type, width, height = key
+        if power_type == "mushroom":
+            # Red mushroom
+            pygame.draw.rect(surface, RED, (x, y, width, height))
+            pygame.draw.rect(surface, WHITE, (x, y, width, 4))
+        elif power_type == "fire_flower":
+            # Fire flower
+            pygame.draw.rect(surface, (255, 100, 100), (x, y, width, height))
+            for i in range(4):
+                angle = i * math.pi / 2
+                px = x + width/2 + math.cos(angle) * 4
+                py = y + height/2 + math.sin(angle) * 4
+                pygame.draw.circle(surface, YELLOW, (int(px), int(py)), 3)
+
+    def draw(self, screen, camera_x=0):
         if not self.collected:
-            y_pos = self.y + self.bounce_offset
-            
-            if self.power_type == "mushroom":
-                # Red mushroom
-                pygame.draw.rect(screen, RED, (self.x, y_pos, self.width, self.height))
-                pygame.draw.rect(screen, WHITE, (self.x, y_pos, self.width, 4))
-            elif self.power_type == "fire_flower":
-                # Fire flower
-                pygame.draw.rect(screen, (255, 100, 100), (self.x, y_pos, self.width, self.height))
-                for i in range(4):
-                    angle = i * math.pi / 2
-                    px = self.x + self.width/2 + math.cos(angle) * 4
-                    py = y_pos + self.height/2 + math.sin(angle) * 4
-                    pygame.draw.circle(screen, YELLOW, (int(px), int(py)), 3)
+            key = ("powerup", self.power_type, self.width, self.height)
+            return sprite_cache.blit(screen, key, (self.width, self.height), (0, 0),
+                                     self.paint, self.x - camera_x, self.y + self.bounce_offset)
 
 class Player:
+    __slots__ = ("x", "y", "width", "height", "vel_x", "vel_y", "jump_power", "gravity",
+                 "speed", "on_ground", "direction", "power_level", "spin_jumping",
+                 "spin_jump_timer", "invulnerable", "invulnerable_timer", "lives", "coins",
+                 "score", "crouching", "fireballs", "fireball_cooldown", "prev_x",
+                 "prev_y", "rect", "respawns", "color")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -254,10 +445,8 @@ class Player:
         self.jump_power = -8.5
         self.gravity = 0.4
         self.speed = 2
-        self.run_speed = 3.5
         self.on_ground = False
         self.direction = 1
-        self.color = RED
         self.power_level = 0
         self.spin_jumping = False
         self.spin_jump_timer = 0
@@ -267,11 +456,18 @@ class Player:
         self.coins = 0
         self.score = 0
         self.crouching = False
-        self.carrying_item = None
-        self.fireballs = []
+        self.fireballs = FireballPool()
         self.fireball_cooldown = 0
+        self.prev_x = x
+        self.prev_y = y
+        self.rect = pygame.Rect(x, y, self.width, self.height)
+        self.respawns = 0  # Deaths, falls and level restarts so far
+        self.color = RED
+
+    def sync_rect(self):
+        self.rect.update(self.x, self.y, self.width, self.height)
 
-    def update(self, platforms, enemies, coins, powerups):
+    def update(self, grid, level_width=SCREEN_WIDTH, view_x=0):
         # Apply gravity
         self.vel_y += self.gravity
 
@@ -280,12 +476,10 @@ class Player:
 
         # Move horizontally first
         self.x += self.vel_x
-        player_rect = pygame.Rect(self.x, self.y, self.width, self.height)
-        for platform in platforms:
-            if platform.broken:
-                continue
-            plat_rect = pygame.Rect(platform.x, platform.y, platform.width, platform.height)
-            if player_rect.colliderect(plat_rect):
+        self.sync_rect()
+        for platform in grid.query(min(orig_x, self.x), self.y,
+                                   abs(self.x - orig_x) + self.width, self.height):
+            if self.rect.colliderect(platform.rect):
                 if self.vel_x > 0:  # Moving right
                     self.x = platform.x - self.width
                 elif self.vel_x < 0:  # Moving left
@@ -296,12 +490,10 @@ class Player:
         self.y += self.vel_y
         self.on_ground = False
 
-        player_rect = pygame.Rect(self.x, self.y, self.width, self.height)
-        for platform in platforms:
-            if platform.broken:
-                continue
-            plat_rect = pygame.Rect(platform.x, platform.y, platform.width, platform.height)
-            if player_rect.colliderect(plat_rect):
+        self.sync_rect()
+        for platform in grid.query(self.x, min(orig_y, self.y),
+                                   self.width, abs(self.y - orig_y) + self.height):
+            if self.rect.colliderect(platform.rect):
                 if self.vel_y > 0:  # Falling
                     self.y = platform.y - self.height
                     self.vel_y = 0
@@ -318,23 +510,14 @@ class Player:
             if self.spin_jump_timer == 0:
                 self.spin_jumping = False
 
-        for fireball in self.fireballs[:]:
-            if not fireball.update(platforms):
-                self.fireballs.remove(fireball)
-            else:
-                for enemy in enemies:
-                    if enemy.alive and fireball.check_collision(enemy):
-                        enemy.alive = False
-                        enemy.bounce_timer = 20
-                        self.score += 100
-                        self.fireballs.remove(fireball)
-                        break
+        # Fireball hits on enemies are resolved by Game.resolve_fireball_hits
+        self.fireballs.update(grid, view_x)
 
-        # Screen boundaries
+        # Level boundaries
         if self.x < 0:
             self.x = 0
-        if self.x > SCREEN_WIDTH - self.width:
-            self.x = SCREEN_WIDTH - self.width
+        if self.x > level_width - self.width:
+            self.x = level_width - self.width
         if self.y > SCREEN_HEIGHT:
             self.respawn()
 
@@ -344,6 +527,8 @@ class Player:
             if self.invulnerable_timer <= 0:
                 self.invulnerable = False
 
+        self.sync_rect()
+
     def jump(self):
         if self.on_ground:
             self.vel_y = self.jump_power
@@ -358,11 +543,11 @@ class Player:
 
     def shoot_fireball(self):
         if self.power_level == 2 and self.fireball_cooldown == 0:
-            self.fireballs.append(Fireball(
+            self.fireballs.spawn(
                 self.x + self.width // 2,
                 self.y + self.height // 2,
                 self.direction
-            ))
+            )
             self.fireball_cooldown = 20
 
     def take_damage(self):
@@ -390,7 +575,11 @@ class Player:
         self.vel_y = 0
         self.invulnerable = True
         self.invulnerable_timer = 120
-        self.carrying_item = None
+        self.respawns += 1
+        # Don't interpolate across the teleport
+        self.prev_x = self.x
+        self.prev_y = self.y
+        self.sync_rect()
 
     def game_over(self):
         self.lives = 3
@@ -400,47 +589,656 @@ class Player:
         self.height = 32
         self.respawn()
 
-    def draw(self, screen):
-        if self.invulnerable and pygame.time.get_ticks() % 200 < 100:
-            return
+    def save_position(self):
+        # Snapshot positions before a simulation step for render interpolation
+        self.prev_x = self.x
+        self.prev_y = self.y
+        for fireball in self.fireballs:
+            fireball.prev_x = fireball.x
+            fireball.prev_y = fireball.y
 
-        body_color = RED if self.power_level == 0 else (BLUE if self.power_level == 2 else RED)
-        body_height = self.height // 2 if self.crouching else self.height
-        body_y = self.y + self.height // 2 if self.crouching else self.y
-        pygame.draw.rect(screen, body_color, (self.x, body_y, self.width, body_height))
+    @staticmethod
+    def paint(surface, x, y, key):
+        _, power_level, crouching, direction, width, height, color = key
+        body_color = BLUE if power_level == 2 else color
+        body_height = height // 2 if crouching else height
+        body_y = y + height // 2 if crouching else y
+        pygame.draw.rect(surface, body_color, (x, body_y, width, body_height))
 
-        face_y = body_y + 8 if self.crouching else self.y + 8
-        pygame.draw.circle(screen, (255, 200, 150),
-                          (self.x + self.width // 2 + self.direction * 3, face_y), 6)
+        face_y = body_y + 8 if crouching else y + 8
+        pygame.draw.circle(surface, (255, 200, 150), (x + width // 2 + direction * 3, face_y), 6)
 
-        hat_y = body_y if self.crouching else self.y
-        pygame.draw.rect(screen, RED, (self.x - 3, hat_y, self.width + 6, 6))
+        hat_y = body_y if crouching else y
+        pygame.draw.rect(surface, color, (x - 3, hat_y, width + 6, 6))
+
+    @staticmethod
+    def paint_stars(surface, x, y, key):
+        base = key[1] * 2 * math.pi / STAR_FRAMES
+        for i in range(3):
+            angle = base + i * 2
+            radius = 12
+            star_x = x + math.cos(angle) * radius
+            star_y = y + math.sin(angle) * radius
+            pygame.draw.circle(surface, YELLOW, (int(star_x), int(star_y)), 3)
+
+    def draw(self, screen, alpha=1.0, dirty=None, camera_x=0):
+        # Appends the screen areas touched to dirty when given
+        if self.invulnerable and pygame.time.get_ticks() % 200 < 100:
+            return
+
+        x = lerp(self.prev_x, self.x, alpha) - camera_x
+        y = lerp(self.prev_y, self.y, alpha)
+        key = ("player", self.power_level, self.crouching, self.direction, self.width, self.height,
+               self.color)
+        area = sprite_cache.blit(screen, key, (self.width + 6, self.height), (3, 0),
+                                 self.paint, x, y)
 
         if self.spin_jumping:
-            for i in range(3):
-                angle = pygame.time.get_ticks() / 100 + i * 2
-                radius = 12
-                star_x = self.x + self.width // 2 + math.cos(angle) * radius
-                star_y = self.y + self.height // 2 + math.sin(angle) * radius
-                pygame.draw.circle(screen, YELLOW, (int(star_x), int(star_y)), 3)
+            # Stars orbit the player; the orbit angle is quantized to cached frames
+            turn = (pygame.time.get_ticks() / 100) / (2 * math.pi)
+            frame = int(turn * STAR_FRAMES) % STAR_FRAMES
+            area.union_ip(sprite_cache.blit(screen, ("spin_stars", frame), (31, 31), (15, 15),
+                                            self.paint_stars, x + self.width // 2,
+                                            y + self.height // 2))
 
+        if dirty is not None:
+            dirty.append(area)
         for fireball in self.fireballs:
-            fireball.draw(screen)
+            area = fireball.draw(screen, alpha, camera_x)
+            if dirty is not None:
+                dirty.append(area)
+
+class SpatialGrid:
+    # Uniform grid over the level so collision checks only visit nearby platforms
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.order = {}
+        self.top = math.inf  # Vertical extent of every platform inserted so far
+        self.bottom = -math.inf
+
+    def cell_range(self, x, y, width, height):
+        size = self.cell_size
+        return (int(x // size), int((x + width - 1) // size),
+                int(y // size), int((y + height - 1) // size))
+
+    def insert(self, platform, order=None):
+        # Remember insertion order so queries resolve collisions in level order;
+        # streamed levels pass each platform's position in the level instead
+        ranks = self.order
+        ranks.setdefault(platform, len(ranks) if order is None else order)
+        self.top = min(self.top, platform.y)
+        self.bottom = max(self.bottom, platform.y + platform.height)
+        x0, x1, y0, y1 = self.cell_range(platform.x, platform.y, platform.width, platform.height)
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                cell = self.cells.setdefault((cx, cy), [])
+                cell.append(platform)
+                if len(cell) > 1 and ranks[cell[-2]] > ranks[platform]:
+                    # Re-inserted or streamed out of order; keep cells in level order
+                    cell.sort(key=ranks.__getitem__)
+
+    def remove(self, platform):
+        self.order.pop(platform, None)
+        x0, x1, y0, y1 = self.cell_range(platform.x, platform.y, platform.width, platform.height)
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                cell = self.cells.get((cx, cy))
+                if cell and platform in cell:
+                    cell.remove(platform)
+                    if not cell:
+                        del self.cells[(cx, cy)]
+
+    def query(self, x, y, width, height):
+        x0, x1, y0, y1 = self.cell_range(x, y, width, height)
+        cells = self.cells
+        if x0 == x1 and y0 == y1:
+            return cells.get((x0, y0), ())
+        found = set()
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                cell = cells.get((cx, cy))
+                if cell:
+                    found.update(cell)
+        if len(found) < 2:
+            return found
+        return sorted(found, key=self.order.__getitem__)
+
+class EntityStore:
+    # Struct-of-arrays storage for coins, power-ups and enemies, updated in NumPy batches.
+    # Mirrors Coin, PowerUp and Enemy behaviour exactly; the objects are only used to build it.
+    def __init__(self, coins, powerups, enemies):
+        if np is None:
+            raise ImportError("EntityStore requires NumPy")
+
+        # Coins
+        self.coin_x = np.array([c.x for c in coins], dtype=float)
+        self.coin_y = np.array([c.y for c in coins], dtype=float)
+        self.coin_radius = [c.radius for c in coins]
+        self.coin_offset = np.array([c.bounce_offset for c in coins], dtype=float)
+        self.coin_dir = np.array([c.bounce_direction for c in coins], dtype=float)
+        self.coin_live = np.array([not c.collected for c in coins], dtype=bool)
+        self.coin_bounds = self.bounds([c.rect for c in coins])
+
+        # Power-ups
+        self.powerup_x = np.array([p.x for p in powerups], dtype=float)
+        self.powerup_y = np.array([p.y for p in powerups], dtype=float)
+        self.powerup_size = [(p.width, p.height) for p in powerups]
+        self.powerup_type = [p.power_type for p in powerups]
+        self.powerup_offset = np.array([p.bounce_offset for p in powerups], dtype=float)
+        self.powerup_dir = np.array([p.bounce_direction for p in powerups], dtype=float)
+        self.powerup_live = np.array([not p.collected for p in powerups], dtype=bool)
+        self.powerup_bounds = self.bounds([p.rect for p in powerups])
+
+        # Enemies
+        self.enemy_x = np.array([e.x for e in enemies], dtype=float)
+        self.enemy_y = np.array([e.y for e in enemies], dtype=float)
+        self.enemy_prev_x = self.enemy_x.copy()
+        self.enemy_prev_y = self.enemy_y.copy()
+        self.enemy_vel_x = np.array([e.vel_x for e in enemies], dtype=float)
+        self.enemy_vel_y = np.array([e.vel_y for e in enemies], dtype=float)
+        self.enemy_dir = np.array([e.direction for e in enemies], dtype=float)
+        self.enemy_width = np.array([e.width for e in enemies], dtype=int)
+        self.enemy_height = np.array([e.height for e in enemies], dtype=int)
+        self.enemy_type = [e.enemy_type for e in enemies]
+        self.enemy_alive = np.array([e.alive for e in enemies], dtype=bool)
+        self.enemy_timer = np.array([e.bounce_timer for e in enemies], dtype=int)
+        self.enemy_present = np.ones(len(enemies), dtype=bool)
+        # Starting columns, copied back in bulk by reset
+        self.initial = {name: column.copy() for name, column in vars(self).items()
+                        if isinstance(column, np.ndarray)}
+
+    def extend(self, coins, powerups, enemies):
+        # Append entities from a newly built part of the level
+        other = EntityStore(coins, powerups, enemies)
+        for name, column in vars(other).items():
+            if isinstance(column, list):
+                getattr(self, name).extend(column)
+            elif isinstance(column, np.ndarray):
+                setattr(self, name, np.concatenate((getattr(self, name), column), axis=-1))
+        for name, column in other.initial.items():
+            self.initial[name] = np.concatenate((self.initial[name], column), axis=-1)
+
+    def reset(self):
+        for name, column in self.initial.items():
+            np.copyto(getattr(self, name), column)
+
+    def select(self, coins, powerups, enemies):
+        # Keep only the given rows of each kind, in the given order
+        rows = {"coin": coins, "powerup": powerups, "enemy": enemies}
+        for columns in (vars(self), self.initial):
+            for name, column in list(columns.items()):
+                kept = rows.get(name.split("_")[0])
+                if kept is None:
+                    continue
+                if isinstance(column, np.ndarray):
+                    columns[name] = column[..., kept]
+                elif isinstance(column, list):
+                    columns[name] = [column[i] for i in kept]
+
+    def gone(self):
+        # Rows of coins, power-ups and enemies already collected or defeated
+        return (~self.coin_live, ~self.powerup_live, ~(self.enemy_present & self.enemy_alive))
+
+    @staticmethod
+    def bounds(rects):
+        # Columns of left, top, right, bottom
+        return np.array([(r.left, r.top, r.right, r.bottom) for r in rects],
+                        dtype=int).reshape(-1, 4).T.copy()
+
+    @staticmethod
+    def overlapping(bounds, rect):
+        # Same test as pygame.Rect.colliderect for every row at once
+        left, top, right, bottom = bounds
+        return ((left < rect.right) & (rect.left < right) &
+                (top < rect.bottom) & (rect.top < bottom))
+
+    def enemy_bounds(self):
+        left = self.enemy_x.astype(int)
+        top = self.enemy_y.astype(int)
+        return left, top, left + self.enemy_width, top + self.enemy_height
+
+    def coin_count(self):
+        return int(np.count_nonzero(self.coin_live))
+
+    def enemy_count(self):
+        return int(np.count_nonzero(self.enemy_present))
+
+    def update(self, grid, level_width=SCREEN_WIDTH, active=(-math.inf, math.inf)):
+        # Only entities whose x lies in the active range are simulated
+        lo, hi = active
+        # Bouncing animation for pickups
+        live = self.coin_live & (self.coin_x >= lo) & (self.coin_x <= hi)
+        self.coin_offset += 0.1 * self.coin_dir * live
+        self.coin_dir[live & (np.abs(self.coin_offset) > 3)] *= -1
+        live = self.powerup_live & (self.powerup_x >= lo) & (self.powerup_x <= hi)
+        self.powerup_offset += 0.05 * self.powerup_dir * live
+        self.powerup_dir[live & (np.abs(self.powerup_offset) > 2)] *= -1
+        self.update_enemies(grid, level_width, lo, hi)
+
+    def update_enemies(self, grid, level_width, lo, hi):
+        present = self.enemy_present
+        active = present & (self.enemy_x >= lo) & (self.enemy_x <= hi)
+        alive = self.enemy_alive
+        timer = self.enemy_timer
+
+        # Defeated enemies bounce up until their timer runs out, then disappear
+        dead = active & ~alive
+        present[dead & (timer <= 0)] = False
+        bouncing = dead & (timer > 0)
+        timer[bouncing] -= 1
+        self.enemy_y[bouncing] -= 2
+
+        # Move horizontally and apply gravity
+        moving = active & alive
+        self.enemy_x += self.enemy_vel_x * self.enemy_dir * moving
+        self.enemy_vel_y += 0.4 * moving
+        self.enemy_y += self.enemy_vel_y * moving
+
+        # Platform collisions for every moving enemy at once, against the platforms
+        # the grid has around them. An enemy lands on (or bumps into) the first platform
+        # it overlaps in level order, and turns around once for each overlapped
+        # platform it hangs over the edge of, as Enemy.update does one at a time.
+        index = np.flatnonzero(moving)
+        if len(index):
+            x = self.enemy_x[index]
+            y = self.enemy_y[index]
+            width = self.enemy_width[index]
+            height = self.enemy_height[index]
+            left = x.astype(int)
+            top = y.astype(int)
+            right = left + width
+            bottom = top + height
+            # Enemies that fell out of the level would stretch the query over empty rows
+            x0 = int(left.min())
+            y0 = max(int(top.min()), grid.top)
+            y1 = min(int(bottom.max()), grid.bottom)
+            platforms = list(grid.query(x0, y0, int(right.max()) - x0, y1 - y0)) if y1 > y0 else []
+            if platforms:
+                p_left, p_top, p_right, p_bottom = self.bounds([p.rect for p in platforms])
+                hit = ((left[:, None] < p_right) & (p_left < right[:, None]) &
+                       (top[:, None] < p_bottom) & (p_top < bottom[:, None]))
+                first = hit.argmax(axis=1)
+                vel_y = self.enemy_vel_y[index]
+                landed = hit.any(axis=1)
+                falling = landed & (vel_y > 0)
+                rising = landed & (vel_y < 0)
+                y[falling] = (p_top[first] - height)[falling]
+                y[rising] = p_bottom[first][rising]
+                vel_y[falling | rising] = 0
+                over_edge = (x[:, None] + width[:, None] > p_right) | (x[:, None] < p_left)
+                turns = np.count_nonzero(hit & over_edge, axis=1) % 2 == 1
+                self.enemy_y[index] = y
+                self.enemy_vel_y[index] = vel_y
+                self.enemy_dir[index[turns]] *= -1
+
+        # Change direction at level edges
+        x = self.enemy_x
+        self.enemy_dir[moving & ((x <= 0) | (x + self.enemy_width >= level_width))] *= -1
+
+    def take_coins(self, rect):
+        # Collects every coin touching rect; returns how many
+        hit = self.coin_live & self.overlapping(self.coin_bounds, rect)
+        self.coin_live[hit] = False
+        return int(np.count_nonzero(hit))
+
+    def take_powerups(self, rect):
+        # Collects every power-up touching rect; returns their types in level order
+        hit = self.powerup_live & self.overlapping(self.powerup_bounds, rect)
+        self.powerup_live[hit] = False
+        return [self.powerup_type[i] for i in np.flatnonzero(hit).tolist()]
+
+    def enemies_touching(self, rect):
+        # Indices and top edges of living enemies touching rect, in level order
+        left, top, right, bottom = self.enemy_bounds()
+        hit = (self.enemy_present & self.enemy_alive &
+               self.overlapping((left, top, right, bottom), rect))
+        index = np.flatnonzero(hit)
+        return zip(index.tolist(), top[index].tolist())
+
+    def defeat_enemy(self, i):
+        self.enemy_alive[i] = False
+        self.enemy_timer[i] = 20
+
+    def save_positions(self):
+        np.copyto(self.enemy_prev_x, self.enemy_x)
+        np.copyto(self.enemy_prev_y, self.enemy_y)
+
+    def draw(self, screen, alpha, dirty, camera_x=0):
+        blit = sprite_cache.blit
+        lo = camera_x - DRAW_MARGIN
+        hi = camera_x + SCREEN_WIDTH + DRAW_MARGIN
+        xs = (self.coin_x - camera_x).tolist()
+        ys = (self.coin_y + self.coin_offset).tolist()
+        shown = self.coin_live & (self.coin_x >= lo) & (self.coin_x <= hi)
+        for i in np.flatnonzero(shown).tolist():
+            r = self.coin_radius[i]
+            dirty.append(blit(screen, ("coin", r), (r * 2 + 1, r * 2 + 1), (r, r),
+                              Coin.paint, xs[i], ys[i]))
+
+        xs = (self.powerup_x - camera_x).tolist()
+        ys = (self.powerup_y + self.powerup_offset).tolist()
+        shown = self.powerup_live & (self.powerup_x >= lo) & (self.powerup_x <= hi)
+        for i in np.flatnonzero(shown).tolist():
+            width, height = self.powerup_size[i]
+            key = ("powerup", self.powerup_type[i], width, height)
+            dirty.append(blit(screen, key, (width, height), (0, 0), PowerUp.paint, xs[i], ys[i]))
+
+        if alpha >= 1:
+            xs = (self.enemy_x - camera_x).tolist()
+            ys = self.enemy_y.tolist()
+        else:
+            xs = (self.enemy_prev_x + (self.enemy_x - self.enemy_prev_x) * alpha - camera_x).tolist()
+            ys = (self.enemy_prev_y + (self.enemy_y - self.enemy_prev_y) * alpha).tolist()
+        alive = self.enemy_alive.tolist()
+        visible = (self.enemy_present & (self.enemy_alive | (self.enemy_timer > 0)) &
+                   (self.enemy_x >= lo) & (self.enemy_x <= hi))
+        for i in np.flatnonzero(visible).tolist():
+            width = int(self.enemy_width[i])
+            height = int(self.enemy_height[i])
+            key = ("enemy", self.enemy_type[i], alive[i], width, height)
+            dirty.append(blit(screen, key, (width, height), (0, 0), Enemy.paint, xs[i], ys[i]))
+
+# Level files; the format is in mario_common
+LEVEL_FILE_NAME = "level%d.lvl"
+BUILTIN_LEVELS = 4  # Levels past 3 all share the default layout
+ENEMY_TYPES = ("goomba",)
+POWERUP_TYPES = ("mushroom", "fire_flower")
+
+def write_level_file(level, path, chunk_width=LEVEL_CHUNK_WIDTH):
+    # Save a level built in code, before any of it is broken or collected
+    flag = level.flag_pole
+    write_level_records(path, level.width, flag and (flag.x, flag.y),
+                        [(p.x, p.y, p.width, p.height, p.breakable) for p in level.platforms],
+                        [(e.x, e.y, ENEMY_TYPES.index(e.enemy_type)) for e in level.enemies],
+                        [(c.x, c.y) for c in level.coins],
+                        [(p.x, p.y, POWERUP_TYPES.index(p.power_type)) for p in level.powerups],
+                        chunk_width)
 
 class Level:
-    def __init__(self, level_num, world_num):
+    def __init__(self, level_num, world_num, array_store=False, source=None):
         self.level_num = level_num
         self.world_num = world_num
+        self.width = SCREEN_WIDTH  # Levels after 3 scroll over several screens
         self.platforms = []
         self.enemies = []
         self.coins = []
         self.powerups = []
         self.flag_pole = None
-        self.setup_level()
+        self.grid = SpatialGrid()
+        self.repainted = []  # Static layer areas changed since the last presented frame
+        self.broken = {}  # Grid rank (platform id in a level file) -> platform broken since reset
+        self.store = None
+        self.template = ([], [], [])  # (entity, starting attributes) for enemies, coins, power-ups
+        # A file-backed level holds only the chunks around the view. Each built chunk
+        # keeps its platform ids, entity record ids per kind and (entity, starting
+        # attributes) entries, and a baked part of the static layer. Entities that were
+        # collected or defeated when their chunk was dropped stay out when it is rebuilt.
+        self.source = source  # LevelFile to build chunks from as the camera nears them
+        self.chunks = {}
+        self.layers = {}
+        self.taken = {}  # Chunk -> frozenset of (kind, record id), kinds in template order
+        self.platform_refs = {}  # Platform id -> [platform, built chunks holding it]
+        if source is None:
+            self.setup_level()
+            if not array_store:
+                self.remember_initial(self.enemies, self.coins, self.powerups)
+        else:
+            self.width = source.width
+            if source.flag_pos:
+                self.flag_pole = FlagPole(*source.flag_pos)
+        if array_store:
+            # Coins, power-ups and enemies move into NumPy columns
+            self.store = EntityStore(self.coins, self.powerups, self.enemies)
+            self.coins = []
+            self.powerups = []
+            self.enemies = []
+        if source is None:
+            self.static_layer = self.new_layer(self.width)
+            self.paint_static(self.static_layer, 0, self.platforms)
+        else:
+            self.stream(0)
+
+    @staticmethod
+    def new_layer(width):
+        layer = pygame.Surface((width, SCREEN_HEIGHT))
+        if pygame.display.get_surface():
+            layer = layer.convert()
+        return layer
+
+    def paint_static(self, layer, left, platforms):
+        # Bake sky, platforms and flag pole onto a layer whose left edge is at level x left
+        layer.fill(SKY_BLUE)
+        for platform in platforms:
+            platform.draw(layer, left)
+        if self.flag_pole:
+            self.flag_pole.draw(layer, left)
+
+    def repaint(self, area):
+        # Paint the static layer again under area, a rectangle in level coordinates
+        if self.source is None:
+            layers = [(self.static_layer, 0)]
+        else:
+            width = self.source.chunk_width
+            layers = [(self.layers[i], i * width)
+                      for i in self.source.chunks_between(area.left, area.right - 1)
+                      if i in self.layers]
+        platforms = self.grid.query(area.x, area.y, area.width, area.height)
+        for layer, left in layers:
+            layer.set_clip(area.move(-left, 0))
+            self.paint_static(layer, left, platforms)
+            layer.set_clip(None)
+        self.repainted.append(pygame.Rect(area))
+
+    def break_platform(self, platform):
+        # Take a platform out of collisions and clear it from the static layer,
+        # repainting only the area it covered
+        if platform.broken:
+            return
+        platform.broken = True
+        self.broken[self.grid.order[platform]] = platform
+        self.grid.remove(platform)
+        self.repaint(platform.rect)
+
+    def blit_static(self, screen, area, offset):
+        # Copy the static layer under area, a screen rectangle, for the view at offset
+        if self.source is None:
+            screen.blit(self.static_layer, area, area.move(offset, 0))
+            return
+        width = self.source.chunk_width
+        for i in self.source.chunks_between(area.x + offset, area.right + offset - 1):
+            layer = self.layers.get(i)
+            if layer is not None:
+                part = area.clip(i * width - offset, 0, width, SCREEN_HEIGHT)
+                screen.blit(layer, part, part.move(offset - i * width, 0))
+
+    def stream(self, view_x):
+        # Build the chunks of a file-backed level that come within reach of the view, and
+        # drop the ones more than a chunk beyond that so a view on the edge keeps them
+        source = self.source
+        if source is None:
+            return
+        margin = LOAD_MARGIN + source.chunk_width
+        kept = source.chunks_between(view_x - margin, view_x + SCREEN_WIDTH + margin)
+        dropped = [i for i in self.chunks if i not in kept]
+        if dropped:
+            self.unload(dropped)
+        wanted = [i for i in source.chunks_between(view_x - LOAD_MARGIN,
+                                                   view_x + SCREEN_WIDTH + LOAD_MARGIN)
+                  if i not in self.chunks]
+        if wanted:
+            self.load(wanted)
+
+    def load(self, indices):
+        source = self.source
+        built = ([], [], [])
+        for i in sorted(indices):
+            platforms, enemies, coins, powerups = source.read_chunk(i)
+            pids = []
+            for pid, x, y, width, height, breakable in platforms:
+                ref = self.platform_refs.get(pid)
+                if ref is None:
+                    platform = Platform(x, y, width, height, breakable=bool(breakable))
+                    ref = self.platform_refs[pid] = [platform, 0]
+                    self.platforms.append(platform)
+                    if pid in self.broken:
+                        # Broken before its chunks were dropped; it stays broken
+                        platform.broken = True
+                    else:
+                        self.grid.insert(platform, pid)
+                ref[1] += 1
+                pids.append(pid)
+
+            taken = self.taken.get(i, ())
+            enemies, coins, powerups = ([r for r in sorted(records) if (kind, r[0]) not in taken]
+                                        for kind, records in enumerate((enemies, coins, powerups)))
+            objects = ([Enemy(x, y, ENEMY_TYPES[t]) for _, x, y, t in enemies],
+                       [Coin(x, y) for _, x, y in coins],
+                       [PowerUp(x, y, POWERUP_TYPES[t]) for _, x, y, t in powerups])
+            ids = tuple([r[0] for r in records] for records in (enemies, coins, powerups))
+            entries = tuple([(obj, slot_values(obj)) for obj in group] for group in objects)
+            self.chunks[i] = (pids, ids, entries)
+            for group, new in zip(built, objects):
+                group.extend(new)
+
+            layer = self.layers[i] = self.new_layer(source.chunk_width)
+            left = i * source.chunk_width
+            self.paint_static(layer, left, self.grid.query(left, 0, source.chunk_width, SCREEN_HEIGHT))
+            self.repainted.append(pygame.Rect(left, 0, source.chunk_width, SCREEN_HEIGHT))
+
+        enemies, coins, powerups = built
+        if self.store:
+            # New rows go after the old; then every kind is put back in chunk order
+            before = self.chunk_rows(exclude=indices)
+            self.store.extend(coins, powerups, enemies)
+            after = [labels + [i for i in sorted(indices) for _ in self.chunks[i][1][kind]]
+                     for kind, labels in enumerate(before)]
+            self.store_select([sorted(range(len(labels)), key=labels.__getitem__)
+                               for labels in after])
+        else:
+            self.enemies.extend(enemies)
+            self.coins.extend(coins)
+            self.powerups.extend(powerups)
+            self.arrange()
+
+    def unload(self, indices, remember=True):
+        # Drop built chunks: their platforms once no other chunk holds them, their part
+        # of the static layer and their entities, remembering which had been taken
+        indices = set(indices)
+        if self.store:
+            labels = self.chunk_rows()
+            gone = [column.tolist() for column in self.store.gone()]
+            gone = [gone[2], gone[0], gone[1]]  # Template order
+        else:
+            present = set(map(id, self.enemies + self.coins + self.powerups))
+        for i in sorted(indices):
+            pids, ids, entries = self.chunks.pop(i)
+            for pid in pids:
+                ref = self.platform_refs[pid]
+                ref[1] -= 1
+                if not ref[1]:
+                    del self.platform_refs[pid]
+                    self.grid.remove(ref[0])
+                    self.platforms.remove(ref[0])
+            del self.layers[i]
+            if not remember:
+                continue
+            taken = set(self.taken.get(i, ()))
+            if self.store:
+                for kind, rows in enumerate(labels):
+                    rids = iter(ids[kind])
+                    for row, chunk in enumerate(rows):
+                        if chunk == i:
+                            rid = next(rids)
+                            if gone[kind][row]:
+                                taken.add((kind, rid))
+            else:
+                for kind, (rids, group) in enumerate(zip(ids, entries)):
+                    for rid, (obj, _) in zip(rids, group):
+                        if id(obj) not in present or (kind == 0 and not obj.alive):
+                            taken.add((kind, rid))
+            if taken:
+                self.taken[i] = frozenset(taken)
+        if self.store:
+            self.store_select([[row for row, chunk in enumerate(rows) if chunk not in indices]
+                               for rows in labels])
+        else:
+            self.arrange()
+
+    def sync(self, chunks, taken):
+        # Hold the built chunks and taken entities of a snapshot. A built chunk is kept
+        # only when the entities taken from it are the same, since they decide its contents.
+        stale = [i for i in self.chunks if i not in chunks or self.taken.get(i) != taken.get(i)]
+        if stale:
+            self.unload(stale, remember=False)
+        self.taken = taken
+        wanted = [i for i in chunks if i not in self.chunks]
+        if wanted:
+            self.load(wanted)
+
+    def chunk_rows(self, exclude=()):
+        # The chunk each entity store row came from, per kind in template order
+        labels = ([], [], [])
+        for i in sorted(self.chunks):
+            if i not in exclude:
+                for rows, ids in zip(labels, self.chunks[i][1]):
+                    rows.extend([i] * len(ids))
+        return labels
+
+    def store_select(self, rows):
+        enemies, coins, powerups = rows
+        self.store.select(coins, powerups, enemies)
+
+    def arrange(self):
+        # Entities of a file-backed level are listed in chunk order, then record order,
+        # whatever order the chunks were built in
+        present = set(map(id, self.enemies + self.coins + self.powerups))
+        chunks = [self.chunks[i][2] for i in sorted(self.chunks)]
+        self.template = tuple([entry for entries in chunks for entry in entries[kind]]
+                              for kind in range(3))
+        self.enemies, self.coins, self.powerups = (
+            [obj for obj, _ in entries if id(obj) in present] for entries in self.template)
+
+    def remember_initial(self, enemies, coins, powerups):
+        for entries, objects in zip(self.template, (enemies, coins, powerups)):
+            entries.extend((obj, slot_values(obj)) for obj in objects)
+
+    def reset(self):
+        # Back to the starting state by copying saved attributes instead of rebuilding
+        broken, self.broken = self.broken, {}
+        if self.source is not None:
+            # File-backed levels are built again around wherever the view enters
+            self.unload(list(self.chunks), remember=False)
+            self.taken = {}
+            return
+        for rank, platform in broken.items():
+            platform.broken = False
+            self.grid.insert(platform, rank)
+            self.repaint(platform.rect)
+        if self.store:
+            self.store.reset()
+            return
+        lists = []
+        for entries in self.template:
+            for obj, values in entries:
+                set_slot_values(obj, values)
+            lists.append([obj for obj, _ in entries])
+        self.enemies, self.coins, self.powerups = lists
+        for enemy in self.enemies:
+            enemy.sync_rect()
+
+    def coin_count(self):
+        return self.store.coin_count() if self.store else len(self.coins)
+
+    def enemy_count(self):
+        return self.store.enemy_count() if self.store else len(self.enemies)
 
     def setup_level(self):
+        if self.level_num > 3:
+            self.width = SCREEN_WIDTH * LONG_LEVEL_SCREENS
+
         # Ground platform
-        self.platforms.append(Platform(0, SCREEN_HEIGHT - 40, SCREEN_WIDTH, 40))
+        self.platforms.append(Platform(0, SCREEN_HEIGHT - 40, self.width, 40))
 
         if self.level_num == 1:
             self.platforms.append(Platform(100, 300, 120, 15))
@@ -454,7 +1252,7 @@ class Level:
             for i in range(3):
                 self.coins.append(Coin(320 + i * 20, 210))
             self.powerups.append(PowerUp(200, 270, "mushroom"))
-            self.flag_pole = FlagPole(SCREEN_WIDTH - 80, SCREEN_HEIGHT - 180)
+            self.flag_pole = FlagPole(self.width - 80, SCREEN_HEIGHT - 180)
 
         elif self.level_num == 2:
             self.platforms.append(Platform(120, 320, 80, 15))
@@ -474,7 +1272,7 @@ class Level:
                 self.coins.append(Coin(395 + i * 15, 170))
             self.powerups.append(PowerUp(280, 230, "mushroom"))
             self.powerups.append(PowerUp(410, 120, "fire_flower"))
-            self.flag_pole = FlagPole(SCREEN_WIDTH - 80, SCREEN_HEIGHT - 180)
+            self.flag_pole = FlagPole(self.width - 80, SCREEN_HEIGHT - 180)
 
         elif self.level_num == 3:
             for i in range(7):
@@ -499,183 +1297,1603 @@ class Level:
                 self.coins.append(Coin(375 + i * 15, 100))
             self.powerups.append(PowerUp(240, 130, "mushroom"))
             self.powerups.append(PowerUp(380, 160, "fire_flower"))
-            self.flag_pole = FlagPole(SCREEN_WIDTH - 80, SCREEN_HEIGHT - 180)
+            self.flag_pole = FlagPole(self.width - 80, SCREEN_HEIGHT - 180)
 
         else:
-            # Default level
-            for i in range(5):
-                x = 100 + i * 100
-                y = 300 - i * 30
-                self.platforms.append(Platform(x, y, 70, 15))
-                if i % 2 == 0:
-                    self.platforms.append(Platform(x + 20, y - 40, 30, 15, breakable=True))
-            for i in range(3):
-                self.enemies.append(Enemy(130 + i * 140, 270, "goomba"))
-            for i in range(10):
-                self.coins.append(Coin(110 + i * 50, 240))
+            # Default level, the same staircase repeated on every screen
+            for screen in range(self.width // SCREEN_WIDTH):
+                left = screen * SCREEN_WIDTH
+                for i in range(5):
+                    x = left + 100 + i * 100
+                    y = 300 - i * 30
+                    self.platforms.append(Platform(x, y, 70, 15))
+                    if i % 2 == 0:
+                        self.platforms.append(Platform(x + 20, y - 40, 30, 15, breakable=True))
+                for i in range(3):
+                    self.enemies.append(Enemy(left + 130 + i * 140, 270, "goomba"))
+                for i in range(10):
+                    self.coins.append(Coin(left + 110 + i * 50, 240))
             self.powerups.append(PowerUp(300, 240, "mushroom"))
             self.powerups.append(PowerUp(450, 180, "fire_flower"))
-            self.flag_pole = FlagPole(SCREEN_WIDTH - 80, SCREEN_HEIGHT - 180)
+            self.flag_pole = FlagPole(self.width - 80, SCREEN_HEIGHT - 180)
+
+        # Index platforms for collision queries
+        for platform in self.platforms:
+            if not platform.broken:
+                self.grid.insert(platform)
+
+# Key names usable in input scripts
+KEY_NAMES = {
+    "left": pygame.K_LEFT,
+    "right": pygame.K_RIGHT,
+    "down": pygame.K_DOWN,
+    "space": pygame.K_SPACE,
+    "lshift": pygame.K_LSHIFT,
+    "z": pygame.K_z,
+    "r": pygame.K_r,
+    "backspace": pygame.K_BACKSPACE,
+}
+HELD_KEY_NAMES = ("left", "right", "down", "backspace")  # Keys the game reads as held rather than pressed
+
+class KeyState:
+    # Stands in for pygame.key.get_pressed() with a fixed set of held keys
+    def __init__(self, held=()):
+        self.held = frozenset(held)
+
+    def __getitem__(self, key):
+        return key in self.held
+
+NO_KEYS = KeyState()
+
+class KeyboardInput:
+    # Live input from the pygame event queue
+    def poll(self):
+        pressed = []
+        quit_requested = False
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                quit_requested = True
+            elif event.type == pygame.KEYDOWN:
+                pressed.append(event.key)
+        return pygame.key.get_pressed(), pressed, quit_requested
+
+class ScriptedInput:
+    # Plays back (held_keys, pressed_keys) per frame, then idles with no keys down.
+    # In a window the event queue is still read so the window can be closed.
+    def __init__(self, frames=(), window=False, start_level=None, rewind_seconds=0):
+        self.frames = [(held if isinstance(held, KeyState) else KeyState(held), list(pressed))
+                       for held, pressed in frames]
+        self.index = 0
+        self.window = window
+        self.start_level = start_level  # Level a recorded replay began on, if known
+        self.rewind_seconds = rewind_seconds  # History the script needs to rewind through
+
+    def __len__(self):
+        return len(self.frames)
+
+    def poll(self):
+        quit_requested = self.window and any(event.type == pygame.QUIT
+                                             for event in pygame.event.get())
+        if self.index >= len(self.frames):
+            return NO_KEYS, [], quit_requested
+        held, pressed = self.frames[self.index]
+        self.index += 1
+        return held, pressed, quit_requested
+
+class InputRecorder:
+    # Passes another input source through, keeping what it returned as script segments
+    def __init__(self, source):
+        self.source = source
+        self.segments = []
+        self.names = {key: name for name, key in KEY_NAMES.items()}
+
+    def poll(self):
+        keys, pressed, quit_requested = self.source.poll()
+        hold = [name for name in HELD_KEY_NAMES if keys[KEY_NAMES[name]]]
+        press = [self.names[key] for key in pressed if key in self.names]
+        last = self.segments[-1] if self.segments else None
+        if last is not None and not press and last.get("hold", []) == hold:
+            last["frames"] += 1
+        else:
+            segment = {"frames": 1}
+            if hold:
+                segment["hold"] = hold
+            if press:
+                segment["press"] = press
+            self.segments.append(segment)
+        return keys, pressed, quit_requested
+
+    def save(self, path, **header):
+        # A script load_input_script reads back, with header fields beside the segments
+        with open(path, "w") as f:
+            json.dump(dict(header, segments=self.segments), f, separators=(",", ":"))
+
+def load_input_script(path, window=False):
+    # JSON list of segments: {"frames": 30, "hold": ["right"], "press": ["space"]}
+    # Keys in "press" go down on the first frame of their segment only. Recorded
+    # replays are an object with the segments under "segments", the level they
+    # started on under "level" and the rewind history they were played with under
+    # "rewind".
+    with open(path) as f:
+        script = json.load(f)
+    start_level = None
+    rewind_seconds = REWIND_SECONDS
+    if isinstance(script, dict):
+        start_level = script.get("level")
+        rewind_seconds = script.get("rewind", rewind_seconds)
+        script = script["segments"]
+    if not any("backspace" in segment.get("hold", []) for segment in script):
+        # Nothing to rewind, so no history needs keeping
+        rewind_seconds = 0
+    frames = []
+    for segment in script:
+        held = KeyState(KEY_NAMES[name] for name in segment.get("hold", []))
+        pressed = [KEY_NAMES[name] for name in segment.get("press", [])]
+        for i in range(segment.get("frames", 1)):
+            frames.append((held, pressed if i == 0 else []))
+    return ScriptedInput(frames, window, start_level, rewind_seconds)
+
+# Snapshots: all mutable simulation state packed into one array of doubles. Each
+# layout lists the attributes saved for one kind of object and the type each is
+# restored as.
+class StateLayout:
+    def __init__(self, *fields):
+        self.names = tuple(name for name, _ in fields)
+        self.fields = fields
+        self.size = len(fields)
+        self.getter = operator.attrgetter(*self.names)
+
+    def pack(self, buffer, obj):
+        buffer.extend(self.getter(obj))
+
+    def unpack(self, obj, values, i):
+        # Returns the index just past this object's values
+        for name, kind in self.fields:
+            setattr(obj, name, kind(values[i]))
+            i += 1
+        return i
+
+PLAYER_STATE = StateLayout(
+    ("x", float), ("y", float), ("height", int), ("vel_x", float), ("vel_y", float),
+    ("on_ground", bool), ("direction", int), ("power_level", int), ("spin_jumping", bool),
+    ("spin_jump_timer", int), ("invulnerable", bool), ("invulnerable_timer", int),
+    ("lives", int), ("coins", int), ("score", int), ("crouching", bool),
+    ("fireball_cooldown", int), ("prev_x", float), ("prev_y", float), ("respawns", int))
+FIREBALL_STATE = StateLayout(("x", float), ("y", float), ("direction", int),
+                             ("bounce_count", int), ("prev_x", float), ("prev_y", float))
+ENEMY_STATE = StateLayout(("x", float), ("y", float), ("vel_x", float), ("vel_y", float),
+                          ("alive", bool), ("bounce_timer", int), ("direction", int),
+                          ("prev_x", float), ("prev_y", float))
+PICKUP_STATE = StateLayout(("collected", bool), ("bounce_offset", float),
+                           ("bounce_direction", int))
+LEVEL_STATES = (ENEMY_STATE, PICKUP_STATE, PICKUP_STATE)  # In Level.template order
+
+REWIND_SECONDS = 30  # History kept for rewinding, at the simulation rate
+REWIND_KEYFRAME_INTERVAL = 60  # Steps between full snapshots; the rest store only changes
+REWIND_BYTES = 4 * 1024 * 1024  # Fixed size of the rewind log
+REWIND_SLACK = 8  # Pixels past the simulated range still checked; more than an entity moves per step
+
+class RewindBuffer:
+    # Recent snapshots in a circular log of doubles allocated once. A keyframe is a
+    # whole snapshot; other steps store spans [count, start, length, values..., ...]
+    # that bring the step before up to date. The oldest steps are dropped, keyframe
+    # and all, when the log or the step limit fills up.
+    def __init__(self, steps, size=REWIND_BYTES, keyframe_interval=REWIND_KEYFRAME_INTERVAL):
+        self.data = array.array("d", bytes(size))
+        self.view = memoryview(self.data)
+        self.max_steps = steps
+        self.keyframe_interval = keyframe_interval
+        self.steps = collections.deque()  # (start, length, keyframe) per step, oldest first
+        self.head = 0  # Where the next step's record goes
+        self.last = None  # Snapshot of the newest step, unless it came as spans
+        self.since_keyframe = 0
+
+    def __len__(self):
+        return len(self.steps)
+
+    def clear(self):
+        self.steps.clear()
+        self.head = 0
+        self.last = None
+        self.since_keyframe = 0
+
+    def record(self, state):
+        last = self.last
+        keyframe = (last is None or len(last) != len(state)
+                    or self.since_keyframe >= self.keyframe_interval)
+        if keyframe:
+            record = state
+            self.since_keyframe = 0
+        elif np is not None:
+            new = np.frombuffer(state)
+            changed = np.flatnonzero(np.frombuffer(last) != new)
+            record = np.empty(1 + 3 * len(changed))
+            record[0] = len(changed)
+            record[1::3] = changed
+            record[2::3] = 1
+            record[3::3] = new[changed]
+            self.since_keyframe += 1
+        else:
+            record = array.array("d", [0])
+            for i, (old, new) in enumerate(zip(last, state)):
+                if old != new:
+                    record.extend((i, 1, new))
+            record[0] = (len(record) - 1) // 3
+            self.since_keyframe += 1
+        if len(state) > len(self.data):
+            self.clear()
+            return
+        if not self.write(record, keyframe):
+            # Eviction took this delta's keyframe; start again from a full snapshot
+            self.write(state, True)
+            self.since_keyframe = 0
+        self.last = state
+
+    def keyframe_due(self):
+        return not self.steps or self.since_keyframe >= self.keyframe_interval
+
+    def record_spans(self, record):
+        # A step the caller already wrote as spans. Without the whole state the next
+        # record() is a keyframe. Returns False when eviction left no keyframe for it.
+        self.last = None
+        if not self.write(record, False):
+            return False
+        self.since_keyframe += 1
+        return True
+
+    def write(self, record, keyframe):
+        steps = self.steps
+        start = self.head
+        end = start + len(record)
+        if end > len(self.data):
+            # Wrap around; steps left in the tail are the oldest and go first
+            while steps and steps[0][0] >= start:
+                self.drop_oldest()
+            start, end = 0, len(record)
+        while steps and (len(steps) >= self.max_steps or start <= steps[0][0] < end):
+            self.drop_oldest()
+        if not steps and not keyframe:
+            return False
+        self.view[start:end] = record
+        steps.append((start, len(record), keyframe))
+        self.head = end
+        return True
+
+    def drop_oldest(self):
+        steps = self.steps
+        steps.popleft()
+        # A delta is useless without the keyframe before it
+        while steps and not steps[0][2]:
+            steps.popleft()
+
+    def rewind(self):
+        # Drops the newest step and returns the snapshot of the one before, or None
+        # when there is nothing older left
+        steps = self.steps
+        if len(steps) < 2:
+            return None
+        self.head = steps.pop()[0]
+        i = len(steps) - 1
+        while not steps[i][2]:
+            i -= 1
+        self.since_keyframe = len(steps) - 1 - i
+        start, length, _ = steps[i]
+        data = self.data
+        state = data[start:start + length]
+        for j in range(i + 1, len(steps)):
+            k = steps[j][0]
+            for _ in range(int(data[k])):
+                at, count = int(data[k + 1]), int(data[k + 2])
+                state[at:at + count] = data[k + 3:k + 3 + count]
+                k += 2 + count
+        self.last = state
+        return state
+
+# Rollback netplay: two game processes exchange only their inputs over UDP. Each one
+# simulates ahead on a guess of the other player's input and, when the real input
+# turns out different, restores the snapshot from that frame and simulates forward
+# again.
+NET_KEYS = ("left", "right", "down", "space", "lshift", "z", "r")  # One bit each per frame
+NET_HELD = 3  # The first NET_HELD keys are held keys, the rest are presses
+NET_HELD_MASK = (1 << NET_HELD) - 1
+NET_PORT = 7350  # Player 1 listens here and player 2 on the port after
+NET_INPUT_DELAY = 1  # Frames local input waits before it applies, which hides some latency
+NET_MAX_ROLLBACK = 8  # Frames the simulation may run ahead of the remote input
+NET_RESEND = 32  # Most unacknowledged local inputs repeated in each packet
+NET_TIMEOUT = 5.0  # Seconds of silence after which the peer counts as gone
+NET_CONNECT_TIMEOUT = 30.0  # Seconds from the start to wait for the peer's first packet
+NET_MAGIC = b"SMBN"
+NET_PACKET = struct.Struct("<4sIiddd")  # magic, first input frame, ack, sent, echo, echo hold
+
+# Input bits decoded once: (held KeyState, pressed keys) for every value
+NET_DECODED = [(KeyState(KEY_NAMES[name] for i, name in enumerate(NET_KEYS[:NET_HELD])
+                         if bits >> i & 1),
+                [KEY_NAMES[name] for i, name in enumerate(NET_KEYS)
+                 if i >= NET_HELD and bits >> i & 1])
+               for bits in range(1 << len(NET_KEYS))]
+
+def encode_input(keys, pressed):
+    bits = 0
+    for i, name in enumerate(NET_KEYS):
+        key = KEY_NAMES[name]
+        if (keys[key] if i < NET_HELD else key in pressed):
+            bits |= 1 << i
+    return bits
+
+class RollbackSession:
+    # One side of a two-player game. local is 0 when this process is player 1 and 1
+    # when it is player 2; inputs[0] and inputs[1] hold each player's bits by frame.
+    def __init__(self, game, local, port, peer, input_delay=NET_INPUT_DELAY,
+                 max_rollback=NET_MAX_ROLLBACK):
+        self.game = game
+        self.local = local
+        self.peer = peer
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("", port))
+        self.socket.setblocking(False)
+        self.input_delay = input_delay
+        self.max_rollback = max_rollback
+        # Nobody can press anything during the first input_delay frames
+        self.inputs = ({f: 0 for f in range(input_delay)}, {f: 0 for f in range(input_delay)})
+        self.frame = 0  # Next frame to simulate
+        self.confirmed = input_delay - 1  # Remote input is known for every frame up to here
+        self.acked = input_delay - 1  # The peer has our input for every frame up to here
+        self.oldest = 0  # Frames before this have been forgotten
+        self.predicted = {}  # Frame -> remote input guessed when the frame was simulated
+        self.states = {}  # Frame -> snapshot from before the frame was simulated
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.rtt = None
+        self.remote_sent = 0.0
+        self.remote_heard = None  # When the last packet arrived, once one has
+        self.started = time.perf_counter()
+        self.closed_reason = None  # Why the session stopped the game, if it did
+
+    def ping_ms(self):
+        return int(self.rtt * 1000) if self.rtt is not None else 0
+
+    def ready(self):
+        # True when the next frame may be simulated; False while too far ahead of the
+        # remote input. Stops the game once the peer goes silent or never answers.
+        self.receive()
+        if self.frame - self.confirmed <= self.max_rollback:
+            return True
+        now = time.perf_counter()
+        if self.remote_heard is None:
+            if now - self.started > NET_CONNECT_TIMEOUT:
+                self.closed_reason = "peer never answered"
+                self.game.running = False
+        elif now - self.remote_heard > NET_TIMEOUT:
+            self.closed_reason = "peer stopped responding"
+            self.game.running = False
+        self.send()
+        return False
+
+    def wait(self, timeout=0.001):
+        select.select([self.socket], [], [], timeout)
+
+    def advance(self, keys, pressed):
+        self.inputs[self.local][self.frame + self.input_delay] = encode_input(keys, pressed)
+        self.simulate(self.frame)
+        self.frame += 1
+        self.send()
+        self.forget()
+
+    def simulate(self, frame):
+        game = self.game
+        if frame > self.confirmed:
+            # Only frames simulated on a guess can be rolled back to
+            self.states[frame] = game.snapshot()
+        remote_inputs = self.inputs[1 - self.local]
+        remote = remote_inputs.get(frame)
+        if remote is None:
+            # Guess the remote player keeps holding what they last held
+            remote = self.predicted[frame] = remote_inputs.get(self.confirmed, 0) & NET_HELD_MASK
+        local = self.inputs[self.local][frame]
+        first, second = (local, remote) if self.local == 0 else (remote, local)
+        game.keys, pressed = NET_DECODED[first]
+        game.partner_keys, partner_pressed = NET_DECODED[second]
+        for key in pressed:
+            game.handle_key(key, game.player)
+        for key in partner_pressed:
+            game.handle_key(key, game.partner)
+        game.save_positions()
+        game.update()
+
+    def rollback(self, frame):
+        # Re-simulate from frame with the inputs known now
+        self.game.restore(self.states[frame])
+        self.rollbacks += 1
+        self.resimulated += self.frame - frame
+        for f in range(frame, self.frame):
+            self.simulate(f)
+
+    def receive(self):
+        remote_inputs = self.inputs[1 - self.local]
+        wrong = None  # Earliest frame simulated on a wrong guess
+        while True:
+            try:
+                data = self.socket.recv(2048)
+            except (BlockingIOError, ConnectionError):
+                break
+            if len(data) < NET_PACKET.size:
+                continue
+            magic, first, ack, sent, echo, hold = NET_PACKET.unpack_from(data)
+            if magic != NET_MAGIC:
+                continue
+            now = time.perf_counter()
+            self.remote_sent = sent
+            self.remote_heard = now
+            if echo:
+                rtt = now - echo - hold
+                self.rtt = rtt if self.rtt is None else self.rtt * 0.9 + rtt * 0.1
+            self.acked = max(self.acked, ack)
+            for frame, bits in enumerate(data[NET_PACKET.size:], first):
+                if frame <= self.confirmed or frame in remote_inputs:
+                    continue
+                remote_inputs[frame] = bits
+                guess = self.predicted.pop(frame, None)
+                if guess is not None and guess != bits and (wrong is None or frame < wrong):
+                    wrong = frame
+            while self.confirmed + 1 in remote_inputs:
+                self.confirmed += 1
+        if wrong is not None:
+            self.rollback(wrong)
+
+    def send(self):
+        # Every local input the peer has not acknowledged yet, up to NET_RESEND of them
+        local_inputs = self.inputs[self.local]
+        last = self.frame - 1 + self.input_delay
+        first = max(self.acked + 1, last - NET_RESEND + 1)
+        now = time.perf_counter()
+        hold = now - self.remote_heard if self.remote_heard else 0.0
+        packet = NET_PACKET.pack(NET_MAGIC, first, self.confirmed, now, self.remote_sent, hold)
+        packet += bytes(local_inputs[f] for f in range(first, last + 1))
+        try:
+            self.socket.sendto(packet, self.peer)
+        except OSError:
+            pass  # The peer may not be listening yet
+
+    def forget(self):
+        # Drop frames that can no longer be rolled back to or need resending
+        limit = min(self.confirmed, self.acked)
+        while self.oldest < limit:
+            self.states.pop(self.oldest, None)
+            for inputs in self.inputs:
+                inputs.pop(self.oldest, None)
+            self.oldest += 1
+
+    def settle(self, timeout=NET_TIMEOUT):
+        # Exchange inputs until both sides know every frame simulated here, so the
+        # final state no longer rests on a guess
+        deadline = time.perf_counter() + timeout
+        last = self.frame - 1 + self.input_delay
+        while time.perf_counter() < deadline:
+            self.receive()
+            self.send()
+            if self.confirmed >= self.frame - 1 and self.acked >= last:
+                break
+            self.wait(0.01)
+        for _ in range(3):
+            # The peer may still be waiting for our acknowledgement
+            self.send()
+
+    def summary(self):
+        per_rollback = self.resimulated / self.rollbacks if self.rollbacks else 0.0
+        return ("netplay frames=%d rollbacks=%d resimulated=%d (%.1f per rollback) ping=%d ms"
+                % (self.frame, self.rollbacks, self.resimulated, per_rollback, self.ping_ms()))
+
+    def close(self):
+        self.socket.close()
+
+# Stop conditions for headless runs
+UNTIL_CONDITIONS = {
+    "life-lost": lambda game: game.player.lives < 3,
+    "powered-up": lambda game: game.player.power_level > 0,
+    "all-coins": lambda game: game.level.coin_count() == 0,
+    "all-enemies": lambda game: game.level.enemy_count() == 0,
+}
 
 class Game:
-    def __init__(self):
+    def __init__(self, headless=False, input_source=None, sim_rate=FPS, render_rate=FPS,
+                 dirty_rects=False, array_store=False, level_dir=None, profiler=None,
+                 rewind_seconds=0):
         global game_instance
         game_instance = self
         
-        self.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-        pygame.display.set_caption("Super Mario Bros")
+        self.headless = headless
+        if headless:
+            # Draw into an off-screen surface; no window is ever opened
+            self.screen = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT))
+        else:
+            self.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+            pygame.display.set_caption("Super Mario Bros")
         self.clock = pygame.time.Clock()
+        self.sim_rate = sim_rate
+        self.render_rate = render_rate  # 0 renders as fast as possible
+        # Present only the screen areas that changed instead of flipping the whole frame
+        self.dirty_rects = dirty_rects
+        self.dirty = []
+        self.presented_level = None
+        self.presented_offset = None
+        if input_source is None:
+            input_source = ScriptedInput() if headless else KeyboardInput()
+        self.input = input_source
+        self.keys = NO_KEYS
+        self.profiler = profiler
+        # Holding Backspace steps back through this many seconds of snapshots
+        self.rewind = RewindBuffer(rewind_seconds * sim_rate) if rewind_seconds else None
+        self.tracked = None  # Where entities sit in the newest rewind keyframe, see record_step
+        self.active = (-math.inf, math.inf)  # x range the last update simulated entities in
         
+        self.array_store = array_store
+        self.level_dir = level_dir  # Levels found here as level files replace the built-in ones
+        self.levels = {}  # Levels built so far by number; re-entering one resets it in place
         self.player = Player(100, 200)
+        self.partner = None  # Second player, steered by partner_keys
+        self.partner_keys = NO_KEYS
+        self.net = None  # RollbackSession when playing over the network
         self.current_level = 1
-        self.level = Level(self.current_level, 1)
+        self.enter_level()
         self.font = pygame.font.SysFont(None, 24)
+        atlas = DigitAtlas(self.font, WHITE)
+        self.hud_score = HudLabel(self.font, atlas, (10, 10))
+        self.hud_coins = HudLabel(self.font, atlas, (10, 40))
+        self.hud_lives = HudLabel(self.font, atlas, (SCREEN_WIDTH - 100, 10))
+        self.hud_level = HudLabel(self.font, atlas, (SCREEN_WIDTH - 100, 40))
+        self.hud_partner = HudLabel(self.font, atlas, (SCREEN_WIDTH - 100, 70))
+        self.hud_ping = HudLabel(self.font, atlas, (10, SCREEN_HEIGHT - 30))
+        self.hud_rollbacks = HudLabel(self.font, atlas, (140, SCREEN_HEIGHT - 30))
         
         self.running = True
         self.game_state = "playing"  # playing, game_over, level_complete
 
     def handle_events(self):
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
+        self.keys, pressed, quit_requested = self.input.poll()
+        if quit_requested:
+            self.running = False
+        for key in pressed:
+            self.handle_key(key)
+
+    @property
+    def players(self):
+        return [self.player] if self.partner is None else [self.player, self.partner]
+
+    def add_partner(self):
+        self.partner = Player(100, 200)
+        self.partner.color = GREEN
+
+    def focus_x(self):
+        # Where the camera centres: between the players when there are two
+        players = self.players
+        return sum(player.x + player.width / 2 for player in players) / len(players)
+
+    def handle_key(self, key, player=None):
+        if player is None:
+            player = self.player
+        if key == pygame.K_SPACE:
+            player.jump()
+        elif key == pygame.K_LSHIFT:
+            player.spin_jump()
+        elif key == pygame.K_z:
+            player.shoot_fireball()
+        elif key == pygame.K_r:
+            self.reset_level()
+        elif key == pygame.K_F3 and self.profiler:
+            self.profiler.overlay = not self.profiler.overlay
+
+    def net_step(self):
+        # One step of a network game: local input goes to the rollback session to
+        # simulate. Returns False while waiting for the remote player; keys pressed
+        # meanwhile stay queued until then.
+        if not self.net.ready():
+            if not self.headless and pygame.event.peek(pygame.QUIT):
                 self.running = False
-            elif event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_SPACE:
-                    self.player.jump()
-                elif event.key == pygame.K_LSHIFT:
-                    self.player.spin_jump()
-                elif event.key == pygame.K_z:
-                    self.player.shoot_fireball()
-                elif event.key == pygame.K_r:
-                    self.reset_level()
+            return False
+        keys, pressed, quit_requested = self.input.poll()
+        if quit_requested:
+            self.running = False
+        self.net.advance(keys, pressed)
+        return True
+
+    def rewind_step(self):
+        # Returns True when this step went back in time instead of forward
+        if self.rewind is None or not self.keys[pygame.K_BACKSPACE]:
+            return False
+        state = self.rewind.rewind()
+        if state is not None:
+            self.restore(state)
+        return True
+
+    def record_step(self):
+        # Between keyframes a step is written as spans of the snapshot it may have
+        # changed, so no whole snapshot is built and diffed every step
+        rewind = self.rewind
+        if rewind is None:
+            return
+        state, chunk_part = self.snapshot_head()
+        layout = (self.level, len(state), state[chunk_part:])
+        if self.tracked is not None and self.tracked[0] == layout and not rewind.keyframe_due():
+            record = array.array("d", (0, 0, chunk_part))
+            record.extend(state[:chunk_part])
+            record[0] = 1 + self.entity_spans(record)
+            if rewind.record_spans(record):
+                return
+        # A keyframe is due, or the level or its chunks changed since the last one
+        self.pack_entities(state)
+        rewind.record(state)
+        self.track_entities(state, layout)
 
     def reset_level(self):
-        self.level = Level(self.current_level, 1)
-        self.player.respawn()
+        for player in self.players:
+            player.respawn()
+        self.enter_level()
+
+    def build_level(self, level_num):
+        # Touches no game state, so a level can be built off the main thread and
+        # handed over through self.levels
+        source = None
+        if self.level_dir:
+            path = os.path.join(self.level_dir, LEVEL_FILE_NAME % level_num)
+            if os.path.exists(path):
+                source = LevelFile(path)
+        return Level(level_num, 1, self.array_store, source)
+
+    def close(self):
+        # Close the level files of every level built so far
+        for level in self.levels.values():
+            if level.source is not None:
+                level.source.close()
+        self.levels = {}
+
+    def enter_level(self):
+        level = self.levels.get(self.current_level)
+        if level is not None:
+            level.reset()
+        else:
+            level = self.levels[self.current_level] = self.build_level(self.current_level)
+        self.level = level
+        self.tracked = None
+        self.camera = Camera(self.level.width)
+        self.camera.snap(self.focus_x())
+        self.level.stream(self.camera.x)
+        if self.profiler:
+            self.profiler.watch_grid(self.level.grid)
 
     def update(self):
-        keys = pygame.key.get_pressed()
-        
-        # Horizontal movement
-        if keys[pygame.K_LEFT]:
-            self.player.vel_x = -self.player.speed
-            self.player.direction = -1
-        elif keys[pygame.K_RIGHT]:
-            self.player.vel_x = self.player.speed
-            self.player.direction = 1
+        players = self.players
+        for player, keys in zip(players, (self.keys, self.partner_keys)):
+            # Horizontal movement
+            if keys[pygame.K_LEFT]:
+                player.vel_x = -player.speed
+                player.direction = -1
+            elif keys[pygame.K_RIGHT]:
+                player.vel_x = player.speed
+                player.direction = 1
+            else:
+                player.vel_x = 0
+
+            # Crouching
+            player.crouching = keys[pygame.K_DOWN]
+
+            # Update player
+            player.update(self.level.grid, self.level.width, self.camera.x)
+        profiler = self.profiler
+        if profiler:
+            profiler.lap("player")
+
+        self.resolve_fireball_hits()
+        if profiler:
+            profiler.lap("fireball hits")
+
+        store = self.level.store
+        self.active = self.camera.active_range()
+        if store:
+            self.update_store(store)
         else:
-            self.player.vel_x = 0
-            
-        # Crouching
-        self.player.crouching = keys[pygame.K_DOWN]
-        
-        # Update player
-        self.player.update(self.level.platforms, self.level.enemies, 
-                          self.level.coins, self.level.powerups)
+            self.update_objects()
+
+        self.camera.follow(self.focus_x())
+        self.level.stream(self.camera.x)
+        if profiler:
+            profiler.lap("camera")
+
+    def update_objects(self):
+        # Entities far outside the view keep still until the camera comes near
+        lo, hi = self.active
         
         # Update enemies
         for enemy in self.level.enemies[:]:
-            if not enemy.update(self.level.platforms):
+            if lo <= enemy.x <= hi and not enemy.update(self.level.grid, self.level.width):
                 self.level.enemies.remove(enemy)
         
         # Update coins
         for coin in self.level.coins:
-            coin.update()
+            if lo <= coin.x <= hi:
+                coin.update()
             
         # Update powerups
         for powerup in self.level.powerups:
-            powerup.update()
+            if lo <= powerup.x <= hi:
+                powerup.update()
+
+        profiler = self.profiler
+        if profiler:
+            profiler.lap("entities")
+            profiler.count("pickup tests", len(self.level.coins) + len(self.level.powerups))
+            profiler.count("enemy tests", len(self.level.enemies))
             
-        # Check coin collisions
-        player_rect = pygame.Rect(self.player.x, self.player.y, 
-                                 self.player.width, self.player.height)
-        for coin in self.level.coins[:]:
-            if not coin.collected:
-                coin_rect = pygame.Rect(coin.x - coin.radius, coin.y - coin.radius,
-                                       coin.radius * 2, coin.radius * 2)
-                if player_rect.colliderect(coin_rect):
-                    coin.collected = True
-                    self.player.coins += 1
-                    self.player.score += 100
-                    self.level.coins.remove(coin)
-        
-        # Check powerup collisions
-        for powerup in self.level.powerups[:]:
-            if not powerup.collected:
-                powerup_rect = pygame.Rect(powerup.x, powerup.y, 
-                                          powerup.width, powerup.height)
-                if player_rect.colliderect(powerup_rect):
-                    powerup.collected = True
-                    if powerup.power_type == "mushroom":
-                        if self.player.power_level < 2:
-                            self.player.power_level += 1
-                    elif powerup.power_type == "fire_flower":
-                        self.player.power_level = 2
-                    self.player.score += 1000
-                    self.level.powerups.remove(powerup)
-        
-        # Check enemy collisions
-        for enemy in self.level.enemies:
-            if enemy.alive:
-                enemy_rect = pygame.Rect(enemy.x, enemy.y, enemy.width, enemy.height)
-                if player_rect.colliderect(enemy_rect):
-                    # Check if player is jumping on enemy
-                    if self.player.vel_y > 0 and player_rect.bottom < enemy_rect.top + 10:
+        for player in self.players:
+            # Check coin collisions
+            player_rect = player.rect
+            for coin in self.level.coins[:]:
+                if not coin.collected:
+                    if player_rect.colliderect(coin.rect):
+                        coin.collected = True
+                        self.collect_coins(player, 1)
+                        self.level.coins.remove(coin)
+
+            # Check powerup collisions
+            for powerup in self.level.powerups[:]:
+                if not powerup.collected:
+                    if player_rect.colliderect(powerup.rect):
+                        powerup.collected = True
+                        self.collect_powerup(player, powerup.power_type)
+                        self.level.powerups.remove(powerup)
+
+            # Check enemy collisions
+            for enemy in self.level.enemies:
+                if enemy.alive:
+                    enemy_rect = enemy.rect
+                    if player_rect.colliderect(enemy_rect):
+                        if self.touch_enemy(player, enemy_rect.top):
+                            enemy.alive = False
+                            enemy.bounce_timer = 20
+        if profiler:
+            profiler.lap("pickups")
+
+    def update_store(self, store):
+        # Same steps as the object path in update, run as batches over the entity store
+        store.update(self.level.grid, self.level.width, self.active)
+        profiler = self.profiler
+        if profiler:
+            profiler.lap("entities")
+            profiler.count("pickup tests", len(store.coin_x) + len(store.powerup_x))
+            profiler.count("enemy tests", len(store.enemy_x))
+        for player in self.players:
+            player_rect = player.rect
+            collected = store.take_coins(player_rect)
+            if collected:
+                self.collect_coins(player, collected)
+            for power_type in store.take_powerups(player_rect):
+                self.collect_powerup(player, power_type)
+            for i, enemy_top in store.enemies_touching(player_rect):
+                if self.touch_enemy(player, enemy_top):
+                    store.defeat_enemy(i)
+        if profiler:
+            profiler.lap("pickups")
+
+    def resolve_fireball_hits(self):
+        for player in self.players:
+            self.resolve_hits(player)
+
+    def resolve_hits(self, player):
+        # Each fireball defeats the first living enemy it touches
+        store = self.level.store
+        fireballs = player.fireballs
+        i = 0
+        while i < len(fireballs):
+            fireball = fireballs.slots[i]
+            if store:
+                hit = next(iter(store.enemies_touching(fireball.rect)), None)
+                if hit is not None:
+                    store.defeat_enemy(hit[0])
+            else:
+                hit = None
+                for enemy in self.level.enemies:
+                    if enemy.alive and fireball.check_collision(enemy):
                         enemy.alive = False
                         enemy.bounce_timer = 20
-                        self.player.vel_y = -5  # Bounce off enemy
-                        self.player.score += 100
-                    else:
-                        self.player.take_damage()
+                        hit = enemy
+                        break
+            if hit is not None:
+                player.score += 100
+                fireballs.release(fireball)
+            else:
+                i += 1
+
+    def collect_coins(self, player, count):
+        player.coins += count
+        player.score += 100 * count
+
+    def collect_powerup(self, player, power_type):
+        if power_type == "mushroom":
+            if player.power_level < 2:
+                player.power_level += 1
+        elif power_type == "fire_flower":
+            player.power_level = 2
+        player.score += 1000
+
+    def touch_enemy(self, player, enemy_top):
+        # Returns True when the player stomps the enemy, otherwise the player is hurt
+        if player.vel_y > 0 and player.rect.bottom < enemy_top + 10:
+            player.vel_y = -5  # Bounce off enemy
+            player.score += 100
+            return True
+        player.take_damage()
+        return False
+
+    def save_positions(self):
+        self.camera.prev_x = self.camera.x
+        for player in self.players:
+            player.save_position()
+        if self.level.store:
+            self.level.store.save_positions()
+        for enemy in self.level.enemies:
+            enemy.prev_x = enemy.x
+            enemy.prev_y = enemy.y
+
+    def snapshot(self):
+        # Flat copy of the simulation state; restore() puts it back without rebuilding
+        # the level. Layout: level, camera, each player and its fireballs, for a
+        # file-backed level its built chunks and taken entities, then either every
+        # entity the level holds (present flag + state) or the entity store's columns.
+        state, _ = self.snapshot_head()
+        self.pack_entities(state)
+        return state
+
+    def snapshot_head(self):
+        # The snapshot up to the entities, and where its chunk part starts
+        level = self.level
+        state = array.array("d", (self.current_level, self.camera.x, self.camera.prev_x))
+        for player in self.players:
+            PLAYER_STATE.pack(state, player)
+            state.append(len(player.fireballs))
+            for fireball in player.fireballs:
+                FIREBALL_STATE.pack(state, fireball)
+        chunk_part = len(state)
+        if level.source:
+            state.append(len(level.chunks))
+            state.extend(sorted(level.chunks))
+            taken = [(i, kind, rid) for i, entities in sorted(level.taken.items())
+                     for kind, rid in sorted(entities)]
+            state.append(len(taken))
+            for entry in taken:
+                state.extend(entry)
+        return state, chunk_part
+
+    def pack_entities(self, state):
+        level = self.level
+        store = level.store
+        if store:
+            for name in store.initial:
+                column = getattr(store, name)
+                state.append(column.shape[-1])
+                state.frombytes(column.astype(float).tobytes())
+        else:
+            for layout, entries, current in zip(LEVEL_STATES, level.template,
+                                                (level.enemies, level.coins, level.powerups)):
+                present = set(map(id, current))
+                state.append(len(entries))
+                getter = layout.getter
+                for obj, _ in entries:
+                    state.append(id(obj) in present)
+                    state.extend(getter(obj))
+
+    def track_entities(self, state, layout):
+        # Where each entity's values sit in state, a keyframe just recorded, for the
+        # spans of the steps up to the next one
+        level = self.level
+        store = level.store
+        i = layout[1]
+        if store:
+            names = list(store.initial)
+            positions = []
+            for name in names:
+                size = getattr(store, name).size
+                positions.append(np.arange(i + 1, i + 1 + size))
+                i += 1 + size
+            positions = np.concatenate(positions)
+            self.tracked = (layout, names, positions, np.frombuffer(state)[positions])
+            return
+        # Per entity, what to write while it is in the level and once it has left
+        spans = {}
+        present = []
+        for fields, entries, current in zip(LEVEL_STATES, level.template,
+                                            (level.enemies, level.coins, level.powerups)):
+            i += 1
+            length = 1 + fields.size
+            for obj, _ in entries:
+                spans[obj] = ((obj, (i, length, 1), fields.getter),
+                              (obj, (i, length, 0), fields.getter))
+                i += length
+            present.append(set(current))
+        # Enemies whose previous positions are still to catch up carry over as well
+        carried = [spans[obj][0] for obj in level.enemies
+                   if obj.prev_x != obj.x or obj.prev_y != obj.y]
+        self.tracked = (layout, spans, present, carried)
+
+    def entity_spans(self, record):
+        # Append spans for the entities this step may have changed and return how
+        # many. Store columns are compared whole against their recorded values. Of
+        # the entity objects only those simulated can have changed, plus enemies
+        # whose previous positions save_positions may still move.
+        level = self.level
+        store = level.store
+        if store:
+            _, names, positions, recorded = self.tracked
+            current = np.concatenate([getattr(store, name).ravel() for name in names])
+            changed = np.flatnonzero(current != recorded)
+            recorded[changed] = current[changed]
+            spans = np.empty((len(changed), 3))
+            spans[:, 0] = positions[changed]
+            spans[:, 1] = 1
+            spans[:, 2] = current[changed]
+            record.frombytes(spans.tobytes())
+            return len(changed)
+        layout, spans, present, before = self.tracked
+        lo, hi = self.active
+        lo -= REWIND_SLACK
+        hi += REWIND_SLACK
+        simulated = []
+        for kind, current in enumerate((level.enemies, level.coins, level.powerups)):
+            simulated += [spans[obj][0] for obj in current if lo <= obj.x <= hi]
+            if len(current) != len(present[kind]):
+                # Collected and fallen entities leave their list
+                remaining = set(current)
+                simulated += [spans[obj][1] for obj in present[kind] - remaining]
+                present[kind] = remaining
+        written = carried = simulated
+        if before != simulated:
+            # Spans apply in order, so this step's come last. An enemy still in the
+            # level that left the range is written again until save_positions has
+            # caught its previous position up with where it stopped.
+            seen = set(simulated)
+            left = [span for span in before if span not in seen]
+            written = left + simulated
+            enemies = present[0]
+            carried = simulated + [(obj, span, getter) for obj, span, getter in left
+                                   if span[2] and obj in enemies
+                                   and (obj.prev_x != obj.x or obj.prev_y != obj.y)]
+        # Gathered as a list first: converting to doubles once is faster than per entity
+        values = []
+        for obj, span, getter in written:
+            values += span
+            values += getter(obj)
+        record.extend(array.array("d", values))
+        self.tracked = (layout, spans, present, carried)
+        return len(written)
+
+    def restore(self, state):
+        self.tracked = None
+        level_num = int(state[0])
+        if level_num != self.current_level:
+            # Switch to the snapshot's level as it was left; it is built only if it
+            # never has been
+            self.current_level = level_num
+            level = self.levels.get(level_num)
+            if level is None:
+                self.enter_level()
+            else:
+                self.level = level
+                self.camera = Camera(level.width)
+                if self.profiler:
+                    self.profiler.watch_grid(level.grid)
+        level = self.level
+        self.camera.x = state[1]
+        self.camera.prev_x = state[2]
+
+        i = 3
+        for player in self.players:
+            i = PLAYER_STATE.unpack(player, state, i)
+            player.sync_rect()
+            fireballs = player.fireballs
+            fireballs.count = int(state[i])
+            i += 1
+            for fireball in fireballs.slots[:fireballs.count]:
+                i = FIREBALL_STATE.unpack(fireball, state, i)
+                fireball.sync_rect()
 
-    def draw(self):
-        self.screen.fill(SKY_BLUE)
+        if level.source:
+            count = int(state[i])
+            chunks = [int(c) for c in state[i + 1:i + 1 + count]]
+            i += 1 + count
+            count = int(state[i])
+            taken = {}
+            for j in range(i + 1, i + 1 + 3 * count, 3):
+                chunk, kind, rid = map(int, state[j:j + 3])
+                taken.setdefault(chunk, set()).add((kind, rid))
+            i += 1 + 3 * count
+            level.sync(chunks, {chunk: frozenset(entities) for chunk, entities in taken.items()})
+
+        store = level.store
+        if store:
+            for name in store.initial:
+                column = getattr(store, name)
+                values = np.frombuffer(state, float, column.size, (i + 1) * 8)
+                np.copyto(column, values.reshape(column.shape), casting="unsafe")
+                i += 1 + column.size
+        else:
+            lists = []
+            for layout, entries in zip(LEVEL_STATES, level.template):
+                i += 1
+                kept = []
+                for obj, _ in entries:
+                    if state[i]:
+                        kept.append(obj)
+                    i = layout.unpack(obj, state, i + 1)
+                lists.append(kept)
+            level.enemies, level.coins, level.powerups = lists
+            for enemy in level.enemies:
+                enemy.sync_rect()
+        level.stream(self.camera.x)
+
+    def draw(self, alpha=1.0):
+        screen = self.screen
+        level = self.level
+        offset = self.camera.offset(alpha)
+        partial = (self.dirty_rects and self.presented_level is self.level
+                   and self.presented_offset == offset)
+        if partial:
+            # Erase last frame's sprites and HUD, and pick up any repainted blocks
+            erased = self.dirty + [rect.move(-offset, 0) for rect in level.repainted]
+            for rect in erased:
+                level.blit_static(screen, rect, offset)
+        else:
+            # Sky, platforms and flag pole come pre-baked
+            level.blit_static(screen, screen.get_rect(), offset)
+        self.level.repainted = []
+        dirty = []
         
-        # Draw level elements
-        for platform in self.level.platforms:
-            platform.draw(self.screen)
-            
+        # Draw level elements in view
+        lo = offset - DRAW_MARGIN
+        hi = offset + SCREEN_WIDTH + DRAW_MARGIN
         for coin in self.level.coins:
-            coin.draw(self.screen)
+            if lo <= coin.x <= hi:
+                area = coin.draw(screen, offset)
+                if area:
+                    dirty.append(area)
             
         for powerup in self.level.powerups:
-            powerup.draw(self.screen)
+            if lo <= powerup.x <= hi:
+                area = powerup.draw(screen, offset)
+                if area:
+                    dirty.append(area)
             
         for enemy in self.level.enemies:
-            enemy.draw(self.screen)
-            
-        if self.level.flag_pole:
-            self.level.flag_pole.draw(self.screen)
+            if lo <= enemy.x <= hi:
+                area = enemy.draw(screen, alpha, offset)
+                if area:
+                    dirty.append(area)
+
+        if self.level.store:
+            self.level.store.draw(screen, alpha, dirty, offset)
         
-        # Draw player
-        self.player.draw(self.screen)
+        # Draw players
+        for player in self.players:
+            player.draw(screen, alpha, dirty, offset)
         
         # Draw HUD
-        score_text = self.font.render(f"Score: {self.player.score}", True, WHITE)
-        coins_text = self.font.render(f"Coins: {self.player.coins}", True, WHITE)
-        lives_text = self.font.render(f"Lives: {self.player.lives}", True, WHITE)
-        level_text = self.font.render(f"Level: {self.current_level}", True, WHITE)
-        
-        self.screen.blit(score_text, (10, 10))
-        self.screen.blit(coins_text, (10, 40))
-        self.screen.blit(lives_text, (SCREEN_WIDTH - 100, 10))
-        self.screen.blit(level_text, (SCREEN_WIDTH - 100, 40))
+        dirty.append(self.hud_score.draw(screen, "Score: ", self.player.score))
+        dirty.append(self.hud_coins.draw(screen, "Coins: ", self.player.coins))
+        dirty.append(self.hud_lives.draw(screen, "Lives: ", self.player.lives))
+        dirty.append(self.hud_level.draw(screen, "Level: ", self.current_level))
+        if self.partner:
+            dirty.append(self.hud_partner.draw(screen, "P2: ", self.partner.score))
+        if self.net:
+            dirty.append(self.hud_ping.draw(screen, "Ping: ", self.net.ping_ms(), " ms"))
+            dirty.append(self.hud_rollbacks.draw(screen, "Rollbacks: ", self.net.rollbacks))
+
+        profiler = self.profiler
+        if profiler:
+            if profiler.overlay:
+                dirty.append(profiler.draw_overlay(screen, (10, 70)))
+            profiler.lap("draw")
         
-        pygame.display.flip()
+        if not self.headless:
+            if partial:
+                pygame.display.update(erased + dirty)
+            else:
+                pygame.display.flip()
+            if profiler:
+                profiler.lap("flip")
+        self.dirty = dirty
+        self.presented_level = self.level
+        self.presented_offset = offset
+
+    def simulate(self, frames=None, until=None):
+        # Step the game without drawing or frame-rate cap; returns frames run
+        frame = 0
+        profiler = self.profiler
+        while self.running and (frames is None or frame < frames):
+            if profiler:
+                profiler.begin_frame()
+            if self.net is not None:
+                if not self.net_step():
+                    self.net.wait()
+                    continue
+                if profiler:
+                    profiler.lap("netplay")
+            else:
+                self.handle_events()
+                if profiler:
+                    profiler.lap("events")
+                if not self.rewind_step():
+                    self.update()
+                    self.record_step()
+                    if profiler:
+                        profiler.lap("rewind record")
+            if profiler:
+                profiler.end_frame()
+            frame += 1
+            if until is not None and until(self):
+                break
+        return frame
 
     def run(self):
+        # Fixed-timestep simulation; rendering interpolates between the last two steps.
+        # Input is read once per step so recordings replay step for step.
+        step = 1.0 / self.sim_rate
+        accumulator = 0.0
+        profiler = self.profiler
+        self.clock.tick()
         while self.running:
-            self.handle_events()
-            self.update()
-            self.draw()
-            self.clock.tick(FPS)
-        
+            frame_time = self.clock.tick(self.render_rate) / 1000.0
+            accumulator += min(frame_time, MAX_FRAME_TIME)
+            if profiler:
+                profiler.begin_frame()
+            while accumulator >= step:
+                if self.net is not None:
+                    self.net_step()
+                    if profiler:
+                        profiler.lap("netplay")
+                else:
+                    self.handle_events()
+                    if profiler:
+                        profiler.lap("events")
+                    self.save_positions()
+                    if profiler:
+                        profiler.lap("save positions")
+                    if not self.rewind_step():
+                        self.update()
+                        self.record_step()
+                        if profiler:
+                            profiler.lap("rewind record")
+                accumulator -= step
+            self.draw(accumulator / step)
+            if profiler:
+                profiler.end_frame()
+
+        if profiler:
+            profiler.report()
+        self.close()
         pygame.quit()
         sys.exit()
 
+# Frame capture. pixels3d views the surface's own memory; while any view exists the
+# surface is locked and cannot be drawn on, so views must not outlive the frame.
+GRAY_WEIGHTS = (77, 150, 29)  # Luma weights out of 256 for red, green, blue
+
+class FrameCapture:
+    # Reads a surface as (height, width[, 3]) uint8 frames, optionally keeping every
+    # scale-th pixel and converting to grayscale. grab() fills and returns the same
+    # buffer every call; copy it to keep a frame past the next grab.
+    def __init__(self, surface, scale=1, grayscale=False):
+        if np is None:
+            raise ImportError("FrameCapture requires NumPy")
+        self.surface = surface
+        self.scale = scale
+        self.grayscale = grayscale
+        width, height = surface.get_size()
+        size = (-(-height // scale), -(-width // scale))
+        self.frame = np.empty(size if grayscale else size + (3,), dtype=np.uint8)
+        if grayscale:
+            # Weighted sums are built in 16 bits, then shifted back to 8
+            self.luma = np.empty(size, dtype=np.uint16)
+            self.channel = np.empty(size, dtype=np.uint16)
+
+    def pixels(self):
+        # Zero-copy (height, width, 3) view of the whole surface; drop it before drawing
+        return pygame.surfarray.pixels3d(self.surface).transpose(1, 0, 2)
+
+    def grab(self):
+        pixels = self.pixels()[::self.scale, ::self.scale]
+        if self.grayscale:
+            luma, channel = self.luma, self.channel
+            np.multiply(pixels[..., 0], GRAY_WEIGHTS[0], out=luma, dtype=np.uint16)
+            for i in (1, 2):
+                np.multiply(pixels[..., i], GRAY_WEIGHTS[i], out=channel, dtype=np.uint16)
+                luma += channel
+            luma >>= 8
+            np.copyto(self.frame, luma, casting="unsafe")
+        else:
+            np.copyto(self.frame, pixels)
+        del pixels  # Unlock the surface
+        return self.frame
+
+# Reinforcement-learning environment: reset()/step(action) over a headless Game,
+# returning (observation, reward, terminated, truncated, info) like Gymnasium
+ENV_ACTIONS = (  # (held keys, keys pressed on the first frame of the step)
+    ((), ()),
+    (("left",), ()),
+    (("right",), ()),
+    (("down",), ()),
+    ((), ("space",)),
+    (("left",), ("space",)),
+    (("right",), ("space",)),
+    ((), ("lshift",)),
+    (("left",), ("lshift",)),
+    (("right",), ("lshift",)),
+    ((), ("z",)),
+    (("left",), ("z",)),
+    (("right",), ("z",)),
+)
+ENV_PLAYER_FIELDS = ("x", "y", "vel_x", "vel_y", "on_ground", "power_level", "direction",
+                     "invulnerable", "spin_jumping", "fireball_cooldown")
+ENV_ENEMIES = 8  # Nearest living enemies in an observation: present, dx, dy, vel_x
+ENV_COINS = 8  # Nearest coins in an observation: present, dx, dy
+ENV_MAX_STEPS = 3000  # Steps before an episode is truncated
+ENV_PROGRESS_REWARD = 0.1  # Per pixel of new ground covered to the right
+ENV_SCORE_REWARD = 0.01  # Per point scored
+ENV_DEATH_PENALTY = 10  # Lost on a death or fall, which ends the episode
+
+def nearest_rows(rows, count):
+    # The count rows closest to the player (dx, dy in the first two columns), padded
+    # with zeros behind a leading present flag
+    out = np.zeros((count, rows.shape[1] + 1), dtype=np.float32)
+    if len(rows):
+        if len(rows) > count:
+            order = np.argsort(rows[:, 0] ** 2 + rows[:, 1] ** 2)[:count]
+            rows = rows[order]
+        out[:len(rows), 0] = 1
+        out[:len(rows), 1:] = rows
+    return out
+
+class GameEnv:
+    # One headless game driven one action at a time. Each step holds the action's
+    # keys for frame_skip frames; pressed keys act on the first of them only.
+    def __init__(self, level=1, frame_skip=1, max_steps=ENV_MAX_STEPS, render=False,
+                 frame_scale=1, grayscale=False, array_store=False, level_dir=None):
+        if np is None:
+            raise ImportError("GameEnv requires NumPy")
+        self.game = Game(headless=True, array_store=array_store, level_dir=level_dir)
+        self.start_level = level
+        self.frame_skip = frame_skip
+        self.max_steps = max_steps
+        # With render, observations carry the drawn frame at 1/frame_scale size
+        self.capture = FrameCapture(self.game.screen, frame_scale, grayscale) if render else None
+        self.actions = [(KeyState(KEY_NAMES[name] for name in held),
+                         [KEY_NAMES[name] for name in pressed]) for held, pressed in ENV_ACTIONS]
+        self.player_fields = operator.attrgetter(*ENV_PLAYER_FIELDS)
+        self.steps = 0
+        self.furthest = 0
+
+    @property
+    def action_count(self):
+        return len(self.actions)
+
+    def reset(self, seed=None, options=None):
+        # The simulation is deterministic; seed is accepted for API compatibility
+        game = self.game
+        game.player = Player(100, 200)
+        game.current_level = (options or {}).get("level", self.start_level)
+        game.enter_level()
+        game.keys = NO_KEYS
+        game.running = True
+        self.steps = 0
+        self.furthest = game.player.x
+        return self.observe(), self.info()
+
+    def step(self, action):
+        game = self.game
+        player = game.player
+        held, pressed = self.actions[action]
+        respawns = player.respawns
+        score = player.score
+        for frame in range(self.frame_skip):
+            game.keys = held
+            if frame == 0:
+                for key in pressed:
+                    game.handle_key(key)
+            game.update()
+            if player.respawns != respawns:
+                break
+        self.steps += 1
+
+        terminated = player.respawns != respawns
+        if terminated:
+            reward = -ENV_DEATH_PENALTY
+        else:
+            reward = (player.score - score) * ENV_SCORE_REWARD
+            if player.x > self.furthest:
+                reward += (player.x - self.furthest) * ENV_PROGRESS_REWARD
+                self.furthest = player.x
+        truncated = not terminated and self.steps >= self.max_steps
+        return self.observe(), reward, terminated, truncated, self.info()
+
+    def snapshot(self):
+        # Saved episode position for search: restore() and step again from here
+        return self.game.snapshot(), self.steps, self.furthest
+
+    def restore(self, snapshot):
+        state, self.steps, self.furthest = snapshot
+        self.game.restore(state)
+        return self.observe()
+
+    def observe(self):
+        game = self.game
+        player = game.player
+        px, py = player.x, player.y
+        lo, hi = game.camera.active_range()
+        store = game.level.store
+        if store:
+            live = store.enemy_alive & (store.enemy_x >= lo) & (store.enemy_x <= hi)
+            enemies = np.stack((store.enemy_x[live] - px, store.enemy_y[live] - py,
+                                (store.enemy_vel_x * store.enemy_dir)[live]), axis=1)
+            live = store.coin_live & (store.coin_x >= lo) & (store.coin_x <= hi)
+            coins = np.stack((store.coin_x[live] - px, store.coin_y[live] - py), axis=1)
+        else:
+            enemies = np.array([(e.x - px, e.y - py, e.vel_x * e.direction)
+                                for e in game.level.enemies if e.alive and lo <= e.x <= hi],
+                               dtype=np.float32).reshape(-1, 3)
+            coins = np.array([(c.x - px, c.y - py) for c in game.level.coins
+                              if lo <= c.x <= hi], dtype=np.float32).reshape(-1, 2)
+        observation = {
+            "player": np.array(self.player_fields(player), dtype=np.float32),
+            "enemies": nearest_rows(enemies, ENV_ENEMIES),
+            "coins": nearest_rows(coins, ENV_COINS),
+        }
+        if self.capture:
+            game.draw()
+            observation["frame"] = self.capture.grab().copy()
+        return observation
+
+    def info(self):
+        player = self.game.player
+        return {"score": player.score, "coins": player.coins, "lives": player.lives,
+                "level": self.game.current_level, "steps": self.steps}
+
+    def close(self):
+        self.game.close()
+
+def env_step(env, action):
+    # Steps and starts a new episode when this one ends; the last observation of the
+    # finished episode goes in info["final_observation"]
+    observation, reward, terminated, truncated, info = env.step(action)
+    if terminated or truncated:
+        info["final_observation"] = observation
+        observation = env.reset()[0]
+    return observation, reward, terminated, truncated, info
+
+def env_worker(connection, options):
+    # Subprocess side of VectorEnv: serve reset/step/close requests for one env
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles Ctrl+C
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)  # Undo pygame's handler so terminate() works
+    env = GameEnv(**options)
+    while True:
+        command, argument = connection.recv()
+        if command == "step":
+            connection.send(env_step(env, argument))
+        elif command == "reset":
+            connection.send(env.reset(*argument))
+        elif command == "close":
+            env.close()
+            connection.close()
+            return
+
+def stack_observations(observations):
+    return {key: np.stack([o[key] for o in observations]) for key in observations[0]}
+
+class VectorEnv:
+    # count environments stepped together, in this process or one subprocess each.
+    # Observations come back stacked along a new first axis and finished episodes
+    # restart automatically.
+    def __init__(self, count, processes=False, **options):
+        self.count = count
+        self.envs = []
+        self.connections = []
+        self.workers = []
+        if processes:
+            for _ in range(count):
+                parent, child = multiprocessing.Pipe()
+                worker = multiprocessing.Process(target=env_worker, args=(child, options),
+                                                 daemon=True)
+                worker.start()
+                child.close()
+                self.connections.append(parent)
+                self.workers.append(worker)
+        else:
+            self.envs = [GameEnv(**options) for _ in range(count)]
+        self.action_count = len(ENV_ACTIONS)
+
+    def reset(self, seed=None, options=None):
+        if self.connections:
+            for i, connection in enumerate(self.connections):
+                connection.send(("reset", (None if seed is None else seed + i, options)))
+            results = [connection.recv() for connection in self.connections]
+        else:
+            results = [env.reset(None if seed is None else seed + i, options)
+                       for i, env in enumerate(self.envs)]
+        observations, infos = zip(*results)
+        return stack_observations(observations), list(infos)
+
+    def step(self, actions):
+        if self.connections:
+            for connection, action in zip(self.connections, actions):
+                connection.send(("step", int(action)))
+            results = [connection.recv() for connection in self.connections]
+        else:
+            results = [env_step(env, action) for env, action in zip(self.envs, actions)]
+        observations, rewards, terminated, truncated, infos = zip(*results)
+        return (stack_observations(observations), np.array(rewards, dtype=np.float32),
+                np.array(terminated), np.array(truncated), list(infos))
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(("close", None))
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+        for env in self.envs:
+            env.close()
+        self.connections = []
+        self.workers = []
+        self.envs = []
+
 # Global game instance
 game_instance = None
 
+def join_netplay(game, args):
+    # Player 1 listens on --port and player 2 on the port after it
+    game.add_partner()
+    local = args.netplay - 1
+    game.net = RollbackSession(game, local, args.port + local, (args.peer, args.port + 1 - local),
+                               args.input_delay)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Super Mario Bros")
+    parser.add_argument("--headless", action="store_true",
+                        help="simulate without a window or frame-rate cap")
+    parser.add_argument("--frames", type=int, default=None,
+                        help="frames to simulate in headless mode (default: script length or 3600)")
+    parser.add_argument("--script", help="JSON input script or recorded replay to drive the player")
+    parser.add_argument("--record", metavar="FILE",
+                        help="save every step's input as a replay script on exit")
+    parser.add_argument("--until", choices=sorted(UNTIL_CONDITIONS),
+                        help="stop the headless run early once this condition holds")
+    parser.add_argument("--level", type=int, default=1, help="level to start on")
+    parser.add_argument("--rewind", type=int, metavar="SECONDS",
+                        help="seconds of play Backspace can rewind through, 0 to turn off "
+                        "(default: %d in a window, off headless unless a script rewinds)"
+                        % REWIND_SECONDS)
+    parser.add_argument("--sim-rate", type=int, default=FPS,
+                        help="simulation steps per second (gameplay is tuned for %d)" % FPS)
+    parser.add_argument("--render-rate", type=int, default=FPS,
+                        help="frames drawn per second, 0 for uncapped")
+    parser.add_argument("--dirty-rects", action="store_true",
+                        help="update only changed screen regions instead of flipping")
+    parser.add_argument("--array-store", action="store_true",
+                        help="keep coins, power-ups and enemies in NumPy arrays")
+    parser.add_argument("--levels", metavar="DIR",
+                        help="load level N from DIR/levelN.lvl when that file exists")
+    parser.add_argument("--export-levels", metavar="DIR",
+                        help="write the built-in levels 1-%d as level files to DIR and exit"
+                        % BUILTIN_LEVELS)
+    parser.add_argument("--profile", action="store_true",
+                        help="time each frame phase and print a summary on exit; "
+                        "in a window F3 toggles an on-screen overlay")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="with profiling, write a Chrome trace-event JSON file on exit")
+    parser.add_argument("--netplay", type=int, choices=(1, 2), metavar="PLAYER",
+                        help="play two-player over UDP as player 1 or 2; both sides must "
+                        "use the same --level and --frames")
+    parser.add_argument("--peer", default="127.0.0.1", help="host of the other --netplay player")
+    parser.add_argument("--port", type=int, default=NET_PORT,
+                        help="UDP port player 1 listens on; player 2 listens on the next one")
+    parser.add_argument("--input-delay", type=int, default=NET_INPUT_DELAY,
+                        help="frames netplay holds local input back before applying it")
+    args = parser.parse_args(argv)
+    if args.array_store and np is None:
+        parser.error("--array-store requires NumPy")
+
+    if args.export_levels:
+        os.makedirs(args.export_levels, exist_ok=True)
+        for level_num in range(1, BUILTIN_LEVELS + 1):
+            path = os.path.join(args.export_levels, LEVEL_FILE_NAME % level_num)
+            write_level_file(Level(level_num, 1), path)
+            print(path)
+        return
+
+    profiler = FrameProfiler(args.trace) if args.profile or args.trace else None
+
+    # A recorded replay starts on the level it was recorded on
+    level = args.level
+    input_source = None
+    if args.script:
+        input_source = load_input_script(args.script, window=not args.headless)
+        if input_source.start_level is not None:
+            level = input_source.start_level
+    recorder = None
+
+    # Recording history costs about as much as a step of play, so only a player at
+    # the keys or a script that rewinds gets it by default
+    rewind = args.rewind
+    if rewind is None:
+        if input_source is not None:
+            rewind = input_source.rewind_seconds
+        else:
+            rewind = 0 if args.headless else REWIND_SECONDS
+    if args.netplay:
+        # Rewinding one side alone would split the two games apart
+        rewind = 0
+
+    if not args.headless:
+        if profiler:
+            profiler.overlay = True
+        if input_source is None:
+            input_source = KeyboardInput()
+        if args.record:
+            input_source = recorder = InputRecorder(input_source)
+        game = Game(input_source=input_source, sim_rate=args.sim_rate,
+                    render_rate=args.render_rate, dirty_rects=args.dirty_rects,
+                    array_store=args.array_store, level_dir=args.levels, profiler=profiler,
+                    rewind_seconds=rewind)
+        if args.netplay:
+            join_netplay(game, args)
+        if level != 1:
+            game.current_level = level
+            game.reset_level()
+        try:
+            game.run()
+        finally:
+            game.close()
+            if recorder:
+                recorder.save(args.record, level=level, rewind=rewind)
+            if game.net:
+                if game.net.closed_reason:
+                    print(game.net.closed_reason)
+                print(game.net.summary())
+                game.net.close()
+        return
+
+    if input_source is None:
+        input_source = ScriptedInput()
+    frames = args.frames
+    if frames is None:
+        frames = len(input_source) or 3600
+    if args.record:
+        input_source = recorder = InputRecorder(input_source)
+    game = Game(headless=True, input_source=input_source, array_store=args.array_store,
+                level_dir=args.levels, profiler=profiler, rewind_seconds=rewind)
+    if args.netplay:
+        join_netplay(game, args)
+    if level != 1:
+        game.current_level = level
+        game.reset_level()
+
+    until = UNTIL_CONDITIONS[args.until] if args.until else None
+    start = time.perf_counter()
+    ran = game.simulate(frames, until)
+    if game.net:
+        if game.net.closed_reason:
+            print(game.net.closed_reason)
+        else:
+            game.net.settle()
+    elapsed = time.perf_counter() - start
+    fps = ran / elapsed if elapsed > 0 else float("inf")
+    print(f"frames={ran} seconds={elapsed:.3f} fps={fps:.0f}")
+    print(f"score={game.player.score} coins={game.player.coins} lives={game.player.lives} "
+          f"power={game.player.power_level} x={game.player.x:.1f} y={game.player.y:.1f}")
+    if game.net:
+        # Both sides print the same state checksum once their inputs have settled
+        print("%s state=%08x" % (game.net.summary(), zlib.crc32(game.snapshot())))
+        game.net.close()
+    game.close()
+    if recorder:
+        recorder.save(args.record, level=level, rewind=rewind)
+    if profiler:
+        profiler.report()
+
 # Main execution
 if __name__ == "__main__":
-    game = Game()
-    game.run()
+    main()
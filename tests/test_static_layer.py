@@ -0,0 +1,68 @@
+# Breaking a platform clears it from the static layer and from collisions, and a
+# level reset puts it back. Run with: python -m pytest tests
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "benchmarks"))
+from games import load_smb
+
+smb = load_smb()
+
+def lone_breakable(level):
+    # A breakable platform whose centre no other platform covers
+    for platform in level.platforms:
+        if platform.breakable:
+            x, y = platform.rect.center
+            if [p for p in level.platforms if p.rect.collidepoint(x, y)] == [platform]:
+                return platform
+    raise AssertionError("level %d has no lone breakable platform" % level.level_num)
+
+def pixel(level, x, y):
+    if level.source is None:
+        return tuple(level.static_layer.get_at((x, y)))[:3]
+    width = level.source.chunk_width
+    return tuple(level.layers[x // width].get_at((x % width, y)))[:3]
+
+def test_break_platform_repaints_only_its_area():
+    level = smb.Level(4, 1)
+    platform = lone_breakable(level)
+    x, y = platform.rect.center
+    outside = (platform.rect.right + 1, platform.rect.bottom + 1)
+    assert pixel(level, x, y) != smb.SKY_BLUE
+    before = pixel(level, *outside)
+
+    level.repainted = []
+    level.break_platform(platform)
+    assert pixel(level, x, y) == smb.SKY_BLUE
+    assert pixel(level, *outside) == before
+    assert level.repainted == [platform.rect]
+    assert platform not in level.grid.query(x, y, 1, 1)
+
+    level.reset()
+    assert not platform.broken
+    assert pixel(level, x, y) != smb.SKY_BLUE
+    assert platform in level.grid.query(x, y, 1, 1)
+
+def test_broken_platform_stays_broken_when_its_chunk_is_rebuilt(tmp_path):
+    path = str(tmp_path / "level4.lvl")
+    smb.write_level_file(smb.Level(4, 1), path)
+    source = smb.LevelFile(path)
+    try:
+        level = smb.Level(4, 1, source=source)
+        platform = lone_breakable(level)
+        x, y = platform.rect.center
+        level.break_platform(platform)
+        assert pixel(level, x, y) == smb.SKY_BLUE
+
+        level.stream(level.width - smb.SCREEN_WIDTH)
+        assert x // source.chunk_width not in level.chunks
+        level.stream(0)
+        assert pixel(level, x, y) == smb.SKY_BLUE
+        assert not [p for p in level.grid.query(x, y, 1, 1) if p.rect.collidepoint(x, y)]
+
+        level.reset()
+        level.stream(0)
+        assert pixel(level, x, y) != smb.SKY_BLUE
+    finally:
+        source.close()